@@ -0,0 +1,202 @@
+"""准入控制：限制耗时接口的并发，保证各会话之间的公平
+
+每个受控接口有全局并发上限与每个会话的并发上限。名额不足时请求进入有界的等待队列，
+按到达顺序放行（轮到某个请求而其会话已达上限时，先放行后面其他会话的请求）；
+队列已满或等待超时时立即拒绝，调用方返回 429 与 Retry-After。
+计数在进程内，多 worker 部署时上限按每个进程计算。
+"""
+import threading
+import time
+from collections import deque
+
+# 统计最近多少次等待时间
+WAIT_SAMPLES = 256
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入；retry_after 为建议的重试间隔 (秒)"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class Ticket:
+    """已准入的请求；release() 归还名额（可重复调用）"""
+
+    def __init__(self, governor, session):
+        self.governor = governor
+        self.session = session
+        self.admitted_at = time.monotonic()
+        # 名额已交给 hold() 返回的生成器，由它负责归还
+        self.held = False
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.governor._release(self)
+
+    def hold(self, events):
+        """包装事件生成器：生成结束（或被关闭）时归还名额"""
+        self.held = True
+        return self._hold(events)
+
+    def _hold(self, events):
+        try:
+            yield from events
+        finally:
+            self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _Waiter:
+
+    def __init__(self, session):
+        self.session = session
+        self.enqueued = time.monotonic()
+
+
+class AdmissionGovernor:
+
+    def __init__(self, name, max_inflight, per_session, max_queue=16, max_wait=5.0):
+        self.name = name
+        self.max_inflight = max_inflight
+        self.per_session = per_session
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.inflight = 0
+        self._sessions = {}
+        self._queue = deque()
+        self._cond = threading.Condition()
+        # 统计
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        # 平均占用时间 (秒)，用于估算 Retry-After
+        self._hold_time = 1.0
+
+    # --- 准入判断（调用时持有 _cond） ---
+
+    def _has_room(self, session):
+        return self.inflight < self.max_inflight and self._sessions.get(session, 0) < self.per_session
+
+    def _is_next(self, waiter):
+        """排在它前面的请求都因会话上限而暂不能放行时，轮到它"""
+        if not self._has_room(waiter.session):
+            return False
+        for other in self._queue:
+            if other is waiter:
+                return True
+            if self._has_room(other.session):
+                return False
+        return False
+
+    def _admit(self, session, waited):
+        self.inflight += 1
+        self._sessions[session] = self._sessions.get(session, 0) + 1
+        self.admitted += 1
+        self._waits.append(waited)
+        return Ticket(self, session)
+
+    def _enter(self, session):
+        """立即准入时返回 Ticket，否则排队并返回 _Waiter；队列已满时拒绝"""
+        if not self._queue and self._has_room(session):
+            return self._admit(session, 0.0)
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"Too many {self.name} requests in progress", self._retry_after())
+        waiter = _Waiter(session)
+        self._queue.append(waiter)
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        return waiter
+
+    def _poll(self, waiter):
+        """轮到时准入并返回 Ticket；超时则出队并拒绝；否则返回 None"""
+        now = time.monotonic()
+        if self._is_next(waiter):
+            self._queue.remove(waiter)
+            self._cond.notify_all()
+            return self._admit(waiter.session, now - waiter.enqueued)
+        if now - waiter.enqueued >= self.max_wait:
+            self._queue.remove(waiter)
+            self._cond.notify_all()
+            self.timeouts += 1
+            self.rejected += 1
+            raise AdmissionRejected(f"Timed out waiting for a {self.name} slot", self._retry_after())
+        return None
+
+    def _retry_after(self):
+        return min(self._hold_time, 60.0)
+
+    # --- 获取/归还 ---
+
+    def acquire(self, session):
+        with self._cond:
+            entry = self._enter(session)
+            if isinstance(entry, Ticket):
+                return entry
+            while True:
+                ticket = self._poll(entry)
+                if ticket is not None:
+                    return ticket
+                self._cond.wait(max(0.0, self.max_wait - (time.monotonic() - entry.enqueued)))
+
+    async def acquire_async(self, session):
+        # asyncio 只在 ASGI 模式下需要，不在导入时加载
+        import asyncio
+        with self._cond:
+            entry = self._enter(session)
+        if isinstance(entry, Ticket):
+            return entry
+        try:
+            while True:
+                with self._cond:
+                    ticket = self._poll(entry)
+                if ticket is not None:
+                    return ticket
+                await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            with self._cond:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    self._cond.notify_all()
+            raise
+
+    def _release(self, ticket):
+        with self._cond:
+            self.inflight -= 1
+            count = self._sessions.get(ticket.session, 0) - 1
+            if count > 0:
+                self._sessions[ticket.session] = count
+            else:
+                self._sessions.pop(ticket.session, None)
+            held = time.monotonic() - ticket.admitted_at
+            self._hold_time = self._hold_time * 0.9 + held * 0.1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "inflight": self.inflight,
+                "max_inflight": self.max_inflight,
+                "per_session": self.per_session,
+                "sessions": len(self._sessions),
+                "queue_depth": len(self._queue),
+                "max_queue": self.max_queue,
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "wait_ms_avg": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+            }
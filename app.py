@@ -1,74 +1,175 @@
 import os
 import time
 import json
-import glob
 import uuid
 import base64
-import shutil
-import requests
-from flask import Flask, request, jsonify, send_from_directory, session, Response, stream_with_context
+import hashlib
+import hmac
+import re
+import threading
+import logging
+from collections import Counter, OrderedDict
+from flask import Blueprint, Flask, request, jsonify, send_from_directory, session, Response, stream_with_context, g
 from dotenv import load_dotenv
-from PIL import Image
-import pillow_heif
-
-# 注册 HEIF 格式支持，使 Pillow 能够打开 HEIC/HEIF 图片
-pillow_heif.register_heif_opener()
 
+# 先加载 .env，下面的模块在导入时读取各自的配置
 load_dotenv()
 
-app = Flask(__name__, static_folder='static')
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "complex_fixed_secret_key_for_persistence")
-app.config['PERMANENT_SESSION_LIFETIME'] = 3600 * 24 * 30 
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 最大上传 50MB
-
-# --- Configuration ---
-SITE_PASSWORD = os.getenv("SITE_PASSWORD", "lwtlwt123")
-
-# OpenAI Config
-OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-
-# Gemini Config
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-GEMINI_NATIVE_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent"
-
-# Model Parameters
-DEFAULT_SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "You are a helpful and friendly family AI assistant.")
-try:
-    MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "8192"))
-except:
-    MAX_OUTPUT_TOKENS = 8192
-
-try:
-    TEMPERATURE = float(os.getenv("TEMPERATURE", "1.0"))
-except:
-    TEMPERATURE = 1.0
-
-IMAGE_CACHE_DIR = "logs/cache_images"
-if not os.path.exists(IMAGE_CACHE_DIR):
-    os.makedirs(IMAGE_CACHE_DIR)
+import log
+log.configure()
+logger = logging.getLogger(__name__)
+
+import upstream
+import metrics
+import image_pipeline
+import history_window
+from sse import SSEDecoder, SSERelay, ChunkEncoder, iter_events, loads
+from image_store import ImageIndex
+from security_store import SecurityStore
+from request_body import InlineImage, StreamingJSONBody
+from stream_buffer import StreamRegistry
+from conversation_store import ConversationStore, ConversationConflict
+from context_cache import ContextCache
+from admission import AdmissionGovernor, AdmissionRejected
+from static_assets import StaticAssets, IMMUTABLE_CACHE_CONTROL
+from title_cache import TitleCache
+from generation_cache import GenerationCache, generation_key
+from upstream_router import UpstreamRouter, NoBackendAvailable, FAILOVER_STATUS
+from image_jobs import ImageJobQueue, JobError, QueueFull, TERMINAL_STATUSES
+from config import Config
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# 由 create_app() 设置；下面的服务也在 create_app() 中创建
+config = None
+
+
+class LazyService:
+    """首次使用时才创建的服务
+
+    SQLite 建表、静态资源预压缩、线程池等推迟到第一个用到该服务的请求，只转发聊天流的 worker
+    不承担这些开销。每个进程只创建一次；属性的读取与赋值都转发给实际的服务对象。
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                instance = self._instance
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._resolve(), name, value)
+
+
+def init_services():
+    """按当前 config 创建进程内的服务；较重的服务包装为 LazyService"""
+    global upstream_router, encoded_cache, image_index, image_jobs, generation_cache, stream_registry
+    global conversation_store, context_cache, chat_admission, image_admission, title_cache, security_store
+    global static_assets
+
+    upstream_router = UpstreamRouter(config.model_routes, "openai", cooldown=config.upstream_cooldown)
+    upstream_router.add_provider("gemini", config.gemini_api_keys, config.gemini_max_inflight)
+    upstream_router.add_provider("openai", config.openai_api_keys, config.openai_max_inflight)
+
+    encoded_cache = EncodedDataCache(config.encoded_cache_max_bytes)
+
+    image_index = LazyService(lambda: ImageIndex(
+        config.image_cache_dir, config.image_index_db, config.image_cache_max_bytes))
+
+    image_jobs = LazyService(lambda: ImageJobQueue(
+        config.image_jobs_db,
+        config.image_gen_concurrency,
+        default_concurrency=config.image_gen_default_concurrency,
+        max_queue=config.image_gen_max_queue,
+    ))
+
+    generation_cache = LazyService(lambda: GenerationCache(
+        config.generation_cache_db, ttl=config.image_result_cache_ttl, max_entries=config.image_result_cache_size,
+    )) if config.image_result_cache else None
+
+    stream_registry = StreamRegistry(
+        config.stream_buffer_max_bytes, config.stream_buffer_ttl, config.sse_flush_interval, config.sse_flush_bytes,
+        max_streams=config.stream_buffer_max_streams)
+
+    conversation_store = LazyService(lambda: ConversationStore(config.conversations_db))
+
+    context_cache = LazyService(lambda: ContextCache(
+        config.context_cache_db,
+        make_body=lambda payload: make_request_body(payload),
+        ttl=config.context_cache_ttl,
+        min_tokens=config.context_cache_min_tokens,
+        step=config.context_cache_step,
+    )) if config.context_cache else None
+
+    chat_admission = AdmissionGovernor(
+        "chat", config.chat_max_inflight, config.chat_max_per_session,
+        max_queue=config.chat_max_queue, max_wait=config.admission_max_wait)
+    # 图片任务本身在 image_jobs 中排队，这里只限制每个会话同时进行的任务数，超出时直接拒绝
+    image_admission = AdmissionGovernor(
+        "image generation", config.image_max_inflight, config.image_max_per_session, max_queue=0)
+
+    title_cache = LazyService(lambda: TitleCache(
+        lambda message: request_title(message),
+        max_entries=config.title_cache_size,
+        ttl=config.title_cache_ttl,
+        max_inflight=config.title_max_inflight,
+        wait_timeout=config.title_wait_timeout,
+        fallback=config.title_fallback,
+    ))
+
+    security_store = LazyService(lambda: SecurityStore(
+        config.security_db, config.security_file, config.login_attempt_window))
+
+    # 页面资源：带指纹的 URL 长期缓存，index.html 每次验证
+    static_assets = LazyService(lambda: StaticAssets(
+        {"": os.path.join(ROOT_PATH, 'static'), "/assets": os.path.join(ROOT_PATH, 'assets')},
+        index=("", "index.html"),
+    ))
+
+
+image_submit_lock = threading.Lock()
+
+bp = Blueprint("main", __name__)
+
+def create_app(app_config=None):
+    """创建 Flask 应用；app_config 默认从环境变量读取
+
+    服务是进程级的全局对象，每个进程只应创建一个应用。
+    """
+    global config
+    config = app_config or Config.from_env()
+    # 目录在这里创建一次；SQLite 建表等在服务首次使用时进行
+    os.makedirs(config.image_cache_dir, exist_ok=True)
+    for path in (config.image_index_db, config.image_jobs_db, config.generation_cache_db,
+                 config.conversations_db, config.context_cache_db, config.security_db):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    upstream.configure(config)
+    image_pipeline.configure(config)
+    history_window.configure(config)
+    init_services()
+
+    app = Flask(__name__, static_folder='static')
+    app.secret_key = config.secret_key
+    app.config['PERMANENT_SESSION_LIFETIME'] = config.session_lifetime
+    app.config['MAX_CONTENT_LENGTH'] = config.max_content_length
+    app.register_blueprint(bp)
+    return app
 
 # --- Security & Blacklist System ---
-SECURITY_FILE = "logs/security.json"
-MAX_LOGIN_ATTEMPTS = 3
-
-def load_security_data():
-    """加载安全数据"""
-    if not os.path.exists(SECURITY_FILE):
-        return {"blacklist": [], "attempts": {}}
-    try:
-        with open(SECURITY_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {"blacklist": [], "attempts": {}}
-
-def save_security_data(data):
-    """保存安全数据"""
-    try:
-        with open(SECURITY_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        print(f"Failed to save security data: {e}")
 
 def get_client_ip():
     """获取客户端真实IP"""
@@ -76,144 +177,219 @@ def get_client_ip():
         return request.headers.getlist("X-Forwarded-For")[0]
     return request.remote_addr
 
-def cleanup_old_images():
-    """清理旧图片/签名，保留最新的500张"""
-    try:
-        # 获取所有图片文件及其创建时间
-        files = glob.glob(os.path.join(IMAGE_CACHE_DIR, "*"))
-        if len(files) <= 1000:
-            return
-
-        # 按时间排序 (旧 -> 新)
-        files.sort(key=os.path.getctime)
-        
-        # 删除旧的，只留最新的500张
-        files_to_delete = files[:len(files) - 500]
-        for f in files_to_delete:
-            try:
-                os.remove(f)
-            except Exception as e:
-                print(f"Error deleting old image {f}: {e}")
-    except Exception as e:
-        print(f"Cleanup failed: {e}")
+def admission_session():
+    """准入控制按会话计数：使用登录时签发并保存在签名 session 中的 id（客户端无法更换），没有时按 IP"""
+    sid = session.get('sid')
+    return f"sid:{sid}" if sid else f"ip:{get_client_ip()}"
+
+def admission_rejected(e):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+def save_content_addressed(data, ext):
+    """按内容哈希保存到缓存目录并登记，相同内容只保存一份，返回文件名"""
+    filename = f"{hashlib.sha256(data).hexdigest()[:32]}{ext}"
+    filepath = os.path.join(config.image_cache_dir, filename)
+    if not os.path.exists(filepath):
+        # 先写临时文件再替换，避免并发读取到半个文件
+        temp_filepath = os.path.join(config.image_cache_dir, f"temp_{uuid.uuid4()}{ext}")
+        with open(temp_filepath, "wb") as f:
+            f.write(data)
+        os.replace(temp_filepath, filepath)
+    image_index.register(filename)
+    return filename
 
+def save_derivative(filename, profile, data):
+    """保存发送给模型用的派生图，与原图同一 stem"""
+    derivative = image_pipeline.derivative_name(filename, profile)
+    filepath = os.path.join(config.image_cache_dir, derivative)
+    if not os.path.exists(filepath):
+        temp_filepath = os.path.join(config.image_cache_dir, f"temp_{uuid.uuid4()}.jpg")
+        with open(temp_filepath, "wb") as f:
+            f.write(data)
+        os.replace(temp_filepath, filepath)
+        image_index.register(derivative, refs=0)
 
 def process_and_save_image(file):
-    """保存图片，检查大小并Resize，自动转换 HEIC/HEIF 格式为 JPEG"""
-    cleanup_old_images() # 每次上传前检查是否需要清理
+    """保存图片，检查大小并Resize，自动转换 HEIC/HEIF 格式为 JPEG
 
+    直接从上传流读取字节，解码/缩放/编码交给 image_pipeline 的进程池；
+    队列已满时抛出 image_pipeline.PipelineBusy。
+    相同的上传内容直接返回已处理好的文件，不再重复处理。
+    """
     original_ext = os.path.splitext(file.filename)[1].lower()
-    print(f"[Upload] Received file: {file.filename}, extension: {original_ext}")
-    
-    # 检查是否是 HEIC/HEIF 格式（iPhone 默认图片格式）
-    is_heic = original_ext in ['.heic', '.heif']
-    
-    # 确定最终保存的扩展名
-    if is_heic:
-        # HEIC/HEIF 转换为 JPEG
-        ext = '.jpg'
-        print(f"[Upload] Detected HEIC/HEIF format, will convert to JPEG")
-    elif original_ext in ['.jpg', '.jpeg', '.png', '.webp', '.gif']:
-        ext = original_ext
-    else:
-        # 未知格式也尝试转换为 JPEG
-        ext = '.jpg'
-        print(f"[Upload] Unknown format '{original_ext}', will attempt to convert to JPEG")
-    
-    filename = f"{uuid.uuid4()}{ext}"
-    filepath = os.path.join(IMAGE_CACHE_DIR, filename)
+    data = file.read()
 
-    # 先保存原始文件到临时路径以便处理
-    temp_filepath = os.path.join(IMAGE_CACHE_DIR, f"temp_{uuid.uuid4()}{original_ext}")
-    file.save(temp_filepath)
-    print(f"[Upload] Saved temp file: {temp_filepath}, size: {os.path.getsize(temp_filepath)} bytes")
+    src_hash = hashlib.sha256(data).hexdigest()
+    existing = image_index.lookup_upload(src_hash)
+    if existing:
+        logger.info("Duplicate upload, reusing processed image", extra={"upload": file.filename, "file": existing})
+        return existing
 
     try:
-        with Image.open(temp_filepath) as img:
-            print(f"[Upload] Opened image successfully, mode: {img.mode}, size: {img.size}")
-            
-            # 检查条件
-            file_size = os.path.getsize(temp_filepath)
-            width, height = img.size
-            num_pixels = width * height
-
-            # 对于 HEIC/HEIF、未知格式或大图片进行处理
-            needs_resize = file_size > 5 * 1024 * 1024 or num_pixels > 1e7
-            needs_conversion = is_heic or (original_ext not in ['.jpg', '.jpeg', '.png', '.webp', '.gif'])
-            
-            if needs_conversion or needs_resize:
-                # 如果需要 resize
-                if needs_resize:
-                    img.thumbnail((1920, 1920))
-                    print(f"[Upload] Resized large image to: {img.size}")
-                
-                # 转换颜色模式（HEIC 可能有 RGBA 或其他模式）
-                if img.mode not in ("RGB",):
-                    print(f"[Upload] Converting color mode from {img.mode} to RGB")
-                    img = img.convert("RGB")
-                
-                # 保存为 JPEG
-                img.save(filepath, "JPEG", quality=85)
-                print(f"[Upload] Saved converted image: {filepath}")
-            else:
-                # 不需要转换，直接移动文件
-                shutil.move(temp_filepath, filepath)
-                temp_filepath = None  # 标记已经移动，不需要删除
-                print(f"[Upload] Moved file directly: {filepath}")
-                
+        with metrics.stage("pipeline"):
+            ext, output, derivatives, info = image_pipeline.submit(image_pipeline.convert_upload, data, original_ext)
+    except image_pipeline.PipelineBusy:
+        raise
     except Exception as e:
-        print(f"[Upload] Image processing error: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # 如果处理失败，抛出异常让调用方知道
-        if temp_filepath and os.path.exists(temp_filepath):
-            try:
-                os.remove(temp_filepath)
-            except:
-                pass
+        logger.warning("Image processing failed", extra={"upload": file.filename, "error": str(e)})
         raise Exception(f"Failed to process image: {str(e)}")
-        
-    finally:
-        # 清理临时文件
-        if temp_filepath and os.path.exists(temp_filepath):
-            try:
-                os.remove(temp_filepath)
-                print(f"[Upload] Cleaned up temp file: {temp_filepath}")
-            except:
-                pass
-
+    # 工作进程中测得的各阶段耗时
+    for stage, seconds in info["timings"].items():
+        metrics.IMAGE_STAGE.observe(seconds, stage=stage)
+        metrics.record(stage, seconds)
+
+    with metrics.stage("save"):
+        filename = save_content_addressed(output if output is not None else data, ext)
+        for profile, derivative in derivatives.items():
+            save_derivative(filename, profile, derivative)
+        image_index.add_upload_alias(src_hash, filename)
+    logger.info("Saved uploaded image", extra={
+        "upload": file.filename, "file": filename, "bytes": len(data), "size": "x".join(map(str, info["size"])),
+        "mode": info["mode"], "converted": info["converted"], "resized": info["resized"],
+        "derivatives": ",".join(derivatives)})
     return filename
 
 def encode_image_from_path(image_path):
     """读取本地图片并转换为Base64，供LLM API调用"""
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        with metrics.stage("base64", metrics.IMAGE_BASE64):
+            with open(image_path, "rb") as image_file:
+                return base64.b64encode(image_file.read()).decode('utf-8')
     except:
         return None
 
-# --- Routes ---
+class EncodedDataCache:
+    """进程内 LRU 缓存：按文件名 + mtime 缓存 Base64 图片，按总字节数淘汰"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # path -> (mtime_ns, value)
+        self._lock = threading.Lock()
 
-@app.route('/')
+    def get(self, path, loader):
+        """命中则直接返回；否则调用 loader(path) 读取并放入缓存"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = loader(path)
+        if value is None:
+            return None
+
+        size = len(value)
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.total_bytes -= len(old[1])
+            if size <= self.max_bytes:
+                self._entries[path] = (mtime, value)
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self.total_bytes -= len(evicted)
+                    self.evictions += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+# --- Metrics ---
+
+metrics.Gauge("admission_inflight", "Admitted requests in progress", lambda: {
+    ("chat",): chat_admission.inflight, ("image",): image_admission.inflight}, ("endpoint",))
+metrics.Gauge("admission_queue_depth", "Requests waiting for admission", lambda: {
+    ("chat",): len(chat_admission._queue), ("image",): len(image_admission._queue)}, ("endpoint",))
+metrics.Gauge("upstream_inflight", "In-flight requests per upstream backend", lambda: {
+    (b["name"],): b["inflight"] for backends in upstream_router.stats().values() for b in backends}, ("backend",))
+metrics.Gauge("chat_streams_active", "Chat streams still generating", lambda: {
+    (): stream_registry.stats()["active"]})
+
+@bp.before_app_request
+def start_request_timing():
+    g.started = time.perf_counter()
+    g.timings = metrics.begin_request()
+
+@bp.after_app_request
+def add_server_timing(response):
+    started = getattr(g, "started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    g.timings.append(("total", elapsed))
+    response.headers["Server-Timing"] = metrics.server_timing(g.timings)
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.REQUEST_DURATION.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的指标；需要 METRICS_TOKEN 令牌或已登录的会话
+
+    不按来源地址放行：部署在同一主机的反向代理后面时，所有请求都来自本机。
+    """
+    authorization = request.headers.get("Authorization", "")
+    token_ok = bool(config.metrics_token) and hmac.compare_digest(
+        authorization.encode("utf-8"), f"Bearer {config.metrics_token}".encode("utf-8"))
+    if not token_ok and not check_session():
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def send_static_asset(prefix, directory, path):
+    asset, fingerprinted = static_assets.lookup(prefix, path)
+    if asset is None:
+        return send_from_directory(directory, path)
+    return static_assets.response(asset, request, immutable=fingerprinted)
+
+def send_index():
+    response = static_assets.index_response(request)
+    if response is None:
+        # 页面不存在（例如前端尚未构建）：交给 send_from_directory 返回 404
+        return send_from_directory('static', 'index.html')
+    return response
+
+@bp.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    return send_index()
 
-@app.route('/assets/<path:filename>')
+@bp.route('/assets/<path:filename>')
 def serve_assets(filename):
     """提供assets目录的静态文件访问（如logo）"""
-    return send_from_directory('assets', filename)
+    return send_static_asset("/assets", 'assets', filename)
 
-@app.route('/<path:path>')
+@bp.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('static', path)
+    if path == 'index.html':
+        return send_index()
+    return send_static_asset("", 'static', path)
 
-@app.route('/api/auth/login', methods=['POST'])
+@bp.route('/api/auth/login', methods=['POST'])
 def login():
     client_ip = get_client_ip()
-    security_data = load_security_data()
     
-    if client_ip in security_data.get("blacklist", []):
+    if security_store.is_banned(client_ip):
         time.sleep(1) 
         return jsonify({"success": False, "error": "Access denied. IP banned."}), 403
 
@@ -225,28 +401,20 @@ def login():
     if len(password) > 100:
         return jsonify({"success": False, "error": "Input too long"}), 400
 
-    if password == SITE_PASSWORD:
-        if client_ip in security_data["attempts"]:
-            del security_data["attempts"][client_ip]
-            save_security_data(security_data)
+    if password == config.site_password:
+        security_store.reset_attempts(client_ip)
         session['authenticated'] = True
+        session['sid'] = uuid.uuid4().hex
         session.permanent = True
         return jsonify({"success": True})
     else:
-        attempts = security_data["attempts"].get(client_ip, 0) + 1
-        security_data["attempts"][client_ip] = attempts
-        if attempts >= MAX_LOGIN_ATTEMPTS:
-            if client_ip not in security_data["blacklist"]:
-                security_data["blacklist"].append(client_ip)
-            if client_ip in security_data["attempts"]:
-                del security_data["attempts"][client_ip]
-            save_security_data(security_data)
+        _, banned = security_store.record_failure(client_ip, config.max_login_attempts)
+        if banned:
             return jsonify({"success": False, "error": "Too many failed attempts. Banned."}), 403
         else:
-            save_security_data(security_data)
             return jsonify({"success": False, "error": f"Incorrect password."}), 401
 
-@app.route('/api/auth/check', methods=['GET'])
+@bp.route('/api/auth/check', methods=['GET'])
 def check_auth():
     return jsonify({"authenticated": session.get('authenticated', False)})
 
@@ -255,12 +423,49 @@ def check_session():
         return False
     return True
 
-@app.route('/images/cache/<path:filename>')
+@bp.route('/images/cache/<path:filename>')
 def serve_cached_image(filename):
     """提供图片访问"""
-    return send_from_directory(IMAGE_CACHE_DIR, filename)
+    image_index.touch(filename)
+    if filename.endswith('.sig'):
+        # 签名保存在图片索引中，兼容按文件访问的旧 URL
+        signature = image_index.signature(filename)
+        if signature is None:
+            return jsonify({"error": "Not found"}), 404
+        return Response(signature, mimetype='text/plain')
+    # 文件名即内容哈希，内容不会变化：用文件名作强 ETag 并允许长期缓存
+    resp = send_from_directory(os.path.abspath(config.image_cache_dir), filename, etag=filename)
+    resp.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return resp
+
+@bp.route('/api/stats/upstreams', methods=['GET'])
+def upstream_stats():
+    """查看各上游 key 的并发、冷却与失败次数"""
+    if not check_session():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(upstream_router.stats())
 
-@app.route('/api/upload', methods=['POST'])
+@bp.route('/api/stats/admission', methods=['GET'])
+def admission_stats():
+    """查看聊天与图片生成的并发、排队深度与等待时间"""
+    if not check_session():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"chat": chat_admission.stats(), "image": image_admission.stats()})
+
+@bp.route('/api/stats/cache', methods=['GET'])
+def cache_stats():
+    """查看已编码图片缓存、磁盘图片缓存与上下文缓存的情况"""
+    if not check_session():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({
+        "encoded": encoded_cache.stats(),
+        "disk": image_index.stats(),
+        "context": context_cache.stats() if context_cache is not None else None,
+        "title": title_cache.stats(),
+        "image_results": generation_cache.stats() if generation_cache is not None else None,
+    })
+
+@bp.route('/api/upload', methods=['POST'])
 def upload_image():
     """处理图片上传"""
     if not session.get('authenticated'):
@@ -278,13 +483,43 @@ def upload_image():
         # 返回相对URL
         url = f"/images/cache/{filename}"
         return jsonify({"url": url})
+    except image_pipeline.PipelineBusy as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "2"}
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 # --- Chat Logic (Modified for Local Image Handling) ---
 
-def process_messages_for_llm(messages):
+def resolve_image_for_llm(filename, profile=None):
+    """返回发送给模型的本地文件 (路径, mime_type)；指定 profile 且存在派生图时优先使用派生图"""
+    if profile:
+        derivative_path = os.path.join(config.image_cache_dir, image_pipeline.derivative_name(filename, profile))
+        if os.path.exists(derivative_path):
+            return derivative_path, "image/jpeg"
+
+    mime_type = "image/jpeg"
+    if filename.endswith('.png'): mime_type = "image/png"
+    elif filename.endswith('.webp'): mime_type = "image/webp"
+    return os.path.join(config.image_cache_dir, filename), mime_type
+
+def cached_image_b64(path):
+    return encoded_cache.get(path, encode_image_from_path)
+
+def make_request_body(payload):
+    """流式 JSON 请求体：图片以 InlineImage 占位，发送时才分块编码"""
+    return StreamingJSONBody(payload, cached_image_b64, config.encoded_cache_max_item)
+
+def llm_image_profile(model):
+    """目标模型对应的派生图规格"""
+    return "gemini" if is_gemini_model(model) else "openai"
+
+def process_messages_for_llm(messages, profile=None, stream_images=False):
+    """将本地图片/签名 URL 替换为实际内容
+
+    stream_images=True 时图片替换为 InlineImage 占位符，配合 make_request_body 在发送时编码，
+    避免整份 Base64 常驻内存。
+    """
     processed_messages = []
     for msg in messages:
         new_msg = msg.copy()
@@ -299,18 +534,25 @@ def process_messages_for_llm(messages):
                     
                     if url.startswith('/images/cache/'):
                         filename = url.split('/')[-1]
-                        local_path = os.path.join(IMAGE_CACHE_DIR, filename)
-                        base64_str = encode_image_from_path(local_path)
+                        local_path, mime_type = resolve_image_for_llm(filename, profile)
+                        image_index.touch(filename)
+
+                        image_value = None
+                        if stream_images:
+                            try:
+                                image_value = InlineImage.data_url(local_path, mime_type)
+                            except OSError:
+                                pass
+                        else:
+                            base64_str = cached_image_b64(local_path)
+                            if base64_str:
+                                image_value = f"data:{mime_type};base64,{base64_str}"
                         
-                        if base64_str:
-                            mime_type = "image/jpeg"
-                            if filename.endswith('.png'): mime_type = "image/png"
-                            elif filename.endswith('.webp'): mime_type = "image/webp"
-                            
+                        if image_value:
                             new_content.append({
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:{mime_type};base64,{base64_str}" 
+                                    "url": image_value
                                 }
                             })
                         else:
@@ -323,10 +565,10 @@ def process_messages_for_llm(messages):
                 if 'thoughtSignature' in item:
                     if item.get('thoughtSignature').startswith('/images/cache/'):
                         filename = item.get('thoughtSignature').split('/')[-1]
-                        local_path = os.path.join(IMAGE_CACHE_DIR, filename)
-                        with open(local_path, 'r') as f:
-                            base64_str = f.read()
-                        new_content[-1]['thoughtSignature'] = base64_str
+                        signature = image_index.signature(filename)
+                        if signature is None:
+                            raise Exception("Invalid signature URL")
+                        new_content[-1]['thoughtSignature'] = signature
                     else:
                         raise Exception("Invalid signature URL")
 
@@ -356,7 +598,14 @@ def convert_openai_to_gemini(messages):
                     image_url_obj = item.get("image_url", {})
                     image_url = image_url_obj.get("url", "")
 
-                    if image_url.startswith("data:"):
+                    if isinstance(image_url, InlineImage):
+                        parts.append({
+                            "inlineData": {
+                                "mimeType": image_url.mime_type,
+                                "data": image_url.without_prefix()
+                            }
+                        })
+                    elif image_url.startswith("data:"):
                         try:
                             header, base64_data = image_url.split(",", 1)
                             mime_type = header.split(":")[1].split(";")[0]
@@ -377,70 +626,162 @@ def convert_openai_to_gemini(messages):
             gemini_contents.append({"role": gemini_role, "parts": parts})
     return gemini_contents
 
-def stream_gemini_native(model_name, messages):
-    target_url = GEMINI_NATIVE_URL.format(model=model_name) + f"?key={GEMINI_API_KEY}"
+def routed_post(backend, url, **kwargs):
+    """向路由选中的 backend 发送请求；有多个 key 时 429/503 不在原地重试，由路由换 key"""
+    retry_status = len(upstream_router.backends[backend.provider]) == 1
+    return upstream.post(url, retry_status=retry_status, **kwargs)
+
+def build_gemini_stream_request(model_name, messages, backend, use_cache=True):
+    """构造发往 backend 的 Gemini 流式请求 (url, payload, headers, cache_key)，同步/异步模式共用
+
+    开启上下文缓存时，稳定的前缀换成缓存引用，cache_key 非空；上游因缓存失效拒绝请求时，
+    调用方 invalidate(cache_key) 后以 use_cache=False 重建完整请求。
+    """
+    # alt=sse 使响应按 SSE 事件逐块返回，便于增量解析
+    target_url = f"{backend.base_url}/models/{model_name}:streamGenerateContent?alt=sse&key={backend.api_key}"
     headers = {"Content-Type": "application/json"}
     contents = convert_openai_to_gemini(messages)
+    system_instruction = {"parts": [{"text": config.system_prompt}]}
     
     payload = {
         "contents": contents,
-        "system_instruction": {"parts": [{"text": DEFAULT_SYSTEM_PROMPT}]},
+        "system_instruction": system_instruction,
         "generationConfig": {
-            "temperature": TEMPERATURE,
-            "maxOutputTokens": MAX_OUTPUT_TOKENS,
+            "temperature": config.temperature,
+            "maxOutputTokens": config.max_output_tokens,
         }
     }
 
+    cache_key = None
+    if use_cache and context_cache is not None:
+        cached = context_cache.get(model_name, system_instruction, contents, backend.base_url, backend.api_key)
+        if cached:
+            name, prefix_length, cache_key = cached
+            # 系统提示词已包含在缓存内容中
+            del payload["system_instruction"]
+            payload["contents"] = contents[prefix_length:]
+            payload["cachedContent"] = name
+    return target_url, payload, headers, cache_key
+
+class GeminiStreamDecoder:
+    """增量解析 Gemini alt=sse 流，每个响应块只解析一次，整体为线性时间"""
+
+    def __init__(self):
+        self._sse = SSEDecoder()
+
+    def _decode(self, events):
+        chunks = []
+        for event in events:
+            try:
+                chunks.append(loads(event))
+            except ValueError as e:
+                logger.warning("Gemini parse error", extra={"error": str(e)})
+        return chunks
+
+    def feed(self, data):
+        return self._decode(self._sse.feed(data))
+
+    def flush(self):
+        return self._decode(self._sse.flush())
+
+# Gemini finishReason -> OpenAI finish_reason
+GEMINI_FINISH_REASONS = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content_filter",
+    "RECITATION": "content_filter",
+    "PROHIBITED_CONTENT": "content_filter",
+    "BLOCKLIST": "content_filter",
+    "SPII": "content_filter",
+}
+
+def gemini_chunk_delta(chunk_json):
+    """将 Gemini 响应块转换为 OpenAI 格式的 (delta, finish_reason, usage)，无内容时返回 None"""
+    candidates = chunk_json.get('candidates') or []
+    candidate = candidates[0] if candidates else {}
+
+    delta = {}
+    text_chunk = ""
+    for part in candidate.get('content', {}).get('parts', []):
+        if 'text' in part: text_chunk += part['text']
+        if 'thoughtSignature' in part: delta['thoughtSignature'] = part['thoughtSignature']
+    if text_chunk:
+        delta['content'] = text_chunk
+
+    finish_reason = candidate.get('finishReason')
+    if finish_reason:
+        finish_reason = GEMINI_FINISH_REASONS.get(finish_reason, finish_reason.lower())
+    if not delta and not finish_reason:
+        return None
+
+    usage = chunk_json.get('usageMetadata')
+    if finish_reason and usage:
+        usage = {
+            "prompt_tokens": usage.get('promptTokenCount', 0),
+            "completion_tokens": usage.get('candidatesTokenCount', 0) + usage.get('thoughtsTokenCount', 0),
+            "total_tokens": usage.get('totalTokenCount', 0),
+            "prompt_tokens_details": {"cached_tokens": usage.get('cachedContentTokenCount', 0)},
+        }
+    else:
+        usage = None
+    return delta, finish_reason, usage
+
+def gemini_relay(model_name):
+    return SSERelay(ChunkEncoder("chatcmpl-gemini", model_name))
+
+def relay_gemini_chunks(relay, chunks):
+    """把一次上游读取解析出的 Gemini 响应块交给 relay，返回合并后的 SSE 事件"""
+    for chunk_json in chunks:
+        converted = gemini_chunk_delta(chunk_json)
+        if converted:
+            relay.add(*converted)
+    return relay.drain()
+
+def post_gemini_stream(model_name, messages):
+    """经上游路由发送流式请求，返回 Lease
+
+    使用了上下文缓存而被拒绝时（缓存过期/被删除），在同一 backend 上去掉缓存重发一次；
+    限流与服务端错误由路由换 key 重试。
+    """
+    def send(backend):
+        target_url, payload, headers, cache_key = build_gemini_stream_request(model_name, messages, backend)
+        resp = routed_post(backend, target_url, data=make_request_body(payload), headers=headers, stream=True)
+        if resp.status_code != 200 and resp.status_code not in FAILOVER_STATUS and cache_key:
+            logger.info("Gemini rejected cached content, retrying without cache",
+                        extra={"model": model_name, "status": resp.status_code})
+            resp.close()
+            context_cache.invalidate(cache_key)
+            target_url, payload, headers, _ = build_gemini_stream_request(
+                model_name, messages, backend, use_cache=False)
+            resp = routed_post(backend, target_url, data=make_request_body(payload), headers=headers, stream=True)
+        return resp
+
+    with metrics.stage("upstream", metrics.UPSTREAM_CONNECT, provider="gemini", model=model_name):
+        return upstream_router.send("gemini", send)
+
+def stream_gemini_native(model_name, messages, relay=None, lease=None):
+    """转换为 OpenAI 格式的 SSE 事件；lease 为调用方已发送的请求（路由失败已在返回响应前处理）"""
     try:
-        with requests.post(target_url, json=payload, headers=headers, stream=True) as resp:
+        with lease or post_gemini_stream(model_name, messages) as resp:
             if resp.status_code != 200:
                 error_msg = f"Gemini API Error ({resp.status_code}): {resp.text}"
-                print(error_msg)
+                metrics.UPSTREAM_ERRORS.inc(provider="gemini", status=resp.status_code)
+                logger.warning("Gemini API error", extra={"model": model_name, "status": resp.status_code})
                 yield f"data: {json.dumps({'error': error_msg})}\n\n"
                 return
 
-            buffer = ""
-            for line in resp.iter_lines():
-                if not line: continue
-                decoded_line = line.decode('utf-8').strip()
-                buffer += decoded_line
-
-                clean_buffer = buffer
-                if clean_buffer.startswith(','): clean_buffer = clean_buffer[1:]
-                if clean_buffer.startswith('['): clean_buffer = clean_buffer[1:]
-                if clean_buffer.endswith(','): clean_buffer = clean_buffer[:-1]
-                if clean_buffer.endswith(']'): clean_buffer = clean_buffer[:-1]
-                
-                try:
-                    chunk_json = json.loads(clean_buffer)
-                    buffer = "" 
-                    candidates = chunk_json.get('candidates', [])
-                    if candidates:
-                        parts = candidates[0].get('content', {}).get('parts', [])
-                        text_chunk = ""
-                        for part in parts:
-                            if 'text' in part: text_chunk += part['text']
-                        if text_chunk:
-                            openai_chunk = {
-                                "id": "chatcmpl-gemini",
-                                "object": "chat.completion.chunk",
-                                "created": int(time.time()),
-                                "model": model_name,
-                                "choices": [{"index": 0, "delta": {"content": text_chunk}, "finish_reason": None}]
-                            }
-                            yield f"data: {json.dumps(openai_chunk)}\n\n"
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    print(f"Gemini Parse Error: {e}")
-                    buffer = ""
+            decoder = GeminiStreamDecoder()
+            relay = relay or gemini_relay(model_name)
+            for data in resp.iter_content(chunk_size=None):
+                yield from relay_gemini_chunks(relay, decoder.feed(data))
+            yield from relay_gemini_chunks(relay, decoder.flush())
             yield "data: [DONE]\n\n"
     except Exception as e:
         yield f"data: {json.dumps({'error': str(e)})}\n\n"
 
-@app.route('/api/chat/generate-title', methods=['POST'])
+@bp.route('/api/chat/generate-title', methods=['POST'])
 def generate_title():
-    """基于用户首条消息生成对话标题"""
+    """基于用户首条消息生成对话标题（相同消息命中缓存；上游慢或失败时返回本地标题）"""
     if not check_session(): 
         return jsonify({"error": "Unauthorized"}), 401
     
@@ -453,7 +794,14 @@ def generate_title():
     # 限制消息长度以避免过长的请求
     if len(first_message) > 500:
         first_message = first_message[:500] + "..."
-    
+
+    with metrics.stage("title"):
+        title, source = title_cache.get(first_message)
+    metrics.TITLE_REQUESTS.inc(source=source)
+    return jsonify({"title": title, "source": source})
+
+def request_title(first_message):
+    """请求 Gemini 生成标题；失败时返回 None"""
     # 使用固定的 prompt 模板
     title_prompt = f"""Based on the following user message, generate a short and concise title in Chinese that summarizes the topic. 
 Only respond with the title itself, no quotes, no explanation, no punctuation at the end.
@@ -464,7 +812,6 @@ Title:"""
     
     # 使用 gemini-2.5-flash 模型
     model_name = "gemini-2.5-flash"
-    target_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
     headers = {"Content-Type": "application/json"}
     
     payload = {
@@ -475,16 +822,23 @@ Title:"""
         }
     }
     
+    def send(backend):
+        target_url = f"{backend.base_url}/models/{model_name}:generateContent?key={backend.api_key}"
+        return routed_post(backend, target_url, json=payload, headers=headers, read_timeout=10)
+
     try:
-        resp = requests.post(target_url, json=payload, headers=headers, timeout=10)
-        if resp.status_code != 200 or resp.json() == []:
-            print(f"Title generation error: {resp.text}")
-            return jsonify({"title": "New Chat"})
+        with metrics.UPSTREAM_CONNECT.time(provider="gemini", model=model_name):
+            lease = upstream_router.send("gemini", send)
+        with lease as resp:
+            if resp.status_code != 200 or resp.json() == []:
+                metrics.UPSTREAM_ERRORS.inc(provider="gemini", status=resp.status_code)
+                logger.warning("Title generation error", extra={"status": resp.status_code, "body": resp.text[:200]})
+                return None
+            resp_json = resp.json()
 
-        resp_json = resp.json()
         candidates = resp_json.get('candidates', [])
         if not candidates:
-            return jsonify({"title": "New Chat"})
+            return None
         
         parts = candidates[0].get('content', {}).get('parts', [])
         if parts and 'text' in parts[0]:
@@ -494,67 +848,437 @@ Title:"""
             # 限制长度
             if len(title) > 50:
                 title = title[:47] + "..."
-            return jsonify({"title": title if title else "New Chat"})
+            return title or None
         
-        return jsonify({"title": "New Chat"})
+        return None
     except Exception as e:
-        print(f"Title generation failed: {e}")
-        return jsonify({"title": "New Chat"})
+        logger.warning("Title generation failed", extra={"error": str(e)})
+        return None
 
 
-@app.route('/api/chat/completions', methods=['POST'])
-def chat_proxy():
+# --- Conversations ---
+
+# 对话与 client id 只允许简单字符，避免异常输入进入存储
+ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def conversation_owner():
+    """浏览器生成并保存在 localStorage 中的 client id，对话按它隔离"""
+    owner = request.headers.get('X-Client-Id', '')
+    return owner if ID_PATTERN.match(owner) else None
+
+def referenced_cache_files(messages):
+    """消息中引用的缓存文件名（图片与签名）"""
+    names = []
+    for msg in messages:
+        content = msg.get('content')
+        if not isinstance(content, list):
+            continue
+        for item in content:
+            url = item.get('image_url', {}).get('url', '') if item.get('type') == 'image_url' else ''
+            for ref in (url, item.get('thoughtSignature') or ''):
+                if ref.startswith('/images/cache/'):
+                    names.append(ref.split('/')[-1])
+    return names
+
+def release_conversation_images(messages, kept=()):
+    """释放被删除消息引用的图片；kept 为替换它们的新消息，其中仍引用的图片沿用原来的引用"""
+    names = Counter(referenced_cache_files(messages)) - Counter(referenced_cache_files(kept))
+    for name in names.elements():
+        image_index.release(name)
+
+@bp.route('/api/conversations', methods=['GET'])
+def list_conversations():
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    owner = conversation_owner()
+    if owner is None: return jsonify({"error": "Missing client id"}), 400
+
+    release_conversation_images(conversation_store.prune(config.conversation_retention))
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        before = float(request.args['before']) if 'before' in request.args else None
+    except ValueError:
+        return jsonify({"error": "Invalid paging parameters"}), 400
+    items, next_before = conversation_store.list(owner, limit, before)
+    return jsonify({"conversations": items, "next_before": next_before})
+
+@bp.route('/api/conversations/search', methods=['GET'])
+def search_conversations():
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    owner = conversation_owner()
+    if owner is None: return jsonify({"error": "Missing client id"}), 400
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"results": []})
+    results = conversation_store.search(owner, query)
+    return jsonify({"results": [{"conversation": conv, "text": text} for conv, text in results]})
+
+@bp.route('/api/conversations/<conversation_id>', methods=['PUT'])
+def update_conversation(conversation_id):
+    """创建对话或修改标题；导入旧的本地记录时带上原时间戳 (毫秒)"""
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    owner = conversation_owner()
+    if owner is None or not ID_PATTERN.match(conversation_id):
+        return jsonify({"error": "Invalid conversation id"}), 400
+
+    data = request.json or {}
+    title = data.get('title')
+    timestamp = data.get('timestamp')
+    conv = conversation_store.upsert(
+        owner, conversation_id,
+        title=str(title)[:100] if title else None,
+        timestamp=float(timestamp) / 1000 if isinstance(timestamp, (int, float)) else None,
+    )
+    return jsonify(conv)
+
+@bp.route('/api/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    owner = conversation_owner()
+    if owner is None: return jsonify({"error": "Missing client id"}), 400
+
+    messages = conversation_store.delete(owner, conversation_id)
+    if messages is None:
+        return jsonify({"error": "Conversation not found"}), 404
+    release_conversation_images(messages)
+    return jsonify({"success": True})
+
+@bp.route('/api/conversations/<conversation_id>/messages', methods=['GET'])
+def conversation_messages(conversation_id):
+    """分页读取消息：after 为上一页返回的 next_after"""
     if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    owner = conversation_owner()
+    if owner is None: return jsonify({"error": "Missing client id"}), 400
+
+    conv = conversation_store.get(owner, conversation_id)
+    if conv is None:
+        return jsonify({"error": "Conversation not found"}), 404
+    try:
+        after = int(request.args.get('after', -1))
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError:
+        return jsonify({"error": "Invalid paging parameters"}), 400
+    messages, next_after = conversation_store.messages(owner, conversation_id, after, limit)
+    return jsonify({"messages": messages, "next_after": next_after, "total": conv["message_count"]})
+
+@bp.route('/api/conversations/<conversation_id>/messages', methods=['POST'])
+def append_messages(conversation_id):
+    """提交增量：保留前 base_seq 条消息，其后替换为 messages"""
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    owner = conversation_owner()
+    if owner is None or not ID_PATTERN.match(conversation_id):
+        return jsonify({"error": "Invalid conversation id"}), 400
+
+    data = request.json or {}
+    messages = data.get('messages', [])
+    base_seq = data.get('base_seq')
+    if not isinstance(base_seq, int) or base_seq < 0 or not isinstance(messages, list) \
+            or not all(isinstance(m, dict) for m in messages):
+        return jsonify({"error": "Invalid request"}), 400
+    try:
+        total, removed = conversation_store.append(owner, conversation_id, base_seq, messages)
+    except ConversationConflict as e:
+        conv = conversation_store.get(owner, conversation_id)
+        return jsonify({"error": str(e), "total": conv["message_count"] if conv else 0}), 409
+    # 编辑/重新生成替换掉的消息
+    release_conversation_images(removed, messages)
+    return jsonify({"total": total})
+
+def load_chat_history(data, owner, model):
+    """按目标模型的 token 预算拼出历史，返回 (消息列表, HistoryWindow)
+
+    请求带 conversation_id 时，用服务端保存的前 base_seq 条消息加上本次的新消息；
+    否则使用请求中的完整 messages。服务端历史不足时抛出 ConversationConflict。
+    """
+    image_tokens = history_window.IMAGE_TOKENS[llm_image_profile(model)]
+    budget = history_window.model_budget(model)
+    conversation_id = data.get('conversation_id')
+    if not conversation_id:
+        messages = data.get('messages', [])
+        # 客户端自带的系统提示词总是保留，并从预算中扣除
+        system = [m for m in messages if m.get('role') == 'system']
+        messages = [m for m in messages if m.get('role') != 'system'][-config.max_history:]
+        if not system:
+            budget -= history_window.text_tokens(config.system_prompt)
+        budget -= sum(history_window.message_cost(m)[0] for m in system)
+        window = history_window.select(
+            [history_window.message_cost(m) for m in reversed(messages)], budget, image_tokens)
+        return system + window.apply(messages[len(messages) - window.kept:]), window
+
+    if owner is None:
+        raise ConversationConflict("Missing client id")
+    message = data.get('message')
+    base_seq = data.get('base_seq')
+    if not isinstance(base_seq, int) or base_seq < 0:
+        raise ConversationConflict("Invalid base_seq")
+
+    budget -= history_window.text_tokens(config.system_prompt)
+    # 先只读取估算列决定窗口，再读取窗口内的消息
+    costs = conversation_store.costs(owner, conversation_id, base_seq, config.max_history - 1 if message else config.max_history)
+    if message:
+        costs.insert(0, history_window.message_cost(message))
+    window = history_window.select(costs, budget, image_tokens)
+    stored = window.kept - 1 if message else window.kept
+    messages = conversation_store.load(owner, conversation_id, base_seq - stored, base_seq)
+    if message:
+        messages.append(message)
+    return window.apply(messages), window
+
+def prepare_chat_messages(raw_messages, model):
+    """将本地 URL 转换为 Base64 供 API 使用（使用目标模型对应的派生图）"""
+    return process_messages_for_llm(raw_messages, llm_image_profile(model), stream_images=True)
+
+def is_gemini_model(model):
+    return upstream_router.provider_for(model) == "gemini"
+
+def build_openai_stream_request(model, processed_messages, backend):
+    """构造发往 backend 的 OpenAI 流式请求 (url, payload, headers)，同步/异步模式共用"""
+    headers = {
+        "Authorization": f"Bearer {backend.api_key}",
+        "Content-Type": "application/json",
+        "User-Agent": "Mozilla/5.0 ..."
+    }
     
-    data = request.json
-    model = data.get('model', 'gpt-3.5-turbo')
-    raw_messages = data.get('messages', [])
+    has_system = any(m.get('role') == 'system' for m in processed_messages)
+    if not has_system: 
+        processed_messages.insert(0, {"role": "system", "content": config.system_prompt})
     
-    # 限制历史长度
-    MAX_HISTORY = 20
-    if len(raw_messages) > MAX_HISTORY: raw_messages = raw_messages[-MAX_HISTORY:]
+    payload = {
+        "model": model,
+        "messages": processed_messages, # 发送带 Base64 的消息
+        "stream": True
+    }
+    if config.openai_stream_usage:
+        # 最后一个事件附带用量统计，用于 token 计数指标
+        payload["stream_options"] = {"include_usage": True}
+    return f"{backend.base_url}/chat/completions", payload, headers
+
+def record_usage(model, usage):
+    if usage:
+        metrics.TOKENS.inc(usage.get("prompt_tokens") or 0, model=model, type="prompt")
+        metrics.TOKENS.inc(usage.get("completion_tokens") or 0, model=model, type="completion")
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        if cached:
+            metrics.TOKENS.inc(cached, model=model, type="cached")
+
+def metered_stream(events, model, started, relay):
+    """记录首个事件的延迟、整个流的时长、转发的字节数与 token 用量；started 为请求到达时间 (perf_counter)"""
+    relayed = 0
+    try:
+        for event in events:
+            if not relayed:
+                metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started, model=model)
+            relayed += len(event)
+            yield event
+    finally:
+        close = getattr(events, "close", None)
+        if close:
+            close()
+        metrics.STREAM_DURATION.observe(time.perf_counter() - started, model=model)
+        metrics.RELAYED_BYTES.inc(relayed, model=model)
+        record_usage(model, relay.usage)
+
+def replay_response(buffer, start=0, headers=None):
+    """从回放缓冲区输出 SSE；X-Stream-Id 供客户端断线后续传"""
+    return Response(
+        stream_with_context(buffer.iter_from(start)),
+        content_type='text/event-stream',
+        headers={"X-Stream-Id": buffer.id, "Cache-Control": "no-cache", **(headers or {})},
+    )
+
+@bp.route('/api/chat/streams/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    """断线续传：从 Last-Event-ID 之后继续输出"""
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    buffer = stream_registry.get(stream_id)
+    if buffer is None:
+        return jsonify({"error": "Stream not found or expired"}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        start = max(0, int(last_event_id) + 1) if last_event_id is not None else 0
+    except ValueError:
+        start = 0
+    return replay_response(buffer, start)
+
+@bp.route('/api/chat/streams/<stream_id>', methods=['DELETE'])
+def cancel_stream(stream_id):
+    """用户主动停止生成时取消上游请求"""
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"success": stream_registry.cancel(stream_id)})
+
+@bp.route('/api/chat/completions', methods=['POST'])
+def chat_proxy():
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        with metrics.stage("admission"):
+            ticket = chat_admission.acquire(admission_session())
+    except AdmissionRejected as e:
+        return admission_rejected(e)
+    try:
+        return proxy_chat(ticket)
+    finally:
+        # 流已交给后台线程时由其结束后归还名额
+        if not ticket.held:
+            ticket.release()
 
-    # 将本地 URL 转换为 Base64 供 API 使用
-    processed_messages = process_messages_for_llm(raw_messages)
+def proxy_chat(ticket):
+    data = request.json
+    model = data.get('model', 'gpt-3.5-turbo')
+    try:
+        with metrics.stage("history"):
+            raw_messages, window = load_chat_history(data, conversation_owner(), model)
+    except ConversationConflict as e:
+        return jsonify({"error": str(e)}), 409
+    with metrics.stage("prepare"):
+        processed_messages = prepare_chat_messages(raw_messages, model)
+    # 告知客户端历史被截取的情况
+    window_headers = {"X-History-Window": window.header()}
+    # 回放缓冲区已满（都是未结束的流）时在发送上游请求之前拒绝
+    if not stream_registry.has_capacity():
+        return jsonify({"error": "Too many active streams, please retry later"}), 503, {"Retry-After": "1"}
 
     # --- 1. Gemini 分支 ---
-    if "gemini" in model.lower():
-        # stream_gemini_native 内部会调用 convert_openai_to_gemini
-        return Response(stream_with_context(stream_gemini_native(model, processed_messages)), content_type='text/event-stream')
+    if is_gemini_model(model):
+        # 先发送请求：所有 key 都在限流时返回 429 与 Retry-After，而不是在 200 的流中报错
+        try:
+            lease = post_gemini_stream(model, processed_messages)
+        except NoBackendAvailable as e:
+            return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        relay = gemini_relay(model)
+        events = metered_stream(
+            stream_gemini_native(model, processed_messages, relay, lease), model, g.started, relay)
+        buffer = stream_registry.start(ticket.hold(events))
+        return replay_response(buffer, headers=window_headers)
     
     # --- 2. OpenAI 分支 ---
     else:
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0 ..."
-        }
-        
-        has_system = any(m.get('role') == 'system' for m in processed_messages)
-        if not has_system: 
-            processed_messages.insert(0, {"role": "system", "content": DEFAULT_SYSTEM_PROMPT})
-        
-        payload = {
-            "model": model,
-            "messages": processed_messages, # 发送带 Base64 的消息
-            "stream": True
-        }
+        def send(backend):
+            target_url, payload, headers = build_openai_stream_request(model, processed_messages, backend)
+            return routed_post(backend, target_url, data=make_request_body(payload), headers=headers, stream=True)
 
         try:
-            resp = requests.post(f"{OPENAI_BASE_URL}/chat/completions", json=payload, headers=headers, stream=True)
+            with metrics.stage("upstream", metrics.UPSTREAM_CONNECT, provider="openai", model=model):
+                lease = upstream_router.send("openai", send)
+            resp = lease.response
             if resp.status_code != 200:
-                return jsonify({"error": resp.text}), resp.status_code
+                error_text = resp.text
+                lease.close()
+                metrics.UPSTREAM_ERRORS.inc(provider="openai", status=resp.status_code)
+                logger.warning("OpenAI API error", extra={"model": model, "status": resp.status_code})
+                return jsonify({"error": error_text}), resp.status_code
 
             def generate_openai():
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk: yield chunk
-
-            return Response(stream_with_context(generate_openai()), content_type=resp.headers.get('Content-Type'))
+                try:
+                    # 按到达的数据块读取，由 iter_events 按事件边界切分
+                    for chunk in resp.iter_content(chunk_size=None):
+                        if chunk: yield chunk
+                finally:
+                    # 生成结束或被取消时归还连接与并发名额
+                    lease.close()
+
+            relay = SSERelay()
+            events = metered_stream(iter_events(generate_openai(), relay), model, g.started, relay)
+            buffer = stream_registry.start(ticket.hold(events))
+            return replay_response(buffer, headers=window_headers)
+        except NoBackendAvailable as e:
+            return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
-@app.route('/api/images/generations', methods=['POST'])
+IMAGE_MODEL = "gemini-3-pro-image-preview"
+
+def build_image_payload(messages):
+    """构造图片生成请求体（图片在发送时编码）"""
+    processed_messages = process_messages_for_llm(messages, stream_images=True)
+    gemini_contents = convert_openai_to_gemini(processed_messages)
+    
+    return {
+        "contents": gemini_contents,
+        "generationConfig": {
+            "responseModalities": ["IMAGE"],
+            "imageConfig": { "imageSize": "2K" }
+        }
+    }
+
+def cached_result_valid(result):
+    """缓存的结果引用的图片与签名仍存在"""
+    item = result["data"][0]
+    filename = item["url"].split('/')[-1]
+    if not os.path.exists(os.path.join(config.image_cache_dir, filename)):
+        return False
+    return "thoughtSignature" not in item or image_index.signature(filename) is not None
+
+def retain_result_images(result, count=1):
+    """命中缓存或复用任务时，已有的图片会出现在新的对话中，与新生成时一样增加引用"""
+    for item in result["data"]:
+        for _ in range(count):
+            image_index.register(item["url"].split('/')[-1])
+
+def generate_image(payload):
+    """调用图片模型生成图片并写入缓存，返回 OpenAI 风格的结果；失败时抛出 JobError"""
+    headers = { "Content-Type": "application/json" }
+    
+    def send(backend):
+        google_url = f"{backend.base_url}/models/{IMAGE_MODEL}:generateContent?key={backend.api_key}"
+        return routed_post(backend, google_url, data=make_request_body(payload), headers=headers,
+                           read_timeout=config.image_gen_read_timeout)
+
+    try:
+        with metrics.stage("upstream", metrics.UPSTREAM_CONNECT, provider="gemini", model=IMAGE_MODEL):
+            lease = upstream_router.send("gemini", send)
+        with lease as resp:
+            if resp.status_code != 200:
+                metrics.UPSTREAM_ERRORS.inc(provider="gemini", status=resp.status_code)
+                raise JobError(f"Gemini API Error: {resp.text}", resp.status_code)
+            resp_json = resp.json()
+    except NoBackendAvailable as e:
+        raise JobError(str(e), 429)
+    
+    candidates = resp_json.get('candidates', [])
+    if not candidates: 
+        raise JobError("Image generation failed.")
+    
+    parts = candidates[0].get('content', {}).get('parts', [])
+    
+    target_part = None
+    for part in reversed(parts):
+        if 'inlineData' in part or 'inline_data' in part:
+            target_part = part
+            break
+    
+    if not target_part: 
+        raise JobError("Model refused or returned no image.")
+
+    # 获取图片数据
+    image_data_obj = target_part.get('inlineData') or target_part.get('inline_data')
+    img_data = base64.b64decode(image_data_obj.get('data'))
+    
+    file_ext = ".jpg"
+    if image_data_obj.get('mimeType') == 'image/png': file_ext = ".png"
+    
+    image_name = save_content_addressed(img_data, file_ext)
+    filename = os.path.splitext(image_name)[0]
+    image_url = f"/images/cache/{image_name}"
+
+    # 签名存入图片索引，消息中以 /images/cache/<stem>.sig 引用
+    result = {"url": image_url}
+    raw_thought_signature = target_part.get('thoughtSignature')
+    if raw_thought_signature:
+        image_index.set_signature(image_name, raw_thought_signature)
+        result["thoughtSignature"] = f"/images/cache/{filename}.sig"
+
+    return {
+        "created": int(time.time()), 
+        "data": [result]
+    }
+
+@bp.route('/api/images/generations', methods=['POST'])
 def image_proxy():
+    """提交图片生成任务；请求带 async=true 时立即返回任务 id (202)，否则等待结果"""
     if not check_session(): return jsonify({"error": "Unauthorized"}), 401
     
     req_data = request.json
@@ -570,77 +1294,117 @@ def image_proxy():
                     {"type": "image_url", "image_url": {"url": req_data.get('image_url')}}
                 ]
 
-    processed_messages = process_messages_for_llm(messages)
-    gemini_contents = convert_openai_to_gemini(processed_messages)
-    
-    gemini_model = "gemini-3-pro-image-preview"
-    google_url = f"https://generativelanguage.googleapis.com/v1beta/models/{gemini_model}:generateContent?key={GEMINI_API_KEY}"
-    
-    payload = {
-        "contents": gemini_contents,
-        "generationConfig": {
-            "responseModalities": ["IMAGE"],
-            "imageConfig": { "imageSize": "2K" }
-        }
-    }
-    headers = { "Content-Type": "application/json" }
-    
     try:
-        resp = requests.post(google_url, json=payload, headers=headers)
-        if resp.status_code != 200: 
-            return jsonify({"error": {"message": f"Gemini API Error: {resp.text}"}}), resp.status_code
-        
-        resp_json = resp.json()
-        candidates = resp_json.get('candidates', [])
-        if not candidates: 
-            return jsonify({"error": {"message": "Image generation failed."}}), 500
-        
-        parts = candidates[0].get('content', {}).get('parts', [])
-        
-        target_part = None
-        for part in reversed(parts):
-            if 'inlineData' in part or 'inline_data' in part:
-                target_part = part
-                break
-        
-        if not target_part: 
-            return jsonify({"error": {"message": "Model refused or returned no image."}}), 500
+        payload = build_image_payload(messages)
+    except Exception as e:
+        return jsonify({"error": {"message": str(e)}}), 400
+
+    # 相同内容的结果直接返回，正在生成时复用该任务；fresh=true 时生成新的变体
+    key = generation_key(IMAGE_MODEL, payload["contents"], payload["generationConfig"])
+    use_cache = generation_cache is not None and not req_data.get('fresh')
+    if use_cache:
+        result = generation_cache.get(key, cached_result_valid)
+        if result is not None:
+            retain_result_images(result)
+            metrics.IMAGE_RESULTS.inc(result="hit")
+            return jsonify({**result, "cached": True})
+    elif generation_cache is not None:
+        generation_cache.record_bypass()
+        metrics.IMAGE_RESULTS.inc(result="bypass")
+
+    # 查找进行中的任务与提交新任务之间持锁，同时到达的重复请求只提交一次（等待结果在锁外进行）
+    with image_submit_lock:
+        job_id = running_image_job(key) if use_cache else None
+        # 复用的请求记入任务，完成时为其增加图片引用；任务刚好结束时改为提交新任务
+        if job_id is not None and not generation_cache.add_waiter(key, job_id):
+            job_id = None
+        if job_id is not None:
+            generation_cache.record_coalesced()
+            metrics.IMAGE_RESULTS.inc(result="coalesced")
+        else:
+            if use_cache:
+                metrics.IMAGE_RESULTS.inc(result="miss")
+            try:
+                ticket = image_admission.acquire(admission_session())
+            except AdmissionRejected as e:
+                return jsonify({"error": {"message": str(e)}}), 429, {"Retry-After": str(e.retry_after)}
+
+            def run_job(payload):
+                # 任务结束（无论成功与否）时归还该会话的名额
+                with ticket:
+                    result = generate_image(payload)
+                if generation_cache is not None:
+                    generation_cache.put(key, result)
+                    if use_cache:
+                        retain_result_images(result, generation_cache.finish_pending(key))
+                return result
 
-        # 获取图片数据
-        image_data_obj = target_part.get('inlineData') or target_part.get('inline_data')
-        img_data = base64.b64decode(image_data_obj.get('data'))
-        
-        file_ext = ".jpg"
-        if image_data_obj.get('mimeType') == 'image/png': file_ext = ".png"
-        
-        filename = f"{uuid.uuid4()}"
-        filepath = os.path.join(IMAGE_CACHE_DIR, f"{filename}{file_ext}")
-        
-        with open(filepath, "wb") as f:
-            f.write(img_data)
-        
-        image_url = f"/images/cache/{filename}{file_ext}"
-        cleanup_old_images()
-
-        # 写入签名
-        raw_thought_signature = target_part.get('thoughtSignature')
-        sig_ext = ".sig"
-        sig_path = os.path.join(IMAGE_CACHE_DIR, f"{filename}{sig_ext}")
-        with open(sig_path, "w") as f:
-            f.write(raw_thought_signature)
-
-        sig_url = f"/images/cache/{filename}{sig_ext}"
-
-        return jsonify({
-            "created": int(time.time()), 
-            "data": [{
-                "url": image_url,
-                "thoughtSignature": sig_url
-            }]
-        })
-
-    except Exception as e: 
-        return jsonify({"error": {"message": str(e)}}), 500
+            try:
+                job_id = image_jobs.submit(IMAGE_MODEL, run_job, payload)
+            except QueueFull as e:
+                ticket.release()
+                return jsonify({"error": {"message": str(e)}}), 429, {"Retry-After": "10"}
+            except BaseException:
+                # 任务未能提交，名额不会由 run_job 归还
+                ticket.release()
+                raise
+            # fresh 的任务不作为复用对象，也不覆盖同一内容进行中的任务记录
+            if use_cache:
+                generation_cache.set_pending(key, job_id)
+
+    return image_job_response(job_id, req_data.get('async'))
+
+def running_image_job(key):
+    """相同内容正在生成的任务 id；没有时返回 None"""
+    job_id = generation_cache.pending_job(key)
+    job = image_jobs.get(job_id) if job_id else None
+    if job is None or job["status"] in TERMINAL_STATUSES:
+        return None
+    return job_id
+
+def image_job_response(job_id, async_mode):
+    """async 时立即返回任务 id (202)，否则等待结果"""
+    if async_mode:
+        return jsonify({"id": job_id, "status": "queued"}), 202
+
+    job = image_jobs.wait(job_id)
+    if job["status"] == "error":
+        return jsonify({"error": job["error"]}), job["status_code"]
+    return jsonify(job["result"])
+
+@bp.route('/api/images/jobs/<job_id>', methods=['GET'])
+def image_job_status(job_id):
+    """轮询图片生成任务状态"""
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    job = image_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": {"message": "Job not found"}}), 404
+    return jsonify(job)
+
+@bp.route('/api/images/jobs/<job_id>/events', methods=['GET'])
+def image_job_events(job_id):
+    """以 SSE 推送图片生成任务的状态变化，任务结束后关闭"""
+    if not check_session(): return jsonify({"error": "Unauthorized"}), 401
+    if image_jobs.get(job_id) is None:
+        return jsonify({"error": {"message": "Job not found"}}), 404
+
+    def generate_events():
+        last_status = None
+        while True:
+            job = image_jobs.get(job_id)
+            if job is None:
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield f"data: {json.dumps(job)}\n\n"
+            if job["status"] in TERMINAL_STATUSES:
+                return
+            time.sleep(config.image_job_poll_interval)
+
+    return Response(stream_with_context(generate_events()), content_type='text/event-stream')
+
+# gunicorn app:app、asgi.py 与 bench 脚本使用模块级的应用
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=False)
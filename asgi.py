@@ -0,0 +1,283 @@
+"""可选的异步 (ASGI) 运行模式
+
+聊天流式接口在 asyncio 中非阻塞地转发上游响应，单进程可同时维持大量流；
+其余路由仍交给原有 Flask 应用处理 (在线程池中运行)。
+
+启动方式：
+    uvicorn asgi:app --host 127.0.0.1 --port 8080
+
+依赖见 requirements-async.txt；原有的 `python app.py` / WSGI 部署方式不受影响。
+
+ASGI 模式下聊天流直接转发给客户端，不经过 StreamRegistry 的回放缓冲区：响应不带 X-Stream-Id，
+断线续传不可用（客户端没有 stream id 时不会尝试续传），/api/chat/streams/<id> 总是返回 404；
+停止生成由客户端断开连接完成，服务端随之关闭上游请求。
+"""
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import upstream
+import metrics
+from sse import SSERelay, aiter_events
+from admission import AdmissionRejected
+from conversation_store import ConversationConflict
+from upstream_router import NoBackendAvailable, FAILOVER_STATUS
+from app import (
+    app as flask_app,
+    prepare_chat_messages,
+    load_chat_history,
+    ID_PATTERN,
+    is_gemini_model,
+    build_gemini_stream_request,
+    build_openai_stream_request,
+    make_request_body,
+    GeminiStreamDecoder,
+    gemini_relay,
+    relay_gemini_chunks,
+    context_cache,
+    upstream_router,
+    chat_admission,
+    record_usage,
+)
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def get_client():
+    """共享的异步 HTTP 客户端（连接池参数与同步模式一致）"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(upstream.READ_TIMEOUT, connect=upstream.CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=upstream.POOL_MAXSIZE),
+            transport=httpx.AsyncHTTPTransport(retries=upstream.MAX_RETRIES),
+        )
+    return _client
+
+
+def load_session(request):
+    """解析 Flask 的签名 session cookie；没有或签名无效时返回空字典"""
+    cookie = request.cookies.get(flask_app.config["SESSION_COOKIE_NAME"])
+    if not cookie:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return {}
+    try:
+        return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def streaming_content(payload, headers):
+    """流式请求体及对应的请求头（httpx 需要显式的 Content-Length）"""
+    body = make_request_body(payload)
+    return body.aiter_chunks(), {**headers, "Content-Length": str(len(body))}
+
+
+async def open_gemini_stream(model_name, messages):
+    """经上游路由发送流式请求，返回 Lease；缓存被拒绝时的处理同 app.post_gemini_stream"""
+    client = get_client()
+
+    async def send(backend):
+        # 查找/创建上下文缓存可能需要请求上游，放到线程池执行
+        target_url, payload, headers, cache_key = await run_in_threadpool(
+            build_gemini_stream_request, model_name, messages, backend)
+        content, headers = streaming_content(payload, headers)
+        resp = await client.send(
+            client.build_request("POST", target_url, content=content, headers=headers), stream=True)
+        if resp.status_code != 200 and resp.status_code not in FAILOVER_STATUS and cache_key:
+            logger.info("Gemini rejected cached content, retrying without cache",
+                        extra={"model": model_name, "status": resp.status_code})
+            await resp.aclose()
+            # 与第一次相同：SQLite 写入与重建请求都不在事件循环中执行
+            await run_in_threadpool(context_cache.invalidate, cache_key)
+            target_url, payload, headers, _ = await run_in_threadpool(
+                build_gemini_stream_request, model_name, messages, backend, use_cache=False)
+            content, headers = streaming_content(payload, headers)
+            resp = await client.send(
+                client.build_request("POST", target_url, content=content, headers=headers), stream=True)
+        return resp
+
+    start = time.perf_counter()
+    try:
+        return await upstream_router.send_async("gemini", send, errors=(httpx.TransportError,))
+    finally:
+        metrics.UPSTREAM_CONNECT.observe(time.perf_counter() - start, provider="gemini", model=model_name)
+
+
+async def stream_gemini_async(lease, model_name, relay):
+    """lease 为已发送的请求（路由失败已在返回响应前处理）"""
+    try:
+        resp = lease.response
+        try:
+            if resp.status_code != 200:
+                body = (await resp.aread()).decode("utf-8", "replace")
+                error_msg = f"Gemini API Error ({resp.status_code}): {body}"
+                metrics.UPSTREAM_ERRORS.inc(provider="gemini", status=resp.status_code)
+                logger.warning("Gemini API error", extra={"model": model_name, "status": resp.status_code})
+                yield f"data: {json.dumps({'error': error_msg})}\n\n"
+                return
+
+            decoder = GeminiStreamDecoder()
+            async for data in resp.aiter_bytes():
+                for event in relay_gemini_chunks(relay, decoder.feed(data)):
+                    yield event
+            for event in relay_gemini_chunks(relay, decoder.flush()):
+                yield event
+            yield "data: [DONE]\n\n"
+        finally:
+            await lease.aclose()
+    except Exception as e:
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+
+async def held(ticket, events):
+    """流结束（或客户端断开）时归还准入名额"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        ticket.release()
+
+
+async def metered_stream(events, model, started, relay):
+    """同 app.metered_stream"""
+    relayed = 0
+    try:
+        async for event in events:
+            if not relayed:
+                metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started, model=model)
+            relayed += len(event)
+            yield event
+    finally:
+        metrics.STREAM_DURATION.observe(time.perf_counter() - started, model=model)
+        metrics.RELAYED_BYTES.inc(relayed, model=model)
+        record_usage(model, relay.usage)
+
+
+async def chat_proxy(request):
+    flask_session = load_session(request)
+    if not flask_session.get("authenticated"):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    started = time.perf_counter()
+    timings = metrics.begin_request()
+    owner = request.headers.get("X-Client-Id", "")
+    # 与 app.admission_session 相同：按登录时签发的 session id 计数，没有时按 IP
+    sid = flask_session.get("sid")
+    session = f"sid:{sid}" if sid else f"ip:{request.client.host if request.client else ''}"
+    try:
+        with metrics.stage("admission"):
+            ticket = await chat_admission.acquire_async(session)
+    except AdmissionRejected as e:
+        return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+    try:
+        response = await proxy_chat(request, owner, ticket, started)
+    finally:
+        # 流式响应已接管名额时由其结束后归还
+        if not ticket.held:
+            ticket.release()
+    elapsed = time.perf_counter() - started
+    response.headers["Server-Timing"] = metrics.server_timing(timings + [("total", elapsed)])
+    metrics.REQUEST_DURATION.observe(
+        elapsed, endpoint="/api/chat/completions", method="POST", status=response.status_code)
+    return response
+
+
+async def proxy_chat(request, owner, ticket, started):
+    data = await request.json()
+    model = data.get("model", "gpt-3.5-turbo")
+    # 查询对话存储、读取本地图片都属于阻塞操作，放到线程池执行
+    try:
+        with metrics.stage("history"):
+            raw_messages, window = await run_in_threadpool(
+                load_chat_history, data, owner if ID_PATTERN.match(owner) else None, model)
+    except ConversationConflict as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    with metrics.stage("prepare"):
+        processed_messages = await run_in_threadpool(prepare_chat_messages, raw_messages, model)
+    window_headers = {"X-History-Window": window.header()}
+
+    if is_gemini_model(model):
+        # 先发送请求：所有 key 都在限流时返回 429 与 Retry-After，而不是在 200 的流中报错
+        try:
+            lease = await open_gemini_stream(model, processed_messages)
+        except NoBackendAvailable as e:
+            return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+        except Exception as e:
+            return JSONResponse({"error": str(e)}, status_code=500)
+        relay = gemini_relay(model)
+        events = metered_stream(stream_gemini_async(lease, model, relay), model, started, relay)
+        ticket.held = True
+        return StreamingResponse(held(ticket, events), media_type="text/event-stream", headers=window_headers)
+
+    client = get_client()
+
+    async def send(backend):
+        target_url, payload, headers = build_openai_stream_request(model, processed_messages, backend)
+        content, headers = streaming_content(payload, headers)
+        return await client.send(
+            client.build_request("POST", target_url, content=content, headers=headers), stream=True)
+
+    try:
+        with metrics.stage("upstream", metrics.UPSTREAM_CONNECT, provider="openai", model=model):
+            lease = await upstream_router.send_async("openai", send, errors=(httpx.TransportError,))
+    except NoBackendAvailable as e:
+        return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    resp = lease.response
+    if resp.status_code != 200:
+        body = await resp.aread()
+        await lease.aclose()
+        metrics.UPSTREAM_ERRORS.inc(provider="openai", status=resp.status_code)
+        logger.warning("OpenAI API error", extra={"model": model, "status": resp.status_code})
+        return JSONResponse({"error": body.decode("utf-8", "replace")}, status_code=resp.status_code)
+
+    relay = SSERelay()
+
+    async def relay_events():
+        try:
+            async for event in aiter_events(resp.aiter_bytes(), relay):
+                yield event
+        finally:
+            await lease.aclose()
+
+    ticket.held = True
+    return StreamingResponse(
+        held(ticket, metered_stream(relay_events(), model, started, relay)),
+        media_type="text/event-stream", headers=window_headers)
+
+
+async def stream_not_resumable(request):
+    return JSONResponse({"error": "Stream resume is not available in ASGI mode"}, status_code=404)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    if _client is not None:
+        await _client.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/chat/completions", chat_proxy, methods=["POST"]),
+        Route("/api/chat/streams/{stream_id}", stream_not_resumable, methods=["GET", "DELETE"]),
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
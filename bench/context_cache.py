@@ -0,0 +1,104 @@
+"""上下文缓存基准：对比长对话中每轮发送完整历史与引用 Gemini 缓存前缀的上传字节与首 token 延迟
+
+用法：
+    python bench/context_cache.py [--turns 24] [--images 6] [--image-kb 400]
+
+使用 bench/fake_gemini.py 模拟的上游（首 token 延迟与上传字节数成正比），在临时目录中
+逐轮追加消息，每轮通过 app.stream_gemini_native 发送请求，分别统计关闭/开启缓存时：
+  - 每轮上传到上游的总字节数（含创建缓存的请求）
+  - 首个事件的延迟（后半段对话的平均值，体现长对话的情况）
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGemini
+
+MODEL = "gemini-3-pro-preview"
+
+
+def user_message(cache_dir, turn, n_images, image_bytes):
+    content = [{"type": "text", "text": f"question {turn} " + "lorem ipsum dolor sit amet " * 40}]
+    if turn < n_images:
+        name = f"{turn:032x}.jpg"
+        with open(os.path.join(cache_dir, name), "wb") as f:
+            f.write(os.urandom(image_bytes))
+        content.append({"type": "image_url", "image_url": {"url": f"/images/cache/{name}"}})
+    return {"role": "user", "content": content}
+
+
+def run(app, fake, messages_per_turn, label):
+    history = []
+    uploads, ttfts = [], []
+    for turn, message in enumerate(messages_per_turn):
+        history.append(message)
+        processed = app.prepare_chat_messages(history, MODEL)
+        fake.reset()
+        start = time.perf_counter()
+        events = app.stream_gemini_native(MODEL, processed)
+        first = next(events)
+        ttfts.append(time.perf_counter() - start)
+        reply = [first, *events]
+        if "error" in first:
+            raise RuntimeError(f"{label}: {first}")
+        uploads.append(fake.upload_bytes())
+        history.append({"role": "assistant", "content": f"answer {turn} " + "consectetur adipiscing " * 30})
+        assert reply[-1].startswith("data: [DONE]")
+
+    tail = ttfts[len(ttfts) // 2:]
+    return {
+        "upload_mb_total": round(sum(uploads) / 1024 / 1024, 2),
+        "upload_kb_last_turn": round(uploads[-1] / 1024, 1),
+        "ttft_ms_second_half": round(sum(tail) / len(tail) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=24)
+    parser.add_argument("--images", type=int, default=6)
+    parser.add_argument("--image-kb", type=int, default=400)
+    args = parser.parse_args()
+
+    fake = FakeGemini().start()
+    workdir = tempfile.mkdtemp(prefix="bench_ctx_")
+    os.chdir(workdir)
+    os.environ.update({
+        "GEMINI_BASE_URL": fake.url,
+        "GEMINI_API_KEY": "fake",
+        "GEMINI_CONTEXT_CACHE": "1",
+        "GEMINI_CONTEXT_CACHE_MIN_TOKENS": "1024",
+    })
+    sys.path.insert(0, ROOT)
+    import app
+
+    cache_dir = app.config.image_cache_dir
+    messages = [user_message(cache_dir, i, args.images, args.image_kb * 1024) for i in range(args.turns)]
+
+    context_cache = app.context_cache
+    app.context_cache = None
+    baseline = run(app, fake, messages, "no cache")
+    app.context_cache = context_cache
+    cached = run(app, fake, messages, "context cache")
+    cached["caches_created"] = context_cache.stats()["created"]
+
+    print(json.dumps({
+        "turns": args.turns,
+        "images": args.images,
+        "image_kb": args.image_kb,
+        "no_cache": baseline,
+        "context_cache": cached,
+        "upload_reduction": round(1 - cached["upload_mb_total"] / baseline["upload_mb_total"], 3),
+        "ttft_reduction": round(1 - cached["ttft_ms_second_half"] / baseline["ttft_ms_second_half"], 3),
+    }, indent=2))
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
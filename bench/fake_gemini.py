@@ -0,0 +1,184 @@
+"""本地模拟的 Gemini 接口，供基准与手动测试使用（不需要 API key，也不访问网络）
+
+支持：
+  - POST  /v1beta/models/<model>:streamGenerateContent   (alt=sse，可引用 cachedContent)
+  - POST  /v1beta/models/<model>:generateContent             (模型名含 "image" 时返回一张图片)
+  - POST  /v1beta/cachedContents                          创建上下文缓存
+  - PATCH /v1beta/cachedContents/<id>                     更新 TTL
+首 token 前的延迟为固定的 first_token_ms 加上按本次上传字节数模拟的 prefill (prefill_ms_per_mb)，
+引用缓存的部分只按很小的比例计算；之后按 tokens_per_sec 逐词输出 (0 表示不限速)。
+非流式请求固定延迟 generate_ms。每个请求的路径与上传字节数记录在 requests 中。
+
+用法：
+    server = FakeGemini().start()
+    os.environ["GEMINI_BASE_URL"] = server.url   # 在导入 app 之前设置
+"""
+import base64
+import io
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class FakeGemini:
+
+    def __init__(self, prefill_ms_per_mb=200.0, cached_prefill_ratio=0.1, min_cache_tokens=0, reply="Hello from fake Gemini",
+                 first_token_ms=0.0, tokens_per_sec=0.0, generate_ms=0.0):
+        self.prefill_ms_per_mb = prefill_ms_per_mb
+        self.cached_prefill_ratio = cached_prefill_ratio
+        self.min_cache_tokens = min_cache_tokens
+        self.reply = reply
+        self.first_token_ms = first_token_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.generate_ms = generate_ms
+        self._image = None
+        self._generated = 0
+        self.requests = []
+        self.caches = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1beta"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                fake._handle(self, "POST")
+
+            def do_PATCH(self):
+                fake._handle(self, "PATCH")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def reset(self):
+        with self._lock:
+            self.requests = []
+
+    def upload_bytes(self):
+        with self._lock:
+            return sum(size for _, size in self.requests)
+
+    # --- 请求处理 ---
+
+    def _handle(self, handler, method):
+        raw = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        path = urlsplit(handler.path).path
+        with self._lock:
+            self.requests.append((path, len(raw)))
+        body = json.loads(raw) if raw else {}
+
+        if path.endswith("/cachedContents") and method == "POST":
+            return self._create_cache(handler, body, len(raw))
+        if "/cachedContents/" in path and method == "PATCH":
+            return self._update_cache(handler, path.split("/v1beta/")[-1], body)
+        if path.endswith(":streamGenerateContent"):
+            return self._stream(handler, body, len(raw))
+        if path.endswith(":generateContent"):
+            time.sleep(self.generate_ms / 1000)
+            if "image" in path.rsplit("/", 1)[-1]:
+                part = {"inlineData": {"mimeType": "image/png", "data": self._image_data()}, "thoughtSignature": "fake-signature"}
+            else:
+                part = {"text": self.reply}
+            return self._json(handler, 200, {
+                "candidates": [{"content": {"role": "model", "parts": [part]}, "finishReason": "STOP"}],
+            })
+        self._json(handler, 404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+
+    @staticmethod
+    def _json(handler, status, obj):
+        out = json.dumps(obj).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(out)))
+        handler.end_headers()
+        handler.wfile.write(out)
+
+    def _image_data(self):
+        # 每次返回不同的图片内容（按内容哈希命名时不会被去重）
+        from PIL import Image
+
+        with self._lock:
+            if self._image is None:
+                self._image = Image.new("RGB", (256, 256), (90, 140, 200))
+            self._generated += 1
+            self._image.putpixel((self._generated % 256, self._generated // 256 % 256), (255, 0, 0))
+            out = io.BytesIO()
+            self._image.save(out, "PNG")
+        return base64.b64encode(out.getvalue()).decode("ascii")
+
+    @staticmethod
+    def _ttl(body):
+        return float(body.get("ttl", "3600s").rstrip("s"))
+
+    def _create_cache(self, handler, body, size):
+        tokens = size // 4
+        if tokens < self.min_cache_tokens:
+            return self._json(handler, 400, {"error": {"code": 400, "message": "Cached content is too small"}})
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self.caches[name] = {"tokens": tokens, "bytes": size, "expires": time.time() + self._ttl(body)}
+        self._json(handler, 200, {"name": name, "model": body.get("model"), "usageMetadata": {"totalTokenCount": tokens}})
+
+    def _update_cache(self, handler, name, body):
+        with self._lock:
+            cache = self.caches.get(name)
+            if cache is not None:
+                cache["expires"] = time.time() + self._ttl(body)
+        if cache is None:
+            return self._json(handler, 404, {"error": {"code": 404, "message": "Cached content not found"}})
+        self._json(handler, 200, {"name": name})
+
+    def _stream(self, handler, body, size):
+        cached_tokens = cached_bytes = 0
+        name = body.get("cachedContent")
+        if name:
+            with self._lock:
+                cache = self.caches.get(name)
+            if cache is None or cache["expires"] < time.time():
+                return self._json(handler, 404, {"error": {"code": 404, "message": "Cached content not found"}})
+            cached_tokens, cached_bytes = cache["tokens"], cache["bytes"]
+
+        # 首 token 前的处理时间：新上传的内容按全价，缓存部分按 cached_prefill_ratio
+        prefill_mb = (size + cached_bytes * self.cached_prefill_ratio) / 1024 / 1024
+        time.sleep((self.first_token_ms + prefill_mb * self.prefill_ms_per_mb) / 1000)
+
+        prompt_tokens = size // 4 + cached_tokens
+        words = self.reply.split(" ")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        for i, word in enumerate(words):
+            if i and self.tokens_per_sec:
+                time.sleep(1 / self.tokens_per_sec)
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": word + (" " if i < len(words) - 1 else "")}]}}]}
+            if i == len(words) - 1:
+                chunk["candidates"][0]["finishReason"] = "STOP"
+                chunk["usageMetadata"] = {
+                    "promptTokenCount": prompt_tokens,
+                    "cachedContentTokenCount": cached_tokens,
+                    "candidatesTokenCount": len(words),
+                    "totalTokenCount": prompt_tokens + len(words),
+                }
+            data = f"data: {json.dumps(chunk)}\r\n\r\n".encode("utf-8")
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            handler.wfile.flush()
+        handler.wfile.write(b"0\r\n\r\n")
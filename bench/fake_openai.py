@@ -0,0 +1,93 @@
+"""本地模拟的 OpenAI chat completions 接口 (stream=true)，供基准使用
+
+  - POST /v1/chat/completions   按 SSE 逐词返回 chat.completion.chunk，请求 include_usage 时最后附带用量
+首 token 前固定延迟 first_token_ms，之后按 tokens_per_sec 输出 (0 表示不限速)。
+
+用法：
+    server = FakeOpenAI().start()
+    os.environ["OPENAI_BASE_URL"] = server.url   # 在导入 app 之前设置
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class FakeOpenAI:
+
+    def __init__(self, reply="Hello from fake OpenAI", first_token_ms=0.0, tokens_per_sec=0.0):
+        self.reply = reply
+        self.first_token_ms = first_token_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _handle(self, handler):
+        raw = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        path = urlsplit(handler.path).path
+        with self._lock:
+            self.requests.append((path, len(raw)))
+        if not path.endswith("/chat/completions"):
+            out = json.dumps({"error": {"message": f"Unknown path {path}"}}).encode("utf-8")
+            handler.send_response(404)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(out)))
+            handler.end_headers()
+            handler.wfile.write(out)
+            return
+
+        body = json.loads(raw)
+        time.sleep(self.first_token_ms / 1000)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model")}
+        words = self.reply.split(" ")
+        chunks = [{**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}]
+        for i, word in enumerate(words):
+            text = word + (" " if i < len(words) - 1 else "")
+            chunks.append({**base, "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]})
+        chunks.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunks.append({**base, "choices": [], "usage": {
+                "prompt_tokens": len(raw) // 4, "completion_tokens": len(words), "total_tokens": len(raw) // 4 + len(words)}})
+
+        for i, chunk in enumerate(chunks):
+            if 1 < i <= len(words) and self.tokens_per_sec:
+                time.sleep(1 / self.tokens_per_sec)
+            self._write(handler, f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self._write(handler, b"data: [DONE]\n\n")
+        handler.wfile.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _write(handler, data):
+        handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        handler.wfile.flush()
@@ -0,0 +1,441 @@
+"""负载测试：在本地模拟的 Gemini / OpenAI 上游前启动服务，按给定并发驱动主要接口
+
+用法：
+    python bench/load.py [--scenarios chat_gemini,chat_openai,upload,image,title]
+                         [--concurrency 8] [--requests 64] [--server wsgi|asgi]
+                         [--first-token-ms 300] [--tokens-per-sec 40] [--reply-words 60]
+                         [--generate-ms 800] [--env KEY=VALUE ...]
+                         [--output baseline.json] [--compare baseline.json] [--tolerance 0.2]
+
+上游使用 bench/fake_gemini.py 与 bench/fake_openai.py（在本进程内运行，可设置首 token 延迟与输出速率），
+服务在临时目录中以子进程启动（wsgi：Flask 多线程服务；asgi：uvicorn asgi:app），
+内存只统计服务进程。每个场景由 concurrency 个线程各用一个已登录的会话（不同的 X-Client-Id）
+共发送 requests 个请求：
+  - chat_gemini / chat_openai：POST /api/chat/completions，首 token 时间为收到第一段非空内容的时间
+  - upload：POST /api/upload，每个请求上传一张内容不同的 JPEG
+  - image：POST /api/images/generations（同步等待结果）
+  - title：POST /api/chat/generate-title
+每个场景输出吞吐、延迟与首 token 时间的 p50/p99、状态码分布与服务进程（及其子进程）的峰值 RSS。
+
+--output 保存结果作为基线；--compare 与基线对比，任一指标变差超过 tolerance 时列出并以状态码 1 退出。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import FakeGemini
+from fake_openai import FakeOpenAI
+
+PASSWORD = "bench-password"
+SCENARIOS = ("chat_gemini", "chat_openai", "upload", "image", "title")
+GEMINI_MODEL = "gemini-2.5-flash"
+OPENAI_MODEL = "gpt-4o-mini"
+
+# 对比时的指标方向与绝对容差：变化小于容差时不算回归（避免极小数值的抖动）
+COMPARED_METRICS = {
+    "throughput_rps": ("higher", 0.0),
+    "latency_ms_p50": ("lower", 5.0),
+    "latency_ms_p99": ("lower", 5.0),
+    "ttft_ms_p50": ("lower", 5.0),
+    "ttft_ms_p99": ("lower", 5.0),
+    "error_rate": ("lower", 0.01),
+    "peak_rss_mb": ("lower", 4.0),
+    "peak_rss_mb_children": ("lower", 4.0),
+}
+
+
+# --- 服务进程 ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, gemini, openai, workdir):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "GEMINI_BASE_URL": gemini.url,
+        "GEMINI_API_KEY": "fake",
+        "OPENAI_BASE_URL": openai.url,
+        "OPENAI_API_KEY": "fake",
+        "SITE_PASSWORD": PASSWORD,
+        "LOG_LEVEL": "WARNING",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    if args.server == "asgi":
+        cmd = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning", "--no-access-log"]
+    else:
+        cmd = [sys.executable, "-c",
+               "import logging, app; logging.getLogger('werkzeug').setLevel(logging.WARNING); "
+               f"app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with status {proc.returncode}")
+        try:
+            requests.get(f"{base}/api/auth/check", timeout=1)
+            return proc, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("Server did not start within 60s")
+
+
+def login(base, client_id):
+    session = requests.Session()
+    session.headers["X-Client-Id"] = client_id
+    resp = session.post(f"{base}/api/auth/login", json={"password": PASSWORD}, timeout=10)
+    resp.raise_for_status()
+    return session
+
+
+# --- 内存 ---
+
+def _children(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm 可能含空格，从最后一个 ")" 之后解析
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def _status_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_rss(pid):
+    """清零 VmHWM（Linux 4.0+），使峰值只反映接下来的场景；不支持时峰值为进程启动以来的值"""
+    for p in [pid] + _children(pid):
+        try:
+            with open(f"/proc/{p}/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+
+class RssSampler:
+    """场景运行期间定期记录子进程的峰值：图片处理进程池中的进程可能在场景结束前退出"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.children_peak = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        for child in _children(self.pid):
+            self.children_peak[child] = max(self.children_peak.get(child, 0), _status_kb(child, "VmHWM"))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def result(self):
+        return {
+            "peak_rss_mb": round(_status_kb(self.pid, "VmHWM") / 1024, 1),
+            "peak_rss_mb_children": round(sum(self.children_peak.values()) / 1024, 1),
+        }
+
+
+# --- 场景 ---
+
+def first_content_time(resp, start):
+    """读取整个 SSE 响应，返回收到第一段非空内容的时间 (秒)；没有内容时返回 None"""
+    ttft = None
+    pending = b""
+    for chunk in resp.iter_content(chunk_size=None):
+        if ttft is not None:
+            continue
+        pending += chunk
+        *events, pending = pending.split(b"\n\n")
+        # 事件可能带 "id: N" 行（可续传的流），只看 data 行
+        for data in (line[6:] for event in events for line in event.split(b"\n") if line.startswith(b"data: ")):
+            if data == b"[DONE]":
+                continue
+            try:
+                obj = json.loads(data)
+                if obj.get("error"):
+                    raise RuntimeError(f"Stream error: {obj['error']}")
+                choices = obj.get("choices") or [{}]
+                if choices[0].get("delta", {}).get("content"):
+                    ttft = time.perf_counter() - start
+                    break
+            except ValueError:
+                continue
+    return ttft
+
+
+def chat_request(model):
+    def run(session, base, i):
+        body = {"model": model, "messages": [
+            {"role": "user", "content": f"Request {i}: tell me something interesting. " + "lorem ipsum " * 30}]}
+        start = time.perf_counter()
+        resp = session.post(f"{base}/api/chat/completions", json=body, stream=True, timeout=120)
+        with resp:
+            ttft = first_content_time(resp, start) if resp.status_code == 200 else None
+        return resp.status_code, ttft
+    return run
+
+
+def make_uploads(count, width, height):
+    """生成 count 张内容各不相同的 JPEG（避免按内容哈希去重）"""
+    from PIL import Image
+
+    base = Image.effect_noise((width, height), 40).convert("RGB")
+    uploads = []
+    for i in range(count):
+        img = base.copy()
+        img.paste((i * 37 % 256, i * 91 % 256, i * 53 % 256), (0, 0, 32, 32))
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=90)
+        uploads.append(out.getvalue())
+    return uploads
+
+
+def upload_request(uploads):
+    def run(session, base, i):
+        resp = session.post(f"{base}/api/upload", files={"file": (f"photo{i}.jpg", uploads[i], "image/jpeg")}, timeout=120)
+        return resp.status_code, None
+    return run
+
+
+def image_request(session, base, i):
+    resp = session.post(f"{base}/api/images/generations", json={"prompt": f"A watercolor cat #{i}"}, timeout=600)
+    return resp.status_code, None
+
+
+def title_request(session, base, i):
+    resp = session.post(f"{base}/api/chat/generate-title",
+                        json={"message": f"How do I plan a family trip to Kyoto? ({i})"}, timeout=60)
+    return resp.status_code, None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 1)
+
+
+def run_scenario(name, send, args, base, server_pid):
+    sessions = [login(base, f"bench-{name}-{w}") for w in range(args.concurrency)]
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+    latencies, ttfts, statuses = [], [], {}
+
+    def worker(session):
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                status, ttft = send(session, base, i)
+            except Exception as e:
+                status, ttft = type(e).__name__, None
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+                    if ttft is not None:
+                        ttfts.append(ttft)
+
+    reset_peak_rss(server_pid)
+    with RssSampler(server_pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(worker, sessions))
+        duration = time.perf_counter() - started
+    for session in sessions:
+        session.close()
+
+    result = {
+        "requests": args.requests,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "error_rate": round(1 - len(latencies) / args.requests, 3),
+        "duration_s": round(duration, 2),
+        "throughput_rps": round(len(latencies) / duration, 2),
+        "latency_ms_p50": percentile(latencies, 0.5),
+        "latency_ms_p99": percentile(latencies, 0.99),
+    }
+    if name.startswith("chat_"):
+        result["ttft_ms_p50"] = percentile(ttfts, 0.5)
+        result["ttft_ms_p99"] = percentile(ttfts, 0.99)
+    result.update(sampler.result())
+    return result
+
+
+# --- 对比 ---
+
+def compare(results, baseline, tolerance):
+    """返回回归列表：[(场景, 指标, 基线值, 本次值)]"""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        for metric, (direction, slack) in COMPARED_METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            if direction == "lower":
+                worse = new > old * (1 + tolerance) and new - old > slack
+            else:
+                worse = new < old * (1 - tolerance) and old - new > slack
+            if worse:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-sec", type=float, default=40)
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--generate-ms", type=float, default=800)
+    parser.add_argument("--upload-size", default="2400x1800", help="上传图片的尺寸 WxH")
+    parser.add_argument("--env", action="append", default=[], help="传给服务进程的环境变量 KEY=VALUE")
+    parser.add_argument("--output", help="结果写入该文件（可作为基线）")
+    parser.add_argument("--compare", help="与该基线文件对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许变差的比例")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    random.seed(0)
+    reply = " ".join(random.choice(("lorem", "ipsum", "dolor", "sit", "amet", "consectetur")) for _ in range(args.reply_words))
+    gemini = FakeGemini(reply=reply, first_token_ms=args.first_token_ms, tokens_per_sec=args.tokens_per_sec,
+                        generate_ms=args.generate_ms).start()
+    openai = FakeOpenAI(reply=reply, first_token_ms=args.first_token_ms, tokens_per_sec=args.tokens_per_sec).start()
+
+    senders = {
+        "chat_gemini": chat_request(GEMINI_MODEL),
+        "chat_openai": chat_request(OPENAI_MODEL),
+        "image": image_request,
+        "title": title_request,
+    }
+    if "upload" in names:
+        width, height = (int(v) for v in args.upload_size.lower().split("x"))
+        senders["upload"] = upload_request(make_uploads(args.requests, width, height))
+
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    proc, base = start_server(args, gemini, openai, workdir)
+    try:
+        scenarios = {}
+        for name in names:
+            scenarios[name] = run_scenario(name, senders[name], args, base, proc.pid)
+            print(f"{name}: {json.dumps(scenarios[name])}", file=sys.stderr)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        gemini.stop()
+        openai.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "revision": git_revision(),
+        "created": int(time.time()),
+        "python": platform.python_version(),
+        "config": {
+            "server": args.server,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "first_token_ms": args.first_token_ms,
+            "tokens_per_sec": args.tokens_per_sec,
+            "reply_words": args.reply_words,
+            "generate_ms": args.generate_ms,
+            "upload_size": args.upload_size,
+            "env": args.env,
+        },
+        "scenarios": scenarios,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("warning: baseline was recorded with a different configuration", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name}.{metric}: {old} -> {new}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
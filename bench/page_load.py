@@ -0,0 +1,92 @@
+"""页面加载基准：模拟浏览器首次访问与再次访问时对本站资源的请求数与传输字节数
+
+用法：
+    python bench/page_load.py [--visits 3]
+
+用 Flask test client 请求首页，解析其中引用的本地资源（CSS/JS/图标），按响应头模拟浏览器缓存：
+  - Cache-Control 含 immutable / max-age 且未过期：不发请求
+  - 有 ETag：带 If-None-Match 重新验证（304 只计响应头）
+外部 CDN 资源不计入。同时给出不做压缩、每次都完整下载时的字节数作为对照。
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_REFERENCE = re.compile(r'\b(?:href|src)="(/[^"]+)"')
+
+
+class BrowserCache:
+
+    def __init__(self, client):
+        self.client = client
+        # url -> (ETag, 过期时间, 内容)
+        self.entries = {}
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        if entry is not None and entry[1] > time.time():
+            return entry[2]
+        headers = {"Accept-Encoding": "gzip"}
+        if entry is not None and entry[0]:
+            headers["If-None-Match"] = entry[0]
+        resp = self.client.get(url, headers=headers)
+        self.requests += 1
+        self.bytes += len(resp.data)
+        if resp.status_code == 304:
+            body = entry[2]
+        else:
+            body = resp.get_data()
+            if resp.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+        cache_control = resp.headers.get("Cache-Control", "")
+        match = re.search(r"max-age=(\d+)", cache_control)
+        expires = time.time() + int(match.group(1)) if match and "no-cache" not in cache_control else 0
+        self.entries[url] = (resp.headers.get("ETag"), expires, body)
+        return body
+
+    def visit(self):
+        before = self.requests, self.bytes
+        html = self.get("/").decode("utf-8")
+        for url in _REFERENCE.findall(html):
+            self.get(url)
+        return {"requests": self.requests - before[0], "bytes": self.bytes - before[1]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--visits", type=int, default=3)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_page_"))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, ROOT)
+    import app
+
+    client = app.app.test_client()
+    browser = BrowserCache(client)
+    visits = [browser.visit() for _ in range(args.visits)]
+
+    # 对照：每次都完整下载未压缩的原始文件
+    html = client.get("/").get_data(as_text=True)
+    raw_bytes = len(app.static_assets.index_asset.variants["identity"])
+    for url in _REFERENCE.findall(html):
+        raw_bytes += len(client.get(url).data)
+
+    print(json.dumps({
+        "uncompressed_full_download": {"requests": 1 + len(_REFERENCE.findall(html)), "bytes": raw_bytes},
+        "first_visit": visits[0],
+        "repeat_visits": visits[1:],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""请求体内存基准：对比整体构造 JSON 与流式构造的峰值内存
+
+用法：
+    python bench/request_body_memory.py [--images 8] [--image-mb 3] [--messages 20]
+
+在临时目录中生成随机内容的图片文件，模拟带图片的 20 条历史消息，分别测量：
+  - inline：消息中直接放 Base64 字符串，再 json.dumps 成完整请求体（旧做法）
+  - stream：InlineImage 占位 + StreamingJSONBody 分块发送
+两者均用 tracemalloc 统计 Python 分配的峰值，并校验生成的请求体完全一致。
+"""
+import argparse
+import dataclasses
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_history(cache_dir, n_messages, n_images, image_bytes):
+    messages = []
+    for i in range(n_messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = [{"type": "text", "text": f"message {i} " + "lorem ipsum " * 20}]
+        if role == "user" and i // 2 < n_images:
+            name = f"{i:032x}.jpg"
+            with open(os.path.join(cache_dir, name), "wb") as f:
+                f.write(os.urandom(image_bytes))
+            content.append({"type": "image_url", "image_url": {"url": f"/images/cache/{name}"}})
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def measure(fn):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    digest = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, digest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--image-mb", type=float, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_body_")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app
+    from upstream_router import Backend
+
+    app.config = dataclasses.replace(app.config, image_cache_dir=os.path.join(workdir, "images"))
+    os.makedirs(app.config.image_cache_dir)
+    # 关闭已编码缓存，两种方式都从磁盘读取
+    app.encoded_cache.max_bytes = 0
+    messages = build_history(app.config.image_cache_dir, args.messages, args.images, int(args.image_mb * 1024 * 1024))
+    # 只构造请求体，不发送
+    backend = Backend("openai", 0, "http://127.0.0.1", "", 1)
+
+    def inline():
+        processed = app.process_messages_for_llm(messages)
+        _, payload, _ = app.build_openai_stream_request("gpt-4o", processed, backend)
+        body = json.dumps(payload).encode("utf-8")
+        return hashlib.sha256(body).hexdigest()
+
+    def stream():
+        processed = app.process_messages_for_llm(messages, stream_images=True)
+        _, payload, _ = app.build_openai_stream_request("gpt-4o", processed, backend)
+        digest = hashlib.sha256()
+        for chunk in app.make_request_body(payload):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    inline_peak, inline_digest = measure(inline)
+    stream_peak, stream_digest = measure(stream)
+    image_total = args.images * args.image_mb
+
+    print(json.dumps({
+        "messages": args.messages,
+        "images": args.images,
+        "image_mb_total": image_total,
+        "inline_peak_mb": round(inline_peak / 1024 / 1024, 2),
+        "stream_peak_mb": round(stream_peak / 1024 / 1024, 2),
+        "identical_body": inline_digest == stream_digest,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""冷启动基准：从导入 app 到完成第一个请求的耗时
+
+用法：
+    python bench/startup.py [--runs 10] [--env KEY=VALUE ...]
+                            [--output baseline.json] [--compare baseline.json] [--tolerance 0.2]
+
+每次在新的临时目录中启动一个新的 Python 进程（相当于一个新 worker 或从零扩容的容器），测量：
+  - import_ms：import app（读取配置、注册路由、创建应用）
+  - first_request_ms：第一个请求 GET /api/auth/check
+  - first_page_ms：随后的首页请求（静态资源在这里首次加载）
+  - total_ms：import_ms + first_request_ms
+  - process_ms：从启动进程到子进程退出的总时间（含解释器启动）
+同时记录第一个请求后已加载的重量级模块（应为空：图片编解码与 asyncio 只在用到时导入）。
+正式测量前先运行 warmup 次，使 .pyc 已生成。
+
+--output 保存结果作为基线；--compare 与基线对比，任一指标变差超过 tolerance 时列出并以状态码 1 退出。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 第一个请求后不应被导入的模块
+HEAVY_MODULES = ("PIL", "pillow_heif", "asyncio")
+
+# 对比时的指标方向与绝对容差 (毫秒)：变化小于容差时不算回归
+COMPARED_METRICS = {
+    "import_ms_p50": ("lower", 5.0),
+    "first_request_ms_p50": ("lower", 2.0),
+    "first_page_ms_p50": ("lower", 5.0),
+    "total_ms_p50": ("lower", 5.0),
+    "process_ms_p50": ("lower", 10.0),
+}
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+status = client.get("/api/auth/check").status_code
+requested = time.perf_counter()
+page_status = client.get("/").status_code
+paged = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (requested - imported) * 1000,
+    "first_page_ms": (paged - requested) * 1000,
+    "statuses": [status, page_status],
+    "heavy_modules": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def run_once(env):
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", CHILD.format(root=ROOT, heavy=HEAVY_MODULES)],
+                              cwd=workdir, env=env, capture_output=True, text=True, timeout=120)
+        elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"startup run failed:\n{proc.stderr}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process_ms"] = elapsed * 1000
+    return result
+
+
+def summarize(samples):
+    summary = {"runs": len(samples)}
+    for metric in ("import_ms", "first_request_ms", "first_page_ms", "total_ms", "process_ms"):
+        values = sorted(s[metric] for s in samples)
+        summary[f"{metric}_p50"] = round(values[len(values) // 2], 1)
+        summary[f"{metric}_max"] = round(values[-1], 1)
+    summary["statuses"] = sorted({tuple(s["statuses"]) for s in samples})
+    summary["heavy_modules"] = sorted({m for s in samples for m in s["heavy_modules"]})
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """返回回归列表：[(指标, 基线值, 本次值)]"""
+    regressions = []
+    for metric, (direction, slack) in COMPARED_METRICS.items():
+        old, new = baseline.get("startup", {}).get(metric), results["startup"].get(metric)
+        if old is None or new is None:
+            continue
+        if direction == "lower":
+            worse = new > old * (1 + tolerance) and new - old > slack
+        else:
+            worse = new < old * (1 - tolerance) and old - new > slack
+        if worse:
+            regressions.append((metric, old, new))
+    # 第一个请求就导入了重量级模块，视为回归
+    for module in results["startup"]["heavy_modules"]:
+        if module not in baseline.get("startup", {}).get("heavy_modules", []):
+            regressions.append((f"heavy_modules.{module}", "not loaded", "loaded"))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], help="传给服务进程的环境变量 KEY=VALUE")
+    parser.add_argument("--output", help="结果写入该文件（可作为基线）")
+    parser.add_argument("--compare", help="与该基线文件对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许变差的比例")
+    args = parser.parse_args()
+
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    for _ in range(args.warmup):
+        run_once(env)
+    samples = []
+    for i in range(args.runs):
+        samples.append(run_once(env))
+        samples[-1]["total_ms"] = samples[-1]["import_ms"] + samples[-1]["first_request_ms"]
+        print(f"run {i + 1}: {json.dumps({k: round(v, 1) for k, v in samples[-1].items() if k.endswith('_ms')})}",
+              file=sys.stderr)
+
+    results = {
+        "revision": git_revision(),
+        "created": int(time.time()),
+        "python": platform.python_version(),
+        "config": {"runs": args.runs, "env": args.env},
+        "startup": summarize(samples),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("warning: baseline was recorded with a different configuration", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for metric, old, new in regressions:
+            print(f"REGRESSION {metric}: {old} -> {new}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
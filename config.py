@@ -0,0 +1,226 @@
+"""应用配置
+
+所有环境变量在 Config.from_env() 中一次性读取并校验，无效的值回退到默认值。
+create_app() 接收一个 Config，测试或基准脚本可用 dataclasses.replace() 覆盖个别字段；
+upstream、image_pipeline、history_window 等模块级配置由 create_app() 调用各自的 configure() 设置。
+"""
+import os
+from dataclasses import dataclass
+
+from upstream_router import parse_keys, parse_routes
+from image_jobs import parse_concurrency
+from history_window import parse_budgets
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, str(default)))
+    except:
+        return default
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, str(default)))
+    except:
+        return default
+
+def _env_bool(name, default):
+    """默认开启的开关只认 0/false/no 为关闭，默认关闭的开关只认 1/true/yes 为开启"""
+    value = os.getenv(name, "").lower()
+    if not value:
+        return default
+    return value not in ("0", "false", "no") if default else value in ("1", "true", "yes")
+
+
+@dataclass(frozen=True)
+class Config:
+    secret_key: str
+    session_lifetime: int
+    max_content_length: int
+    site_password: str
+    # 登录失败次数上限与统计窗口 (秒)
+    max_login_attempts: int
+    login_attempt_window: int
+    # 封禁名单的 JSON 导入/导出文件与 SQLite 数据库
+    security_file: str
+    security_db: str
+    # 抓取 /metrics 用的令牌 (Authorization: Bearer)；未设置时只允许已登录的会话
+    metrics_token: str
+
+    # 上游路由：每个服务商可配置多个 key ("key1,key2@https://endpoint/v1")，未配置时使用单个 key
+    gemini_base_url: str
+    gemini_api_keys: list
+    openai_base_url: str
+    openai_api_keys: list
+    # 每个 key 的并发请求上限；429 未带 Retry-After 时的冷却时间 (秒)
+    gemini_max_inflight: int
+    openai_max_inflight: int
+    upstream_cooldown: float
+    # OpenAI 流式请求附带 stream_options.include_usage（不支持该参数的兼容接口可关闭）
+    openai_stream_usage: bool
+    # 模型名前缀 -> 服务商 ("gemini=gemini,claude=openai")，未匹配的模型走 OpenAI 兼容接口
+    model_routes: list
+    # 上游 HTTP 客户端：每个主机的连接池大小、连接/读取超时 (秒)、连接失败或 429/503 时的重试次数与退避系数
+    upstream_pool_maxsize: int
+    upstream_connect_timeout: float
+    upstream_read_timeout: float
+    upstream_max_retries: int
+    upstream_retry_backoff: float
+
+    # 模型参数
+    system_prompt: str
+    max_output_tokens: int
+    temperature: float
+    # 按 token 预算截取历史前最多考虑的消息条数（只限制查询量，实际长度由预算决定）
+    max_history: int
+    # 按模型名前缀覆盖的 token 预算 ("gemini=32000,gpt-4o=64000")；预算不够时是否先去掉较早消息中的图片
+    history_token_budgets: dict
+    history_drop_images: bool
+
+    # 图片缓存目录与总字节预算，超出后由后台线程按最近访问时间淘汰
+    image_cache_dir: str
+    image_cache_max_bytes: int
+    # 图片索引（引用计数、访问时间）数据库
+    image_index_db: str
+    # 已编码图片的内存缓存上限；流式请求体中不超过 encoded_cache_max_item 的图片使用该缓存
+    encoded_cache_max_bytes: int
+    encoded_cache_max_item: int
+    # 上传图片处理进程池：工作进程数、除执行中任务外最多排队的任务数、单个任务等待超时 (秒)
+    image_workers: int
+    image_queue_depth: int
+    image_task_timeout: int
+
+    # 图片生成：读取超时 (秒)、按模型的并发上限、默认并发与每个模型最多排队数
+    image_gen_read_timeout: float
+    image_gen_concurrency: dict
+    image_gen_default_concurrency: int
+    image_gen_max_queue: int
+    image_job_poll_interval: float
+    image_jobs_db: str
+    # 图片生成结果缓存：保留时间 (秒) 与条数上限
+    image_result_cache: bool
+    image_result_cache_ttl: int
+    image_result_cache_size: int
+    generation_cache_db: str
+
+    # 聊天流回放缓冲区：已结束的流保留时间 (秒)、总内存上限与缓冲区个数上限
+    stream_buffer_ttl: int
+    stream_buffer_max_bytes: int
+    stream_buffer_max_streams: int
+    # 向客户端输出时合并事件的窗口 (秒) 与字节阈值；窗口为 0 时每批事件立即输出
+    sse_flush_interval: float
+    sse_flush_bytes: int
+
+    # 超过保留时间 (秒) 未更新的对话自动删除
+    conversation_retention: int
+    conversations_db: str
+
+    # Gemini 上下文缓存（默认关闭）：保留时间 (秒)、最小 token 数、前缀对齐的消息条数
+    context_cache: bool
+    context_cache_ttl: int
+    context_cache_min_tokens: int
+    context_cache_step: int
+    context_cache_db: str
+
+    # 准入控制：聊天流与图片生成的全局并发上限、每个会话的并发上限、等待队列长度与最长等待时间 (秒)
+    chat_max_inflight: int
+    chat_max_per_session: int
+    chat_max_queue: int
+    admission_max_wait: float
+    image_max_inflight: int
+    image_max_per_session: int
+
+    # 对话标题：缓存条数与保留时间 (秒)、上游并发、请求最长等待时间 (秒)，超时或失败时是否使用本地标题
+    title_cache_size: int
+    title_cache_ttl: int
+    title_max_inflight: int
+    title_wait_timeout: float
+    title_fallback: bool
+
+    @classmethod
+    def from_env(cls):
+        gemini_base_url = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+        openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+        gemini_keys = os.getenv("GEMINI_API_KEYS", "") or os.getenv("GEMINI_API_KEY", "")
+        openai_keys = os.getenv("OPENAI_API_KEYS", "") or os.getenv("OPENAI_API_KEY", "")
+        return cls(
+            secret_key=os.getenv("FLASK_SECRET_KEY", "complex_fixed_secret_key_for_persistence"),
+            session_lifetime=3600 * 24 * 30,
+            max_content_length=50 * 1024 * 1024,  # 最大上传 50MB
+            site_password=os.getenv("SITE_PASSWORD", "lwtlwt123"),
+            max_login_attempts=3,
+            login_attempt_window=_env_int("LOGIN_ATTEMPT_WINDOW", 86400),
+            security_file="logs/security.json",
+            security_db="logs/security.db",
+            metrics_token=os.getenv("METRICS_TOKEN", ""),
+
+            gemini_base_url=gemini_base_url,
+            gemini_api_keys=parse_keys(gemini_keys, gemini_base_url) or [(gemini_base_url, "")],
+            openai_base_url=openai_base_url,
+            openai_api_keys=parse_keys(openai_keys, openai_base_url) or [(openai_base_url, "")],
+            gemini_max_inflight=_env_int("GEMINI_MAX_INFLIGHT", 8),
+            openai_max_inflight=_env_int("OPENAI_MAX_INFLIGHT", 8),
+            upstream_cooldown=_env_float("UPSTREAM_COOLDOWN", 30.0),
+            openai_stream_usage=_env_bool("OPENAI_STREAM_USAGE", True),
+            model_routes=parse_routes(os.getenv("MODEL_ROUTES", "gemini=gemini")),
+            upstream_pool_maxsize=_env_int("UPSTREAM_POOL_MAXSIZE", 32),
+            upstream_connect_timeout=_env_float("UPSTREAM_CONNECT_TIMEOUT", 5.0),
+            upstream_read_timeout=_env_float("UPSTREAM_READ_TIMEOUT", 120.0),
+            upstream_max_retries=_env_int("UPSTREAM_MAX_RETRIES", 2),
+            upstream_retry_backoff=_env_float("UPSTREAM_RETRY_BACKOFF", 0.5),
+
+            system_prompt=os.getenv("SYSTEM_PROMPT", "You are a helpful and friendly family AI assistant."),
+            max_output_tokens=_env_int("MAX_OUTPUT_TOKENS", 8192),
+            temperature=_env_float("TEMPERATURE", 1.0),
+            max_history=_env_int("MAX_HISTORY_MESSAGES", 200),
+            history_token_budgets=parse_budgets(os.getenv("HISTORY_TOKEN_BUDGETS", "")),
+            history_drop_images=_env_bool("HISTORY_DROP_IMAGES", True),
+
+            image_cache_dir="logs/cache_images",
+            image_cache_max_bytes=_env_int("IMAGE_CACHE_MAX_MB", 2048) * 1024 * 1024,
+            image_index_db="logs/image_index.db",
+            encoded_cache_max_bytes=_env_int("ENCODED_CACHE_MAX_MB", 64) * 1024 * 1024,
+            encoded_cache_max_item=1024 * 1024,
+            image_workers=_env_int("IMAGE_WORKERS", min(4, os.cpu_count() or 1)),
+            image_queue_depth=_env_int("IMAGE_QUEUE_DEPTH", 8),
+            image_task_timeout=_env_int("IMAGE_TASK_TIMEOUT", 60),
+
+            image_gen_read_timeout=_env_float("IMAGE_GEN_READ_TIMEOUT", 300.0),
+            image_gen_concurrency=parse_concurrency(os.getenv("IMAGE_GEN_CONCURRENCY", "")),
+            image_gen_default_concurrency=_env_int("IMAGE_GEN_DEFAULT_CONCURRENCY", 2),
+            image_gen_max_queue=_env_int("IMAGE_GEN_MAX_QUEUE", 8),
+            image_job_poll_interval=1.0,
+            image_jobs_db="logs/image_jobs.db",
+            image_result_cache=_env_bool("IMAGE_RESULT_CACHE", True),
+            image_result_cache_ttl=_env_int("IMAGE_RESULT_CACHE_TTL", 86400),
+            image_result_cache_size=_env_int("IMAGE_RESULT_CACHE_SIZE", 512),
+            generation_cache_db="logs/generation_cache.db",
+
+            stream_buffer_ttl=_env_int("STREAM_BUFFER_TTL", 300),
+            stream_buffer_max_bytes=_env_int("STREAM_BUFFER_MAX_MB", 64) * 1024 * 1024,
+            stream_buffer_max_streams=_env_int("STREAM_BUFFER_MAX_STREAMS", 256),
+            sse_flush_interval=_env_float("SSE_FLUSH_MS", 25) / 1000,
+            sse_flush_bytes=_env_int("SSE_FLUSH_BYTES", 4096),
+
+            conversation_retention=_env_int("CONVERSATION_RETENTION_DAYS", 30) * 86400,
+            conversations_db="logs/conversations.db",
+
+            context_cache=_env_bool("GEMINI_CONTEXT_CACHE", False),
+            context_cache_ttl=_env_int("GEMINI_CONTEXT_CACHE_TTL", 900),
+            context_cache_min_tokens=_env_int("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 2048),
+            context_cache_step=_env_int("GEMINI_CONTEXT_CACHE_STEP", 8),
+            context_cache_db="logs/context_cache.db",
+
+            chat_max_inflight=_env_int("CHAT_MAX_INFLIGHT", 16),
+            chat_max_per_session=_env_int("CHAT_MAX_PER_SESSION", 3),
+            chat_max_queue=_env_int("CHAT_MAX_QUEUE", 16),
+            admission_max_wait=_env_float("ADMISSION_MAX_WAIT", 5.0),
+            image_max_inflight=_env_int("IMAGE_MAX_INFLIGHT", 8),
+            image_max_per_session=_env_int("IMAGE_MAX_PER_SESSION", 2),
+
+            title_cache_size=_env_int("TITLE_CACHE_SIZE", 1024),
+            title_cache_ttl=_env_int("TITLE_CACHE_TTL", 86400),
+            title_max_inflight=_env_int("TITLE_MAX_INFLIGHT", 4),
+            title_wait_timeout=_env_float("TITLE_WAIT_TIMEOUT", 3.0),
+            title_fallback=_env_bool("TITLE_FALLBACK", True),
+        )
@@ -0,0 +1,228 @@
+"""Gemini 上下文缓存 (cachedContents)
+
+长对话中，系统提示词与较早的消息（含图片）每轮都不变。开启后这段前缀注册为服务商的缓存内容，
+之后的请求只发送新增的后缀与缓存引用，减少上传字节与首 token 延迟。
+
+前缀长度按 step 条消息对齐，多轮对话复用同一缓存，前缀推进时才重新创建；同一前缀第二次出现时
+才创建缓存，历史窗口整体前移（每轮前缀都不同）时不会每轮白白上传一次。
+缓存名与过期时间记录在 SQLite 中，所有 worker 共享；缓存只能由创建它的 key 引用，按 endpoint + key
+分别记录。创建失败、模型不支持或缓存失效时调用方回退到完整请求，对客户端透明。
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import upstream
+from history_window import IMAGE_TOKENS, text_tokens
+from request_body import image_identity
+
+logger = logging.getLogger(__name__)
+
+# 缓存剩余时间少于该值 (秒) 时不再使用，避免请求途中过期
+EXPIRY_MARGIN = 30
+# 创建失败后暂停尝试该模型的时间 (秒)
+FAILURE_BACKOFF = 600
+# 续期 TTL 的后台线程数
+EXTEND_WORKERS = 2
+
+
+def estimate_tokens(contents):
+    tokens = 0
+    for content in contents:
+        for part in content.get("parts", []):
+            if "text" in part:
+                tokens += text_tokens(part["text"])
+            elif "inlineData" in part:
+                tokens += IMAGE_TOKENS["gemini"]
+    return tokens
+
+
+class ContextCache:
+
+    def __init__(self, db_path, make_body, ttl=900, min_tokens=2048, step=8):
+        self.db_path = db_path
+        # make_body(payload) 构造流式请求体（图片在发送时编码）
+        self.make_body = make_body
+        self.ttl = ttl
+        # 服务商对缓存内容有最小 token 数要求，估算不足时不创建
+        self.min_tokens = min_tokens
+        self.step = step
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failures = 0
+        self._disabled_until = {}
+        self._local = threading.local()
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # 正在续期的缓存 key：同一缓存同时只续期一次
+        self._extending = set()
+        self._extend_executor = ThreadPoolExecutor(max_workers=EXTEND_WORKERS, thread_name_prefix="context-cache-ttl")
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS caches (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                name TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sightings (
+                key TEXT PRIMARY KEY,
+                seen REAL NOT NULL
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def prefix_length(self, system_instruction, contents):
+        """可缓存的前缀条数：按 step 对齐且至少留下最后一条；估算 token 不足时返回 0"""
+        length = (len(contents) - 1) // self.step * self.step
+        if length <= 0:
+            return 0
+        tokens = estimate_tokens([system_instruction]) + estimate_tokens(contents[:length])
+        return length if tokens >= self.min_tokens else 0
+
+    @staticmethod
+    def prefix_key(endpoint, model, system_instruction, prefix):
+        text = json.dumps([endpoint, model, system_instruction, prefix], default=image_identity, sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, model, system_instruction, contents, base_url, api_key):
+        """返回 (缓存名, 前缀条数, key)；不可用时返回 None，调用方发送完整请求"""
+        now = time.time()
+        endpoint = (base_url, hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16])
+        if self._disabled_until.get((endpoint, model), 0) > now:
+            return None
+        length = self.prefix_length(system_instruction, contents)
+        if not length:
+            return None
+        key = self.prefix_key(endpoint, model, system_instruction, contents[:length])
+
+        row = self._lookup(key, now)
+        if row is None and not self._seen_before(key, now):
+            return None
+        if row is None:
+            # 同一前缀只创建一次，并发的请求等待创建结果
+            try:
+                with self._lock_for(key):
+                    row = self._lookup(key, now)
+                    if row is None:
+                        self.misses += 1
+                        name = self._create(key, model, system_instruction, contents[:length], base_url, api_key)
+                        if name is None:
+                            self._disabled_until[(endpoint, model)] = time.time() + FAILURE_BACKOFF
+                        return (name, length, key) if name else None
+            finally:
+                with self._locks_lock:
+                    self._locks.pop(key, None)
+
+        self.hits += 1
+        name, expires = row
+        if expires - now < self.ttl / 2:
+            with self._locks_lock:
+                extending = key in self._extending
+                self._extending.add(key)
+            if not extending:
+                self._extend_executor.submit(self._extend, key, name, base_url, api_key)
+        return name, length, key
+
+    def _lookup(self, key, now):
+        row = self._conn().execute("SELECT name, expires FROM caches WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] - now < EXPIRY_MARGIN:
+            return None
+        return row
+
+    def _seen_before(self, key, now):
+        """记录一次前缀出现；返回此前 TTL 内是否出现过"""
+        conn = self._conn()
+        row = conn.execute("SELECT seen FROM sightings WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[0] > self.ttl:
+            conn.execute("INSERT OR REPLACE INTO sightings (key, seen) VALUES (?, ?)", (key, now))
+            return False
+        return True
+
+    def _create(self, key, model, system_instruction, prefix, base_url, api_key):
+        payload = {
+            "model": f"models/{model}",
+            "systemInstruction": system_instruction,
+            "contents": prefix,
+            "ttl": f"{self.ttl}s",
+        }
+        try:
+            resp = upstream.post(
+                f"{base_url}/cachedContents?key={api_key}",
+                data=self.make_body(payload), headers={"Content-Type": "application/json"},
+            )
+            if resp.status_code != 200:
+                raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            name = resp.json()["name"]
+        except Exception as e:
+            # 模型不支持缓存、内容过短等：一段时间内直接发送完整请求
+            logger.warning("Context cache creation failed", extra={"model": model, "error": str(e)})
+            self.failures += 1
+            return None
+
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO caches (key, model, name, tokens, expires, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, name, estimate_tokens(prefix), now + self.ttl, now),
+        )
+        self.created += 1
+        self.prune()
+        return name
+
+    def _extend(self, key, name, base_url, api_key):
+        """仍在使用的缓存延长 TTL"""
+        try:
+            resp = upstream.request(
+                "PATCH", f"{base_url}/{name}?key={api_key}&updateMask=ttl",
+                json={"ttl": f"{self.ttl}s"},
+            )
+            if resp.status_code == 200:
+                self._conn().execute(
+                    "UPDATE caches SET expires = ? WHERE key = ?", (time.time() + self.ttl, key))
+            elif resp.status_code == 404:
+                self.invalidate(key)
+        except Exception as e:
+            logger.warning("Context cache TTL update failed", extra={"cache": name, "error": str(e)})
+        finally:
+            with self._locks_lock:
+                self._extending.discard(key)
+
+    def invalidate(self, key):
+        """服务商拒绝了缓存引用（已过期或被删除）"""
+        self._conn().execute("DELETE FROM caches WHERE key = ?", (key,))
+
+    def prune(self):
+        now = time.time()
+        self._conn().execute("DELETE FROM caches WHERE expires < ?", (now,))
+        self._conn().execute("DELETE FROM sightings WHERE seen < ?", (now - self.ttl,))
+
+    def stats(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM caches WHERE expires > ?", (time.time(),)).fetchone()
+        return {
+            "entries": row[0],
+            "tokens": row[1],
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "failures": self.failures,
+        }
@@ -0,0 +1,233 @@
+"""服务端对话存储
+
+对话与消息保存在 SQLite 中，按浏览器生成的 client id 区分（与原先 localStorage 按设备隔离一致）。
+客户端只提交增量：base_seq 之前的消息保持不变，之后的由本次提交的消息替换，
+编辑/重新生成时从被修改的位置截断即可。聊天接口据此在服务端拼出历史，请求只需带新消息。
+每条消息写入时同时保存 token 估算，截取历史窗口时只需读取这两列。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from history_window import message_cost
+
+
+class ConversationConflict(Exception):
+    """客户端声明的历史长度与服务端不一致（增量尚未同步或已被其他页面修改）"""
+
+
+def message_text(message):
+    """消息中的纯文本，用于搜索"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(item.get("text", "") for item in content if item.get("type") == "text")
+    return ""
+
+
+class ConversationStore:
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_db()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                owner TEXT NOT NULL,
+                id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (owner, id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(owner, updated);
+            CREATE TABLE IF NOT EXISTS messages (
+                owner TEXT NOT NULL,
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                data TEXT NOT NULL,
+                text TEXT NOT NULL,
+                text_tokens INTEGER NOT NULL,
+                images INTEGER NOT NULL,
+                PRIMARY KEY (owner, conversation_id, seq)
+            );
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _meta(row):
+        return {"id": row[0], "title": row[1], "created": row[2], "updated": row[3], "message_count": row[4]}
+
+    # --- 对话 ---
+
+    def list(self, owner, limit=50, before=None):
+        """按最近更新时间倒序分页；before 为上一页最后一条的 updated，返回 (对话列表, 下一页游标)"""
+        rows = self._conn().execute(
+            "SELECT id, title, created, updated, message_count FROM conversations "
+            "WHERE owner = ? AND updated < ? ORDER BY updated DESC LIMIT ?",
+            (owner, before if before is not None else float("inf"), limit + 1),
+        ).fetchall()
+        items = [self._meta(row) for row in rows[:limit]]
+        return items, (items[-1]["updated"] if len(rows) > limit else None)
+
+    def get(self, owner, conversation_id):
+        row = self._conn().execute(
+            "SELECT id, title, created, updated, message_count FROM conversations WHERE owner = ? AND id = ?",
+            (owner, conversation_id),
+        ).fetchone()
+        return self._meta(row) if row else None
+
+    def upsert(self, owner, conversation_id, title=None, timestamp=None):
+        """创建对话或修改标题；timestamp 仅在导入旧记录时指定，作为其创建与更新时间"""
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO conversations (owner, id, title, created, updated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(owner, id) DO UPDATE SET title = COALESCE(?, title), updated = COALESCE(?, updated)",
+            (owner, conversation_id, title or "New Chat", timestamp or now, timestamp or now, title, timestamp),
+        )
+        return self.get(owner, conversation_id)
+
+    def delete(self, owner, conversation_id):
+        """删除对话，返回其消息（供调用方释放引用的图片）"""
+        with self._transaction() as conn:
+            messages = [json.loads(row[0]) for row in conn.execute(
+                "SELECT data FROM messages WHERE owner = ? AND conversation_id = ?", (owner, conversation_id))]
+            conn.execute("DELETE FROM messages WHERE owner = ? AND conversation_id = ?", (owner, conversation_id))
+            deleted = conn.execute(
+                "DELETE FROM conversations WHERE owner = ? AND id = ?", (owner, conversation_id)).rowcount
+        return messages if deleted else None
+
+    def prune(self, max_age):
+        """删除超过 max_age 秒未更新的对话，返回被删除的消息"""
+        cutoff = time.time() - max_age
+        with self._transaction() as conn:
+            expired = conn.execute("SELECT owner, id FROM conversations WHERE updated < ?", (cutoff,)).fetchall()
+            messages = []
+            for owner, conversation_id in expired:
+                messages.extend(json.loads(row[0]) for row in conn.execute(
+                    "SELECT data FROM messages WHERE owner = ? AND conversation_id = ?", (owner, conversation_id)))
+                conn.execute("DELETE FROM messages WHERE owner = ? AND conversation_id = ?", (owner, conversation_id))
+            conn.execute("DELETE FROM conversations WHERE updated < ?", (cutoff,))
+        return messages
+
+    def search(self, owner, query, limit=50):
+        """在标题与消息文本中查找，返回 [(对话, 命中的消息文本或 None)]"""
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conn = self._conn()
+        results = []
+        for row in conn.execute(
+            "SELECT id, title, created, updated, message_count FROM conversations WHERE owner = ? "
+            "ORDER BY updated DESC", (owner,)
+        ):
+            match = conn.execute(
+                "SELECT text FROM messages WHERE owner = ? AND conversation_id = ? AND text LIKE ? ESCAPE '\\' "
+                "ORDER BY seq LIMIT 1", (owner, row[0], pattern),
+            ).fetchone()
+            if match or query.lower() in row[1].lower():
+                results.append((self._meta(row), match[0] if match else None))
+                if len(results) >= limit:
+                    break
+        return results
+
+    # --- 消息 ---
+
+    def messages(self, owner, conversation_id, after=-1, limit=100):
+        """返回 seq > after 的至多 limit 条消息及下一页游标"""
+        rows = self._conn().execute(
+            "SELECT seq, data FROM messages WHERE owner = ? AND conversation_id = ? AND seq > ? "
+            "ORDER BY seq LIMIT ?", (owner, conversation_id, after, limit + 1),
+        ).fetchall()
+        messages = [json.loads(row[1]) for row in rows[:limit]]
+        return messages, (rows[limit - 1][0] if len(rows) > limit else None)
+
+    def costs(self, owner, conversation_id, end, limit):
+        """seq < end 的最后 limit 条消息的 (文本 token, 图片张数)，从新到旧；
+        服务端不足 end 条时抛出 ConversationConflict"""
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT message_count FROM conversations WHERE owner = ? AND id = ?", (owner, conversation_id)).fetchone()
+        if end > (row[0] if row else 0):
+            raise ConversationConflict("Conversation history is out of sync")
+        if limit <= 0:
+            return []
+        return conn.execute(
+            "SELECT text_tokens, images FROM messages WHERE owner = ? AND conversation_id = ? AND seq < ? "
+            "ORDER BY seq DESC LIMIT ?", (owner, conversation_id, end, limit),
+        ).fetchall()
+
+    def load(self, owner, conversation_id, start, end):
+        """seq 在 [start, end) 之间的消息（按顺序）"""
+        rows = self._conn().execute(
+            "SELECT data FROM messages WHERE owner = ? AND conversation_id = ? AND seq >= ? AND seq < ? "
+            "ORDER BY seq", (owner, conversation_id, start, end),
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def append(self, owner, conversation_id, base_seq, messages):
+        """丢弃 seq >= base_seq 的旧消息并追加 messages，返回 (对话的消息总数, 被替换的旧消息)
+
+        被替换的消息供调用方释放引用的图片。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO conversations (owner, id, title, created, updated) "
+                "VALUES (?, ?, 'New Chat', ?, ?)", (owner, conversation_id, now, now))
+            count = conn.execute(
+                "SELECT message_count FROM conversations WHERE owner = ? AND id = ?",
+                (owner, conversation_id)).fetchone()[0]
+            if base_seq > count:
+                raise ConversationConflict("Conversation history is out of sync")
+            removed = [json.loads(row[0]) for row in conn.execute(
+                "SELECT data FROM messages WHERE owner = ? AND conversation_id = ? AND seq >= ? ORDER BY seq",
+                (owner, conversation_id, base_seq))]
+            conn.execute(
+                "DELETE FROM messages WHERE owner = ? AND conversation_id = ? AND seq >= ?",
+                (owner, conversation_id, base_seq))
+            conn.executemany(
+                "INSERT INTO messages (owner, conversation_id, seq, role, data, text, text_tokens, images) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(owner, conversation_id, base_seq + i, m.get("role", ""),
+                  json.dumps(m, ensure_ascii=False), message_text(m), *message_cost(m))
+                 for i, m in enumerate(messages)],
+            )
+            count = base_seq + len(messages)
+            conn.execute(
+                "UPDATE conversations SET message_count = ?, updated = ? WHERE owner = ? AND id = ?",
+                (count, now, owner, conversation_id))
+        return count, removed
+
+    def stats(self):
+        conn = self._conn()
+        return {
+            "conversations": conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0],
+            "messages": conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+        }
@@ -0,0 +1,162 @@
+"""图片生成结果缓存
+
+断线重试、重复点击时常会用相同的提示词与输入图片再次生成。结果按请求内容的哈希缓存：
+gemini_contents（文本、输入图片的内容哈希与签名）加上模型与生成参数。命中时直接返回已保存的图片与签名 URL；
+相同内容正在生成时复用该任务，不再请求上游。客户端带 fresh=true 时跳过缓存，生成新的变体。
+
+记录保存在 SQLite 中，所有 worker 共享；超过 TTL 或条数上限时按最近使用时间淘汰。
+结果引用的图片本身仍由图片缓存管理，被淘汰后对应的记录在读取时失效。
+命中缓存或复用任务的请求同样会把图片放进对话，调用方需为每个这样的请求增加一次图片引用：
+复用任务的请求数记在 pending.waiters 中，任务完成时由 finish_pending() 取出。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from request_body import image_identity
+
+# 进行中任务记录的保留时间 (秒)，超过时任务早已结束
+PENDING_RETENTION = 3600
+
+
+def _normalize(obj):
+    """去掉文本首尾空白、合并连续空白，使仅有空白差异的提示词命中同一结果"""
+    if isinstance(obj, str):
+        return " ".join(obj.split())
+    if isinstance(obj, list):
+        return [_normalize(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: _normalize(v) for k, v in obj.items()}
+    return obj
+
+
+def generation_key(model, contents, config):
+    text = json.dumps([model, _normalize(contents), config], default=image_identity, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+
+    def __init__(self, db_path, ttl=86400, max_entries=512):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+        self._local = threading.local()
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_hit REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_results_last_hit ON results(last_hit);
+            CREATE TABLE IF NOT EXISTS pending (
+                key TEXT PRIMARY KEY,
+                job_id TEXT NOT NULL,
+                created REAL NOT NULL,
+                waiters INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, is_valid=None):
+        """返回缓存的结果；不存在、已过期或 is_valid(result) 为假时返回 None"""
+        now = time.time()
+        row = self._conn().execute("SELECT result, created FROM results WHERE key = ?", (key,)).fetchone()
+        result = json.loads(row[0]) if row is not None and now - row[1] < self.ttl else None
+        if result is not None and is_valid is not None and not is_valid(result):
+            result = None
+        if result is None:
+            if row is not None:
+                self.invalidate(key)
+            self.misses += 1
+            return None
+        self._conn().execute("UPDATE results SET last_hit = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO results (key, result, created, last_hit) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(result), now, now),
+        )
+        conn.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+        conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_hit DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def record_bypass(self):
+        """客户端要求生成新的变体 (fresh)，未查询缓存"""
+        self.bypassed += 1
+
+    def record_coalesced(self):
+        """复用了相同内容正在进行的生成任务"""
+        self.coalesced += 1
+
+    def invalidate(self, key):
+        self._conn().execute("DELETE FROM results WHERE key = ?", (key,))
+
+    # --- 进行中的生成 ---
+
+    def pending_job(self, key):
+        """key 最近一次提交的生成任务 id"""
+        row = self._conn().execute("SELECT job_id FROM pending WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_pending(self, key, job_id):
+        """记录 key 对应的生成任务；任务是否仍在进行由调用方按任务状态判断，记录只按时间清理"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO pending (key, job_id, created) VALUES (?, ?, ?)", (key, job_id, now))
+        conn.execute("DELETE FROM pending WHERE created < ?", (now - PENDING_RETENTION,))
+
+    def add_waiter(self, key, job_id):
+        """登记一个复用 job_id 的请求；任务已结束（刚好完成）时返回 False"""
+        cursor = self._conn().execute(
+            "UPDATE pending SET waiters = waiters + 1 WHERE key = ? AND job_id = ? AND done = 0", (key, job_id))
+        return cursor.rowcount > 0
+
+    def finish_pending(self, key):
+        """任务完成：标记 key 的记录已结束，返回复用该任务的请求数"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT waiters FROM pending WHERE key = ? AND done = 0", (key,)).fetchone()
+            conn.execute("UPDATE pending SET done = 1 WHERE key = ?", (key,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if row else 0
+
+    def stats(self):
+        row = self._conn().execute("SELECT COUNT(*) FROM results").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": row[0],
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "bypassed": self.bypassed,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,137 @@
+"""按 token 预算截取聊天历史
+
+每条消息的 token 数按文本与图片估算（不需要真正的分词器，只需量级正确），
+从最新的消息往前保留，直到达到目标模型的预算；预算不够时先去掉较早消息中的图片，
+再丢弃更早的消息。文本估算按字符串缓存，对话存储中的消息还会把估算结果随消息保存。
+"""
+from functools import lru_cache
+
+# 输入的 token 预算：按模型名前缀匹配，最长的前缀优先；
+# 包含系统提示词，调用方先扣除实际发送的系统提示词再用剩余部分截取历史
+DEFAULT_MODEL_BUDGETS = {
+    "gemini-3": 64000,
+    "gemini": 32000,
+    "gpt-4o": 32000,
+    "gpt-4": 16000,
+    "gpt-3.5": 12000,
+}
+DEFAULT_BUDGET = 16000
+
+# 每张图片的估算 token 数，按发送给模型的派生图尺寸 (image_pipeline.LLM_PROFILES) 取上限
+IMAGE_TOKENS = {
+    "gemini": 1032,   # 1536x1536 → 4 个 768 切片 x 258
+    "openai": 1445,   # 2048x768 → 85 + 8 个 512 切片 x 170
+}
+# 每条消息的格式开销
+MESSAGE_OVERHEAD = 4
+
+# 被去掉图片后内容为空的消息用这段文本占位，让模型知道这里曾有图片
+IMAGE_PLACEHOLDER = "[image omitted]"
+
+
+def parse_budgets(spec):
+    """解析 "model-prefix=tokens,..." 形式的预算配置"""
+    budgets = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        prefix, _, value = item.partition("=")
+        try:
+            budgets[prefix.strip().lower()] = max(1, int(value))
+        except ValueError:
+            continue
+    return budgets
+
+
+# 由 create_app() 调用 configure() 按 Config 覆盖
+MODEL_BUDGETS = dict(DEFAULT_MODEL_BUDGETS)
+DROP_IMAGES_FIRST = True
+
+
+def configure(config):
+    """按应用配置设置各模型的预算（覆盖默认值）与是否先去掉图片"""
+    global MODEL_BUDGETS, DROP_IMAGES_FIRST
+    MODEL_BUDGETS = {**DEFAULT_MODEL_BUDGETS, **config.history_token_budgets}
+    DROP_IMAGES_FIRST = config.history_drop_images
+
+
+def model_budget(model):
+    model = model.lower()
+    matches = [prefix for prefix in MODEL_BUDGETS if model.startswith(prefix)]
+    return MODEL_BUDGETS[max(matches, key=len)] if matches else DEFAULT_BUDGET
+
+
+@lru_cache(maxsize=8192)
+def text_tokens(text):
+    """约 4 个 ASCII 字符一个 token，CJK 等多字节字符约每字一个 token"""
+    encoded = len(text.encode("utf-8"))
+    # UTF-8 中多字节字符大多为 3 字节：多出的字节数 / 2 即为其个数
+    wide = (encoded - len(text)) // 2
+    return wide + (len(text) - wide + 3) // 4
+
+
+def message_cost(message):
+    """返回 (文本 token 数, 图片张数)"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD + text_tokens(content), 0
+    tokens, images = MESSAGE_OVERHEAD, 0
+    for item in content or []:
+        if item.get("type") == "image_url":
+            images += 1
+        elif item.get("type") == "text":
+            tokens += text_tokens(item.get("text", ""))
+    return tokens, images
+
+
+def strip_images(message):
+    content = message.get("content")
+    if not isinstance(content, list):
+        return message
+    kept = [item for item in content if item.get("type") != "image_url"]
+    return {**message, "content": kept or [{"type": "text", "text": IMAGE_PLACEHOLDER}]}
+
+
+class HistoryWindow:
+    """截取结果：保留最新的 kept 条消息，其中最新的 full 条保留图片"""
+
+    def __init__(self, kept, full, considered, images_dropped, tokens, budget):
+        self.kept = kept
+        self.full = full
+        self.considered = considered
+        self.images_dropped = images_dropped
+        self.tokens = tokens
+        self.budget = budget
+
+    def apply(self, messages):
+        """messages 为按时间顺序排列的最新 kept 条消息"""
+        text_only = len(messages) - self.full
+        return [strip_images(m) if i < text_only else m for i, m in enumerate(messages)]
+
+    def header(self):
+        """X-History-Window 响应头"""
+        return (f"kept={self.kept}; dropped={self.considered - self.kept}; "
+                f"images_dropped={self.images_dropped}; tokens={self.tokens}; budget={self.budget}")
+
+
+def select(costs, budget, image_tokens, drop_images=None):
+    """costs 为从新到旧的 [(文本 token, 图片张数)]；最新一条总是保留
+
+    drop_images 未指定时使用配置的 DROP_IMAGES_FIRST。
+    """
+    if drop_images is None:
+        drop_images = DROP_IMAGES_FIRST
+    used = kept = full = images_dropped = 0
+    for text, images in costs:
+        cost = text + images * image_tokens
+        if kept == full and (used + cost <= budget or kept == 0):
+            full += 1
+        elif drop_images and used + text <= budget:
+            # 放不下完整消息：这条及更早的消息都只保留文本
+            cost = text
+            images_dropped += images
+        else:
+            break
+        used += cost
+        kept += 1
+    return HistoryWindow(kept, full, len(costs), images_dropped, used, budget)
@@ -0,0 +1,193 @@
+"""图片生成后台任务队列
+
+提交后立即返回任务 id，生成在按模型划分的有界线程池中执行，与请求连接解耦；
+任务状态与结果记录在 SQLite 中，任意 worker 进程都能查询（轮询或 SSE）。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+TERMINAL_STATUSES = ("done", "error")
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """该模型的排队任务已达上限"""
+
+
+class JobError(Exception):
+    """任务失败；message 与 status_code 会原样返回给客户端"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def parse_concurrency(spec):
+    """解析 "model-a=2,model-b=1" 形式的并发配置"""
+    limits = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        model, _, value = item.partition("=")
+        try:
+            limits[model.strip()] = max(1, int(value))
+        except ValueError:
+            continue
+    return limits
+
+
+class ImageJobQueue:
+
+    def __init__(self, db_path, concurrency, default_concurrency=2, max_queue=8, ttl=3600):
+        self.db_path = db_path
+        self.concurrency = concurrency
+        self.default_concurrency = default_concurrency
+        # 每个模型除正在执行外最多排队的任务数
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._pending = {}
+        self._futures = {}
+        self._pid = os.getpid()
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                status_code INTEGER,
+                pid INTEGER NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _executor(self, model):
+        # fork 后线程池不可用，按进程重建
+        if self._pid != os.getpid():
+            self._executors, self._pending, self._futures = {}, {}, {}
+            self._pid = os.getpid()
+        executor = self._executors.get(model)
+        if executor is None:
+            limit = self.concurrency.get(model, self.default_concurrency)
+            executor = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"image-job-{model}")
+            self._executors[model] = executor
+        return executor
+
+    def _update(self, job_id, **fields):
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        self._conn().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def submit(self, model, fn, *args):
+        """提交任务 fn(*args)，返回任务 id；队列已满时抛出 QueueFull"""
+        with self._lock:
+            executor = self._executor(model)
+            limit = self.concurrency.get(model, self.default_concurrency)
+            if self._pending.get(model, 0) >= limit + self.max_queue:
+                raise QueueFull(f"Too many image generations in progress for {model}")
+            self._pending[model] = self._pending.get(model, 0) + 1
+
+        self.prune()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO jobs (id, model, status, pid, created, updated) VALUES (?, ?, 'queued', ?, ?, ?)",
+            (job_id, model, os.getpid(), now, now),
+        )
+        with self._lock:
+            # 持锁登记，保证 _run 结束时的清理发生在登记之后
+            self._futures[job_id] = executor.submit(self._run, job_id, model, fn, args)
+        return job_id
+
+    def _run(self, job_id, model, fn, args):
+        try:
+            self._update(job_id, status="running")
+            result = fn(*args)
+            self._update(job_id, status="done", result=json.dumps(result), status_code=200)
+        except JobError as e:
+            self._update(job_id, status="error", error=e.message, status_code=e.status_code)
+        except Exception as e:
+            logger.warning("Image job failed", extra={"job": job_id, "model": model, "error": str(e)})
+            self._update(job_id, status="error", error=str(e), status_code=500)
+        finally:
+            with self._lock:
+                self._pending[model] -= 1
+                self._futures.pop(job_id, None)
+
+    def wait(self, job_id, timeout=None, poll_interval=1.0):
+        """等待任务结束并返回其状态；其他进程提交的任务按 poll_interval 轮询"""
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout=timeout)
+            return self.get(job_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in TERMINAL_STATUSES:
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                return job
+            time.sleep(poll_interval)
+
+    def get(self, job_id):
+        row = self._conn().execute(
+            "SELECT id, model, status, result, error, status_code, pid, created, updated FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, result, error, status_code = row[2], row[3], row[4], row[5]
+        if status not in TERMINAL_STATUSES and not _pid_alive(row[6]):
+            # 执行任务的进程已退出（重启/崩溃），任务不会再完成
+            status, error, status_code = "error", "Job interrupted", 500
+            self._update(job_id, status=status, error=error, status_code=status_code)
+
+        job = {"id": row[0], "model": row[1], "status": status, "created": row[7], "updated": row[8]}
+        if status == "done":
+            job["result"] = json.loads(result)
+        elif status == "error":
+            job["error"] = {"message": error}
+            job["status_code"] = status_code
+        return job
+
+    def prune(self):
+        """删除超过保留时间的已结束任务"""
+        self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'error') AND updated < ?", (time.time() - self.ttl,))
+
+    def stats(self):
+        with self._lock:
+            return {"pending": dict(self._pending)}
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
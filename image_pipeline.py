@@ -0,0 +1,193 @@
+"""上传图片处理流水线
+
+解码、缩放、重新编码都在独立的进程池中执行，不占用请求线程的 GIL；
+排队任务数有上限，超出时抛出 PipelineBusy，由调用方返回 503。
+各阶段耗时在工作进程中测量，随结果返回给请求进程记录。
+进程数、队列长度与超时由 create_app() 调用 configure() 按 Config 设置。
+"""
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+
+IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+# 除正在执行的任务外，最多允许排队的任务数
+IMAGE_QUEUE_DEPTH = 8
+IMAGE_TASK_TIMEOUT = 60
+
+PASSTHROUGH_EXTS = ['.jpg', '.jpeg', '.png', '.webp', '.gif']
+MAX_PASSTHROUGH_BYTES = 5 * 1024 * 1024
+MAX_PASSTHROUGH_PIXELS = 1e7
+MAX_EDGE = 1920
+
+# 发送给模型的派生图：profile -> (长边上限, 短边上限)
+# 模型端本身会缩小大图，原图只需给浏览器展示；原图已足够小时不生成派生图
+LLM_PROFILES = {
+    "gemini": (1536, 1536),
+    "openai": (2048, 768),
+}
+DERIVATIVE_QUALITY = 80
+DERIVATIVE_MIN_BYTES = 256 * 1024
+
+
+def derivative_name(filename, profile):
+    """原图文件名对应的派生图文件名，与原图同一 stem，淘汰时一起删除"""
+    return f"{filename.split('.')[0]}.{profile}.jpg"
+
+
+class PipelineBusy(Exception):
+    """处理队列已满"""
+
+
+# --- 在工作进程中执行 ---
+
+_codecs_ready = False
+
+def _ensure_codecs():
+    """按需导入 Pillow 并注册 HEIF 支持，只在真正处理图片的进程中执行一次"""
+    global _codecs_ready
+    if not _codecs_ready:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        _codecs_ready = True
+
+
+def _to_rgb(img):
+    from PIL import Image
+
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        # 透明背景铺白，避免转换后变黑
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+class _Timings(dict):
+    """按阶段累计耗时 (秒)"""
+
+    def add(self, stage, start):
+        self[stage] = self.get(stage, 0.0) + time.perf_counter() - start
+
+
+def make_derivatives(img, source_bytes, timings=None):
+    """按 LLM_PROFILES 生成去除元数据的 JPEG 派生图，返回 {profile: bytes}；不比原图小的不保留"""
+    from PIL import Image
+
+    timings = timings if timings is not None else _Timings()
+    derivatives = {}
+    width, height = img.size
+    for profile, (long_max, short_max) in LLM_PROFILES.items():
+        scale = min(1.0, long_max / max(width, height), short_max / min(width, height))
+        if scale >= 1.0 and source_bytes <= DERIVATIVE_MIN_BYTES:
+            continue
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # 原样保存的图片在这里才真正解码（已解码时 load 不做任何事）
+        start = time.perf_counter()
+        img.load()
+        timings.add("decode", start)
+        start = time.perf_counter()
+        resized = img if target == img.size else img.resize(target, Image.LANCZOS)
+        timings.add("resize", start)
+        start = time.perf_counter()
+        out = io.BytesIO()
+        _to_rgb(resized).save(out, "JPEG", quality=DERIVATIVE_QUALITY, optimize=True)
+        timings.add("encode", start)
+        if out.tell() < source_bytes:
+            derivatives[profile] = out.getvalue()
+    return derivatives
+
+
+def convert_upload(data, original_ext):
+    """处理上传的原始字节，返回 (扩展名, 新字节, 派生图, 信息)；新字节为 None 表示原样保存
+
+    信息包含原图尺寸/模式、是否转换与缩放，以及 decode/resize/encode 各阶段耗时。
+    """
+    _ensure_codecs()
+    from PIL import Image
+
+    timings = _Timings()
+    needs_conversion = original_ext not in PASSTHROUGH_EXTS
+    ext = '.jpg' if needs_conversion else original_ext
+
+    with Image.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        needs_resize = len(data) > MAX_PASSTHROUGH_BYTES or width * height > MAX_PASSTHROUGH_PIXELS
+        info = {"size": img.size, "mode": img.mode, "converted": needs_conversion, "resized": needs_resize,
+                "timings": timings}
+        if not needs_conversion and not needs_resize:
+            return ext, None, make_derivatives(img, len(data), timings), info
+
+        if needs_resize and img.format == 'JPEG':
+            # JPEG 可在解码时直接按 1/2、1/4、1/8 缩小，避免解码全分辨率
+            img.draft('RGB', (MAX_EDGE, MAX_EDGE))
+        start = time.perf_counter()
+        img.load()
+        timings.add("decode", start)
+
+        if needs_resize:
+            start = time.perf_counter()
+            img.thumbnail((MAX_EDGE, MAX_EDGE))
+            timings.add("resize", start)
+
+        start = time.perf_counter()
+        # 转换颜色模式（HEIC 可能有 RGBA 或其他模式）
+        if img.mode not in ("RGB",):
+            img = img.convert("RGB")
+
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=85)
+        timings.add("encode", start)
+        info["output_size"] = img.size
+        return '.jpg', out.getvalue(), make_derivatives(img, out.tell(), timings), info
+
+
+# --- 在请求进程中执行 ---
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(IMAGE_WORKERS + IMAGE_QUEUE_DEPTH)
+
+
+def configure(config):
+    """按应用配置设置进程数、队列长度与超时；应在提交第一个任务前调用"""
+    global IMAGE_WORKERS, IMAGE_QUEUE_DEPTH, IMAGE_TASK_TIMEOUT, _slots
+    IMAGE_WORKERS = config.image_workers
+    IMAGE_QUEUE_DEPTH = config.image_queue_depth
+    IMAGE_TASK_TIMEOUT = config.image_task_timeout
+    _slots = threading.BoundedSemaphore(IMAGE_WORKERS + IMAGE_QUEUE_DEPTH)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def submit(fn, *args):
+    """在进程池中执行 fn(*args) 并等待结果；队列已满时立即抛出 PipelineBusy"""
+    if not _slots.acquire(blocking=False):
+        raise PipelineBusy("Image pipeline is busy, please retry later")
+    try:
+        future = _get_executor().submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    # 名额在任务真正结束时归还：等待超时后工作进程仍在执行该任务，此时归还会让进程池超出上限
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=IMAGE_TASK_TIMEOUT)
+    except FutureTimeout:
+        # 仍在排队的任务直接取消（取消后同样触发回调归还名额）
+        future.cancel()
+        raise
@@ -0,0 +1,286 @@
+"""图片缓存索引：用 SQLite 记录缓存目录中每个文件的大小与最近访问时间
+
+同名 (同一 stem) 的图片与派生图视为一组，淘汰时整组删除，避免旧对话只剩一半。
+生成图片的 thoughtSignature 按组保存在同一个数据库的 signatures 表中，随组一起淘汰；
+引用方式仍是 /images/cache/<stem>.sig，旧版本留下的 .sig 文件在启动时（或首次读取时）迁移进表中。
+淘汰按总字节预算在后台线程中进行，请求路径只做一次插入或内存中的访问标记。
+
+图片按内容哈希命名，同一内容只存一份；refs 记录被引用的次数，只有引用数为 0 的组会被淘汰，
+仍被对话或结果缓存引用的组即使超出预算也保留。
+上传原始字节的哈希另存一份映射，重复上传可直接复用已处理好的文件。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImageIndex:
+
+    def __init__(self, cache_dir, db_path, max_bytes, interval=60):
+        self.cache_dir = cache_dir
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        # 超出预算时淘汰到预算的 90%，避免每次只删一组
+        self.low_water = int(max_bytes * 0.9)
+        self.interval = interval
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self._local = threading.local()
+        self._pending_touches = {}
+        self._touch_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+        self._init_db()
+
+    # --- SQLite ---
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                grp TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                refs INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE INDEX IF NOT EXISTS idx_files_grp ON files(grp);
+            CREATE TABLE IF NOT EXISTS upload_aliases (
+                src_hash TEXT PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_upload_aliases_name ON upload_aliases(name);
+            CREATE TABLE IF NOT EXISTS signatures (
+                grp TEXT PRIMARY KEY,
+                signature TEXT NOT NULL
+            );
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def group_of(name):
+        # 原图、签名 (.sig) 与派生图 (.<profile>.jpg) 共用第一个 "." 之前的 stem
+        return name.split(".")[0]
+
+    # --- 签名 ---
+
+    def set_signature(self, name, signature):
+        """保存图片 name 的 thoughtSignature"""
+        self._conn().execute(
+            "INSERT OR REPLACE INTO signatures (grp, signature) VALUES (?, ?)", (self.group_of(name), signature))
+
+    def signature(self, name):
+        """按图片或签名文件名 (<stem>.sig) 读取签名；尚未迁移的旧 .sig 文件在此时迁移"""
+        grp = self.group_of(name)
+        row = self._conn().execute("SELECT signature FROM signatures WHERE grp = ?", (grp,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._migrate_signature(f"{grp}.sig")
+
+    def _migrate_signature(self, filename):
+        """把旧版本的 .sig 文件写入签名表并删除文件；文件不存在时返回 None"""
+        path = os.path.join(self.cache_dir, filename)
+        try:
+            with open(path, "r") as f:
+                signature = f.read()
+        except OSError:
+            return None
+        self.set_signature(filename, signature)
+        self._conn().execute("DELETE FROM files WHERE name = ?", (filename,))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return signature
+
+    # --- 请求路径 ---
+
+    def register(self, name, refs=1):
+        """文件写入缓存目录后登记；已存在的文件 (内容相同) 则增加 refs 次引用
+
+        派生图以 refs=0 登记：它们随原图一起被引用与淘汰，对话删除时只释放原图。
+        """
+        try:
+            size = os.path.getsize(os.path.join(self.cache_dir, name))
+        except OSError:
+            return
+        self._conn().execute(
+            "INSERT INTO files (name, grp, size, last_access, refs) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET size = excluded.size, last_access = excluded.last_access, "
+            "refs = refs + excluded.refs",
+            (name, self.group_of(name), size, time.time(), refs),
+        )
+        self._ensure_worker()
+        self._wakeup.set()
+
+    def release(self, name):
+        """释放一次引用（如对话被删除），不立即删除文件"""
+        self._conn().execute("UPDATE files SET refs = MAX(refs - 1, 0) WHERE name = ?", (name,))
+
+    def lookup_upload(self, src_hash):
+        """按上传原始字节的哈希查找已处理好的文件，命中时增加一次引用并返回文件名"""
+        row = self._conn().execute(
+            "SELECT f.name FROM upload_aliases a JOIN files f ON f.name = a.name WHERE a.src_hash = ?",
+            (src_hash,),
+        ).fetchone()
+        if row is None or not os.path.exists(os.path.join(self.cache_dir, row[0])):
+            return None
+        self.register(row[0])
+        return row[0]
+
+    def add_upload_alias(self, src_hash, name):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO upload_aliases (src_hash, name) VALUES (?, ?)", (src_hash, name))
+
+    def touch(self, name):
+        """记录一次访问；只写内存，由后台线程批量落库"""
+        with self._touch_lock:
+            self._pending_touches[self.group_of(name)] = time.time()
+        self._ensure_worker()
+
+    # --- 后台维护 ---
+
+    def _ensure_worker(self):
+        # 按进程启动（gunicorn fork 之后的 worker 需要各自的线程）
+        if self._worker_pid == os.getpid():
+            return
+        with self._worker_lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            threading.Thread(target=self._run, name="image-index", daemon=True).start()
+
+    def _run(self):
+        try:
+            self.reconcile()
+        except Exception:
+            logger.exception("Image index reconcile failed")
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush_touches()
+                self.evict()
+            except Exception:
+                logger.exception("Image index maintenance failed")
+
+    def flush_touches(self):
+        with self._touch_lock:
+            touches, self._pending_touches = self._pending_touches, {}
+        if touches:
+            with self._transaction() as conn:
+                conn.executemany(
+                    "UPDATE files SET last_access = MAX(last_access, ?) WHERE grp = ?",
+                    [(ts, grp) for grp, ts in touches.items()],
+                )
+
+    def reconcile(self):
+        """同步目录与索引：登记未索引的已有文件（含旧版本留下的文件），移除已不存在的记录"""
+        conn = self._conn()
+        known = {row[0] for row in conn.execute("SELECT name FROM files")}
+        present = set()
+        new_rows = []
+        legacy_signatures = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith("temp_"):
+                    continue
+                if entry.name.endswith(".sig"):
+                    legacy_signatures.append(entry.name)
+                    continue
+                present.add(entry.name)
+                if entry.name not in known:
+                    st = entry.stat()
+                    new_rows.append((entry.name, self.group_of(entry.name), st.st_size, st.st_mtime))
+        missing = [(n,) for n in known - present]
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO files (name, grp, size, last_access) VALUES (?, ?, ?, ?)", new_rows)
+            conn.executemany("DELETE FROM files WHERE name = ?", missing)
+            conn.executemany("DELETE FROM upload_aliases WHERE name = ?", missing)
+        for name in legacy_signatures:
+            self._migrate_signature(name)
+        if legacy_signatures:
+            logger.info("Migrated signature files", extra={"count": len(legacy_signatures)})
+        # 图片已不存在的签名
+        self._conn().execute("DELETE FROM signatures WHERE grp NOT IN (SELECT grp FROM files)")
+
+    def total_bytes(self):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    def evict(self):
+        """总大小超出预算时，在无引用的组中按最近访问时间从旧到新整组删除"""
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        with metrics.CACHE_EVICTION.time():
+            self._evict_to_low_water(total)
+
+    def _evict_to_low_water(self, total):
+        conn = self._conn()
+        # 组是否被引用只看原图 (<stem>.<ext>)；reconcile 登记的派生图 refs 可能不为 0
+        groups = conn.execute(
+            "SELECT grp, SUM(size), MAX(last_access) AS la FROM files GROUP BY grp "
+            "HAVING MAX(CASE WHEN instr(substr(name, length(grp) + 2), '.') = 0 THEN refs ELSE 0 END) = 0 "
+            "ORDER BY la ASC"
+        ).fetchall()
+        for grp, size, _ in groups:
+            if total <= self.low_water:
+                break
+            names = [row[0] for row in conn.execute("SELECT name FROM files WHERE grp = ?", (grp,))]
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    logger.warning("Failed to delete evicted image", extra={"file": name, "error": str(e)})
+            with self._transaction() as conn:
+                conn.executemany("DELETE FROM upload_aliases WHERE name = ?", [(n,) for n in names])
+                conn.execute("DELETE FROM files WHERE grp = ?", (grp,))
+                conn.execute("DELETE FROM signatures WHERE grp = ?", (grp,))
+            total -= size
+            self.evicted_files += len(names)
+            self.evicted_bytes += size
+        if total > self.max_bytes:
+            logger.warning("Image cache over budget, remaining images are referenced",
+                           extra={"bytes": total, "max_bytes": self.max_bytes})
+
+    def stats(self):
+        row = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+        signatures = self._conn().execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+        return {
+            "files": row[0],
+            "bytes": row[1],
+            "signatures": signatures,
+            "max_bytes": self.max_bytes,
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+        }
@@ -0,0 +1,197 @@
+"""进程内指标：计数器与直方图，以 Prometheus 文本格式输出 (/metrics)
+
+另外记录每个请求内各阶段的耗时，由 app 在响应中以 Server-Timing 头返回。
+指标按进程统计，多 worker 部署时每个进程分别输出。
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# 延迟类直方图的默认分桶 (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines += self._render_items(items)
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """抓取时调用 fn() 取值；fn 返回 {标签值元组: 数值}"""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def render(self):
+        try:
+            self._values = {tuple(str(v) for v in key): value for key, value in self.fn().items()}
+        except Exception:
+            self._values = {}
+        return super().render()
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}" for key, v in items]
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# --- 请求内的阶段耗时 (Server-Timing) ---
+
+_timings = contextvars.ContextVar("server_timings", default=None)
+
+
+def begin_request():
+    """开始收集当前请求（或其在线程池中的调用）的阶段耗时"""
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+def record(name, seconds):
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage(name, histogram=None, **labels):
+    """记录一个阶段的耗时：写入当前请求的 Server-Timing，并可同时记入直方图"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record(name, elapsed)
+        if histogram is not None:
+            histogram.observe(elapsed, **labels)
+
+
+def server_timing(timings):
+    """Server-Timing 头：同名阶段累加"""
+    totals = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+# --- 指标定义 ---
+
+UPSTREAM_CONNECT = Histogram(
+    "upstream_connect_seconds", "Time until upstream response headers (including failover)", ("provider", "model"))
+TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds", "Time from request arrival to the first streamed event", ("model",))
+STREAM_DURATION = Histogram(
+    "chat_stream_duration_seconds", "Total time from request arrival to the end of the stream", ("model",),
+    buckets=LATENCY_BUCKETS + (300,))
+TOKENS = Counter("chat_tokens_total", "Tokens reported by upstream usage", ("model", "type"))
+RELAYED_BYTES = Counter("chat_relayed_bytes_total", "SSE bytes relayed to clients", ("model",))
+UPSTREAM_ERRORS = Counter("upstream_errors_total", "Failed upstream requests", ("provider", "status"))
+IMAGE_STAGE = Histogram(
+    "image_pipeline_seconds", "Upload pipeline stage timings", ("stage",))
+IMAGE_BASE64 = Histogram(
+    "image_base64_seconds", "Base64 encoding of cached images for LLM requests")
+CACHE_EVICTION = Histogram(
+    "image_cache_eviction_seconds", "Image cache eviction passes that removed files")
+TITLE_REQUESTS = Counter("title_requests_total", "Title requests by source (cache, upstream, fallback, default)", ("source",))
+IMAGE_RESULTS = Counter(
+    "image_result_cache_total", "Image generation requests by result cache outcome (hit, coalesced, miss, bypass)", ("result",))
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to produce response headers", ("endpoint", "method", "status"))
@@ -0,0 +1,130 @@
+"""流式构造上游请求体
+
+消息中的图片以 InlineImage 占位，序列化时才从文件增量 Base64 编码，
+因此每个请求的额外内存只有固定大小的分块，与历史中有多少张图片无关。
+"""
+import base64
+import json
+import os
+import re
+import uuid
+
+# 每次从文件读取的字节数（须为 3 的倍数，保证分块编码结果可直接拼接）
+READ_BLOCK = 48 * 1024
+# 直接发送已缓存字符串时的分块大小
+SEND_BLOCK = 64 * 1024
+
+
+class InlineImage:
+    """请求体中的本地图片占位符；序列化为 prefix + 文件内容的 Base64"""
+
+    def __init__(self, path, mime_type, prefix=""):
+        self.path = path
+        self.mime_type = mime_type
+        self.prefix = prefix
+        self.size = os.path.getsize(path)
+
+    @classmethod
+    def data_url(cls, path, mime_type):
+        """OpenAI 格式：data:<mime>;base64,<data>"""
+        return cls(path, mime_type, f"data:{mime_type};base64,")
+
+    def without_prefix(self):
+        """Gemini inlineData 格式：只有 Base64 数据"""
+        image = InlineImage.__new__(InlineImage)
+        image.path, image.mime_type, image.size, image.prefix = self.path, self.mime_type, self.size, ""
+        return image
+
+    @property
+    def encoded_length(self):
+        return len(self.prefix.encode("utf-8")) + 4 * ((self.size + 2) // 3)
+
+
+def image_identity(obj):
+    """计算缓存键时 json.dumps 的 default：图片文件按内容哈希命名，用文件名与大小代替内容"""
+    if isinstance(obj, InlineImage):
+        return {"file": os.path.basename(obj.path), "size": obj.size, "mime": obj.mime_type}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class StreamingJSONBody:
+    """可重复迭代、已知长度的 JSON 请求体
+
+    requests 会据 __len__ 设置 Content-Length 并逐块发送；每次迭代都从头生成，
+    上游拒绝后重试时也能再次发送。
+    """
+
+    def __init__(self, payload, cached_lookup=None, cache_max_item=0):
+        # cached_lookup(path) 返回已缓存/新编码的 Base64 字符串，仅用于不超过 cache_max_item 的小图
+        self.images = []
+        # 占位符带随机前缀，避免与消息文本中的内容冲突
+        self._nonce = uuid.uuid4().hex
+        self.cached_lookup = cached_lookup
+        self.cache_max_item = cache_max_item
+        text = json.dumps(payload, default=self._placeholder)
+        # 序列化结果按占位符切分为 [文本, 图片序号, 文本, ...]
+        pieces = re.split(r'\\u0000%s:(\d+)\\u0000' % self._nonce, text)
+        self.segments = []
+        for i, piece in enumerate(pieces):
+            if i % 2:
+                self.segments.append(self.images[int(piece)])
+            elif piece:
+                self.segments.append(piece.encode("utf-8"))
+        self.length = sum(len(s) if isinstance(s, bytes) else s.encoded_length for s in self.segments)
+
+    def _placeholder(self, obj):
+        if isinstance(obj, InlineImage):
+            self.images.append(obj)
+            return f"\x00{self._nonce}:{len(self.images) - 1}\x00"
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield from self._iter_image(segment)
+
+    async def aiter_chunks(self):
+        """供 httpx.AsyncClient 使用（需配合手动设置的 Content-Length）
+
+        图片的读取与 Base64 编码逐块在线程池中进行，大图不会阻塞事件循环中的其他流。
+        """
+        # anyio 随 ASGI 模式的依赖安装，同步模式不需要
+        from anyio import to_thread
+
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            blocks = self._iter_image(segment)
+            try:
+                while True:
+                    block = await to_thread.run_sync(next, blocks, None)
+                    if block is None:
+                        break
+                    yield block
+            finally:
+                blocks.close()
+
+    def _iter_image(self, image):
+        if image.prefix:
+            yield image.prefix.encode("utf-8")
+
+        # 小图（如派生图）走已编码缓存，大图直接从文件分块编码
+        if self.cached_lookup is not None and image.size <= self.cache_max_item:
+            encoded = self.cached_lookup(image.path)
+            if encoded is not None:
+                for i in range(0, len(encoded), SEND_BLOCK):
+                    yield encoded[i:i + SEND_BLOCK].encode("ascii")
+                return
+
+        with open(image.path, "rb") as f:
+            while True:
+                block = f.read(READ_BLOCK)
+                if not block:
+                    break
+                yield base64.b64encode(block)
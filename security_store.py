@@ -0,0 +1,144 @@
+"""登录安全数据（黑名单与失败次数）存储
+
+使用 SQLite WAL，多个 gunicorn worker 进程共享同一份数据，每次更新都在事务内原子完成。
+logs/security.json 保留为导入/导出格式：启动时若 JSON 比上次同步更新则导入，封禁变化后导出。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SecurityStore:
+
+    def __init__(self, db_path, json_path, attempt_window):
+        self.db_path = db_path
+        self.json_path = json_path
+        # 失败次数的统计窗口 (秒)，超过窗口后重新计数
+        self.attempt_window = attempt_window
+        self._local = threading.local()
+        self._init_db()
+        try:
+            self.import_json_if_newer()
+        except Exception as e:
+            logger.warning("Failed to import security data", extra={"error": str(e)})
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS blacklist (
+                ip TEXT PRIMARY KEY,
+                banned_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS attempts (
+                ip TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                first_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    def is_banned(self, ip):
+        row = self._conn().execute("SELECT 1 FROM blacklist WHERE ip = ?", (ip,)).fetchone()
+        return row is not None
+
+    def record_failure(self, ip, max_attempts):
+        """记录一次失败登录，返回 (窗口内失败次数, 是否因此被封禁)"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 顺带清理已过期的失败记录
+            conn.execute("DELETE FROM attempts WHERE first_at < ?", (now - self.attempt_window,))
+            row = conn.execute("SELECT count, first_at FROM attempts WHERE ip = ?", (ip,)).fetchone()
+            if row is None or now - row[1] > self.attempt_window:
+                count, first_at = 1, now
+            else:
+                count, first_at = row[0] + 1, row[1]
+
+            banned = count >= max_attempts
+            if banned:
+                conn.execute("INSERT OR IGNORE INTO blacklist (ip, banned_at) VALUES (?, ?)", (ip, now))
+                conn.execute("DELETE FROM attempts WHERE ip = ?", (ip,))
+            else:
+                conn.execute("INSERT OR REPLACE INTO attempts (ip, count, first_at) VALUES (?, ?, ?)",
+                             (ip, count, first_at))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+        if banned:
+            try:
+                self.export_json()
+            except Exception as e:
+                logger.warning("Failed to save security data", extra={"error": str(e)})
+        return count, banned
+
+    def reset_attempts(self, ip):
+        self._conn().execute("DELETE FROM attempts WHERE ip = ?", (ip,))
+
+    # --- JSON 导入/导出 ---
+
+    def to_dict(self):
+        conn = self._conn()
+        return {
+            "blacklist": [row[0] for row in conn.execute("SELECT ip FROM blacklist ORDER BY banned_at")],
+            "attempts": {row[0]: row[1] for row in conn.execute("SELECT ip, count FROM attempts")},
+        }
+
+    def export_json(self):
+        """原子地写出 security.json（先写临时文件再替换）"""
+        tmp_path = f"{self.json_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(tmp_path, self.json_path)
+        self._set_meta("json_mtime", str(os.path.getmtime(self.json_path)))
+
+    def import_json_if_newer(self):
+        """security.json 被手动修改（或首次从旧版本迁移）时，以其黑名单为准导入"""
+        if not os.path.exists(self.json_path):
+            return
+        mtime = os.path.getmtime(self.json_path)
+        synced = self._get_meta("json_mtime")
+        if synced is not None and float(synced) >= mtime:
+            return
+
+        with open(self.json_path, "r") as f:
+            data = json.load(f)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM blacklist")
+            conn.executemany("INSERT OR IGNORE INTO blacklist (ip, banned_at) VALUES (?, ?)",
+                             [(ip, now) for ip in data.get("blacklist", [])])
+            conn.executemany("INSERT OR REPLACE INTO attempts (ip, count, first_at) VALUES (?, ?, ?)",
+                             [(ip, int(n), now) for ip, n in data.get("attempts", {}).items()])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_mtime', ?)", (str(mtime),))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _get_meta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
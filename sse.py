@@ -0,0 +1,216 @@
+"""Server-Sent Events 工具
+
+SSERelay 把上游的文本片段整理为发给客户端的 OpenAI 格式事件：同一次上游读取中连续的纯文本片段
+合并为一个事件，事件信封按每个流预先编码的模板拼接，只需编码文本本身。安装了 orjson 时用它编解码 JSON。
+"""
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    loads = json.loads
+
+
+class SSEDecoder:
+    """增量解析 SSE 字节流：可按任意字节边界喂入，按空行切分事件并返回各事件的 data 内容
+
+    每个字节只扫描一次：未完整的行留在缓冲区等待后续数据，已确认不含换行的部分不再重复查找。
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._data = []
+        # 缓冲区开头已扫描过、不含换行的字节数
+        self._scanned = 0
+
+    def feed(self, data):
+        self._buf += data
+        buf = self._buf
+        events = []
+        start = 0
+        scan = self._scanned
+        while True:
+            nl = buf.find(b"\n", scan)
+            if nl < 0:
+                break
+            line = bytes(buf[start:nl]).rstrip(b"\r")
+            start = scan = nl + 1
+            if not line:
+                # 空行：事件结束
+                if self._data:
+                    events.append("\n".join(self._data))
+                    self._data = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                if value.startswith(b" "):
+                    value = value[1:]
+                self._data.append(value.decode("utf-8"))
+            # 其他字段 (event/id/retry) 与注释行此处不需要
+        del buf[:start]
+        self._scanned = len(buf)
+        return events
+
+    def flush(self):
+        """流结束时取出最后一个未以空行结尾的事件"""
+        events = self.feed(b"\n") if self._buf else []
+        if self._data:
+            events.append("\n".join(self._data))
+            self._data = []
+        return events
+
+
+def format_event(data):
+    """把 data 内容编码为一个 SSE 事件（多行内容拆成多条 data 行）"""
+    return "data: " + data.replace("\n", "\ndata: ") + "\n\n"
+
+
+class ChunkEncoder:
+    """chat.completion.chunk 信封：id/created/model 每个流只编码一次，纯文本事件只需编码文本"""
+
+    def __init__(self, chunk_id, model, created=None):
+        head = dumps({
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(created or time.time()),
+            "model": model,
+        })
+        self._head = head[:-1]
+        self._content_prefix = "data: " + self._head + ',"choices":[{"index":0,"delta":{"content":'
+        self._content_suffix = '},"finish_reason":null}]}\n\n'
+
+    def content(self, text):
+        return self._content_prefix + dumps(text) + self._content_suffix
+
+    def chunk(self, delta, finish_reason=None, usage=None):
+        choice = dumps({"index": 0, "delta": delta, "finish_reason": finish_reason})
+        tail = ',"usage":' + dumps(usage) if usage else ""
+        return "data: " + self._head + ',"choices":[' + choice + "]" + tail + "}\n\n"
+
+
+def _content_only(obj):
+    """OpenAI 格式的块只包含一段文本增量时返回该文本，否则返回 None"""
+    choices = obj.get("choices") if isinstance(obj, dict) else None
+    if not isinstance(choices, list) or len(choices) != 1 or obj.get("usage"):
+        return None
+    choice = choices[0]
+    if choice.get("finish_reason") is not None or choice.get("index", 0) != 0:
+        return None
+    delta = choice.get("delta") or {}
+    content = delta.get("content")
+    if not isinstance(content, str) or any(v is not None for k, v in delta.items() if k != "content"):
+        return None
+    return content
+
+
+class SSERelay:
+    """合并连续的文本片段；每次上游读取后调用 drain() 取出待发送的事件
+
+    add() 接收已转换的增量（Gemini 分支），add_data() 接收 OpenAI 格式的 data 内容（OpenAI 分支）。
+    usage 为流中最后一次出现的用量统计。
+    """
+
+    def __init__(self, encoder=None):
+        # encoder 为 None 时按收到的第一个 OpenAI 块的 id/model/created 创建
+        self.encoder = encoder
+        self._text = []
+        # 只有一段待发送文本时，OpenAI 分支直接转发原始 data，不重新编码
+        self._raw = None
+        self._events = []
+        self.usage = None
+
+    def _flush_text(self):
+        if len(self._text) == 1 and self._raw is not None:
+            self._events.append(format_event(self._raw))
+        elif self._text:
+            self._events.append(self.encoder.content("".join(self._text)))
+        self._text = []
+        self._raw = None
+
+    def add(self, delta, finish_reason=None, usage=None):
+        if usage:
+            self.usage = usage
+        if not finish_reason and not usage and delta.keys() == {"content"}:
+            self._text.append(delta["content"])
+            return
+        if self._text and "content" in delta:
+            # 带签名/结束原因的块：之前的文本并入它的 content，保持顺序
+            delta = {**delta, "content": "".join(self._text) + delta["content"]}
+            self._text = []
+            self._raw = None
+        self._flush_text()
+        self._events.append(self.encoder.chunk(delta, finish_reason, usage))
+
+    def add_data(self, data):
+        obj = None
+        if data != "[DONE]":
+            try:
+                obj = loads(data)
+            except ValueError:
+                pass
+        if isinstance(obj, dict) and obj.get("usage"):
+            self.usage = obj["usage"]
+        if self.encoder is None and isinstance(obj, dict) and obj.get("id"):
+            self.encoder = ChunkEncoder(obj["id"], obj.get("model"), obj.get("created"))
+        content = _content_only(obj) if obj is not None and self.encoder is not None else None
+        if content is not None:
+            self._raw = data if not self._text else None
+            self._text.append(content)
+            return
+        self._flush_text()
+        self._events.append(format_event(data))
+
+    def drain(self):
+        self._flush_text()
+        events, self._events = self._events, []
+        return events
+
+
+def iter_events(chunks, relay=None):
+    """把任意切分的 SSE 字节流按事件边界重新整理为完整事件文本；给出 relay 时合并文本片段"""
+    decoder = SSEDecoder()
+    try:
+        for chunk in chunks:
+            if relay is None:
+                for data in decoder.feed(chunk):
+                    yield format_event(data)
+                continue
+            for data in decoder.feed(chunk):
+                relay.add_data(data)
+            yield from relay.drain()
+        for data in decoder.flush():
+            if relay is None:
+                yield format_event(data)
+            else:
+                relay.add_data(data)
+        if relay is not None:
+            yield from relay.drain()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+async def aiter_events(chunks, relay):
+    """iter_events 的异步版本（ASGI 模式）"""
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for data in decoder.feed(chunk):
+            relay.add_data(data)
+        for event in relay.drain():
+            yield event
+    for data in decoder.flush():
+        relay.add_data(data)
+    for event in relay.drain():
+        yield event
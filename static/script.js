@@ -27,6 +27,20 @@ let currentAbortController = null; // 用于取消流式请求
 let isGenerating = false; // 标记是否正在生成回复
 let currentAiContentDiv = null; // 当前正在生成的AI消息DOM元素
 let currentFullResponse = ''; // 当前已生成的完整响应内容
+let currentStreamId = null; // 当前聊天流 id，断线后用于续传
+let syncedCount = 0; // 当前对话中服务端已保存且未改动的前缀消息数
+let syncQueue = Promise.resolve(); // 增量提交按顺序执行
+
+// 本浏览器的 client id，服务端按它隔离对话记录
+const clientId = localStorage.getItem('client_id') || (() => {
+    const id = Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+    localStorage.setItem('client_id', id);
+    return id;
+})();
+
+function apiHeaders(extra = {}) {
+    return { 'Content-Type': 'application/json', 'X-Client-Id': clientId, ...extra };
+}
 
 // === Lightbox State ===
 const lightbox = document.getElementById('lightbox');
@@ -406,47 +420,86 @@ if (sidebarOverlay) {
 
 // History Management
 
-function loadHistory() {
-    const stored = localStorage.getItem('chat_history');
-    if (stored) {
-        conversations = JSON.parse(stored);
-        // 数据清理：加载时也顺便检查一下是否有过期的
-        cleanOldHistory();
+// 对话保存在服务端；这里只保留列表元数据 {id, title, timestamp}
+function toConversationMeta(conv) {
+    return { id: conv.id, title: conv.title, timestamp: conv.updated * 1000 };
+}
+
+async function loadHistory() {
+    try {
+        await migrateLocalHistory();
+
+        const loaded = [];
+        let before = null;
+        do {
+            const query = before !== null ? `?before=${before}` : '';
+            const res = await fetch(`/api/conversations${query}`, { headers: apiHeaders() });
+            if (!res.ok) throw new Error(`HTTP error! status: ${res.status}`);
+            const data = await res.json();
+            data.conversations.forEach(conv => loaded.push(toConversationMeta(conv)));
+            before = data.next_before;
+        } while (before !== null);
+
+        // 保留尚未同步到服务端的当前对话
+        const pending = conversations.filter(c => !loaded.some(l => l.id === c.id));
+        conversations = [...pending, ...loaded];
+    } catch (e) {
+        console.error("Failed to load history:", e);
     }
     renderHistoryList();
 }
 
-function cleanOldHistory() {
-    const thirtyDaysAgo = Date.now() - (30 * 24 * 60 * 60 * 1000);
-    const initialCount = conversations.length;
-    conversations = conversations.filter(c => c.timestamp > thirtyDaysAgo);
+// 旧版本把对话全部存在 localStorage 中，首次加载时逐个上传到服务端
+async function migrateLocalHistory() {
+    const stored = localStorage.getItem('chat_history');
+    if (!stored) return;
+
+    let localConversations;
+    try {
+        localConversations = JSON.parse(stored);
+    } catch (e) {
+        localStorage.removeItem('chat_history');
+        return;
+    }
 
-    if (conversations.length !== initialCount) {
-        saveHistory();
+    for (const conv of localConversations) {
+        const messagesRes = await fetch(`/api/conversations/${conv.id}/messages`, {
+            method: 'POST',
+            headers: apiHeaders(),
+            body: JSON.stringify({ base_seq: 0, messages: conv.messages || [] })
+        });
+        if (!messagesRes.ok) throw new Error(`Failed to migrate conversation ${conv.id}`);
+        await fetch(`/api/conversations/${conv.id}`, {
+            method: 'PUT',
+            headers: apiHeaders(),
+            body: JSON.stringify({ title: conv.title, timestamp: conv.timestamp })
+        });
     }
+    localStorage.removeItem('chat_history');
 }
 
-function saveHistory() {
-    const thirtyDaysAgo = Date.now() - (30 * 24 * 60 * 60 * 1000);
-    conversations = conversations.filter(c => c.timestamp > thirtyDaysAgo);
+// 把当前对话中服务端尚未保存的部分作为增量提交：保留前 base_seq 条，其后替换
+function syncConversation() {
+    const conversationId = currentConversationId;
+    const baseSeq = Math.min(syncedCount, messageHistory.length);
+    const delta = messageHistory.slice(baseSeq);
+    syncedCount = messageHistory.length;
 
-    try {
-        localStorage.setItem('chat_history', JSON.stringify(conversations));
-    } catch (e) {
-        if (e.name === 'QuotaExceededError') {
-            console.warn("Local storage full, removing oldest conversation...");
-            // 如果满了，删除最后一条（最早的）记录，然后重试
-            if (conversations.length > 0) {
-                conversations.pop();
-                saveHistory(); // 递归重试
-            } else {
-                console.error("Storage full and cannot be freed.");
-            }
-        } else {
-            console.error("Failed to save history:", e);
+    syncQueue = syncQueue.then(async () => {
+        const res = await fetch(`/api/conversations/${conversationId}/messages`, {
+            method: 'POST',
+            headers: apiHeaders(),
+            body: JSON.stringify({ base_seq: baseSeq, messages: delta })
+        });
+        if (!res.ok) throw new Error(`HTTP error! status: ${res.status}`);
+    }).catch(e => {
+        console.error("Failed to save conversation:", e);
+        // 下次从失败的位置重新提交
+        if (conversationId === currentConversationId) {
+            syncedCount = Math.min(syncedCount, baseSeq);
         }
-    }
-    renderHistoryList();
+    });
+    return syncQueue;
 }
 
 function getRelativeDateLabel(timestamp) {
@@ -520,7 +573,9 @@ function renderHistoryList() {
 function deleteConversation(id) {
     if (confirm("Are you sure you want to delete this conversation?")) {
         conversations = conversations.filter(c => c.id !== id);
-        saveHistory();
+        renderHistoryList();
+        fetch(`/api/conversations/${id}`, { method: 'DELETE', headers: apiHeaders() })
+            .catch(e => console.error("Failed to delete conversation:", e));
 
         // 如果删除的是当前正在看的对话，重置界面
         if (id === currentConversationId) {
@@ -586,6 +641,11 @@ function stopGeneration(savePartialResponse = true) {
         currentAbortController.abort();
         currentAbortController = null;
     }
+    // 通知服务端停止上游生成
+    if (currentStreamId) {
+        fetch(`/api/chat/streams/${currentStreamId}`, { method: 'DELETE' }).catch(() => { });
+        currentStreamId = null;
+    }
 
     // 如果有部分响应内容，保存到历史记录
     if (savePartialResponse && currentAiContentDiv && currentFullResponse) {
@@ -640,13 +700,28 @@ function startNewChat() {
 
     currentConversationId = Date.now().toString();
     messageHistory = [];
+    syncedCount = 0;
     selectedImages = [];
     renderImagePreviews();
     chatContainer.innerHTML = '<div class="welcome-message"><h3>Hello!</h3><p>I\'m your AI assistant. Ask me anything or upload images.</p></div>';
     renderHistoryList();
 }
 
-function loadConversation(id) {
+// 分页读取对话的全部消息
+async function fetchConversationMessages(id) {
+    const messages = [];
+    let after = -1;
+    do {
+        const res = await fetch(`/api/conversations/${id}/messages?after=${after}`, { headers: apiHeaders() });
+        if (!res.ok) throw new Error(`HTTP error! status: ${res.status}`);
+        const data = await res.json();
+        messages.push(...data.messages);
+        after = data.next_after;
+    } while (after !== null);
+    return messages;
+}
+
+async function loadConversation(id) {
     // 如果正在生成回复，先执行停止操作
     stopGeneration(true);
 
@@ -654,8 +729,20 @@ function loadConversation(id) {
     const conv = conversations.find(c => c.id === id);
     if (!conv) return;
 
+    // 等待未完成的增量提交，避免读到旧数据
+    await syncQueue;
+    let messages;
+    try {
+        messages = await fetchConversationMessages(id);
+    } catch (e) {
+        console.error("Failed to load conversation:", e);
+        showToast('加载对话失败');
+        return;
+    }
+
     currentConversationId = id;
-    messageHistory = JSON.parse(JSON.stringify(conv.messages));
+    messageHistory = messages;
+    syncedCount = messages.length;
     selectedImages = [];
     renderImagePreviews();
     chatContainer.innerHTML = '';
@@ -735,39 +822,31 @@ function copyAiMessageContent(contentDiv) {
 
 function updateCurrentConversation(role, content, isImage = false) {
     let conv = conversations.find(c => c.id === currentConversationId);
+    const isNew = !conv;
 
-    // 如果当前ID在列表里找不到（可能是新对话还没存），创建一个新的
-    if (!conv) {
+    // 如果当前ID在列表里找不到（新对话），创建一个新的
+    if (isNew) {
         conv = {
             id: currentConversationId,
             title: 'New Chat',
-            messages: [],
             timestamp: Date.now()
         };
-        conversations.unshift(conv); // 加到开头
     }
 
-    // 如果是用户的第一条消息，异步生成标题
-    if (role === 'user' && conv.messages.length === 0) {
-        conv.title = 'New Chat';    // 先设置默认标题
-        // 异步生成标题（不阻塞主流程）
-        generateConversationTitle(content, conv.id);
+    // 如果是新对话的第一条用户消息，异步生成标题
+    if (role === 'user' && isNew) {
+        // 异步生成标题（不阻塞主流程），在第一条消息提交后再保存
+        syncConversation().then(() => generateConversationTitle(content, conv.id));
+    } else {
+        syncConversation();
     }
-
-    // 更新消息列表
-    // 再次注意：这里我们保存的是 messageHistory 的快照
-    const msgObj = { role, content };
-    if (isImage) msgObj.isImage = true;
-
-    // 实时同步内存中的 history 到 storage 对象
-    conv.messages = [...messageHistory];
     conv.timestamp = Date.now();
 
     // 重新排序：把当前对话移到最前
     conversations = conversations.filter(c => c.id !== currentConversationId);
     conversations.unshift(conv);
 
-    saveHistory();
+    renderHistoryList();
 }
 
 // 异步生成对话标题
@@ -806,8 +885,12 @@ async function generateConversationTitle(content, conversationId) {
         const conv = conversations.find(c => c.id === conversationId);
         if (conv && conv.title === 'New Chat') {
             conv.title = newTitle;
-            saveHistory();
             renderHistoryList();
+            await fetch(`/api/conversations/${conversationId}`, {
+                method: 'PUT',
+                headers: apiHeaders(),
+                body: JSON.stringify({ title: newTitle })
+            });
         }
     } catch (e) {
         console.warn('Title generation error:', e);
@@ -1167,13 +1250,9 @@ async function updateMessage(messageDiv, editContainer, newText, messageIndex) {
         renderMarkdownWithMath(newContent, contentDiv);
     }
 
-    // 保存更新后的对话
-    let conv = conversations.find(c => c.id === currentConversationId);
-    if (conv) {
-        conv.messages = [...messageHistory];
-        conv.timestamp = Date.now();
-        saveHistory();
-    }
+    // 保存更新后的对话：从被编辑的消息开始重新提交
+    syncedCount = Math.min(syncedCount, historyIndex);
+    updateCurrentConversation('user', newContent);
 
     // 重新生成 AI 回复
     const model = modelSelect.value;
@@ -1181,7 +1260,8 @@ async function updateMessage(messageDiv, editContainer, newText, messageIndex) {
 
     if (model === 'gemini-3-pro-image-preview') {
         const recentMessages = messageHistory.slice(-20);
-        await generateImage(recentMessages, model);
+        // 编辑后重新提交：即使内容未变也生成新图
+        await generateImage(recentMessages, model, true);
     } else {
         await generateText(newContent, model);
     }
@@ -1215,11 +1295,6 @@ async function regenerateLastMessage() {
 
     // 更新对话状态（移除被撤销的消息）
     updateCurrentConversation('assistant', '', false);
-    let conv = conversations.find(c => c.id === currentConversationId);
-    if (conv) {
-        conv.messages = [...messageHistory];
-        saveHistory();
-    }
 
     await generateText(lastUserMsgText, model);
     // 按钮状态会在 generateText 的 finally 中恢复
@@ -1309,7 +1384,30 @@ async function handleSend() {
     // 按钮状态会在 generateText/generateImage 的 finally 中恢复
 }
 
-async function generateImage(messages, model = "gemini-3-pro-image-preview") {
+// 轮询图片生成任务，直到完成或失败；网络中断时继续重试，任务在服务端不会丢失
+async function waitForImageJob(jobId, signal) {
+    const pollInterval = 1500;
+    let failures = 0;
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+        if (signal && signal.aborted) throw new DOMException('Aborted', 'AbortError');
+        try {
+            const res = await fetch(`/api/images/jobs/${jobId}`, { signal });
+            const job = await res.json();
+            failures = 0;
+            if (res.status === 404) return { error: { message: "Image job expired." } };
+            if (job.status === 'done') return job.result;
+            if (job.status === 'error') return { error: job.error };
+        } catch (e) {
+            if (e.name === 'AbortError') throw e;
+            failures++;
+            if (failures >= 20) throw e;
+        }
+    }
+}
+
+// fresh=true 时跳过服务端的结果缓存，生成新的变体
+async function generateImage(messages, model = "gemini-3-pro-image-preview", fresh = false) {
     // 创建 AbortController
     currentAbortController = new AbortController();
     isGenerating = true;
@@ -1321,15 +1419,20 @@ async function generateImage(messages, model = "gemini-3-pro-image-preview") {
     try {
         const res = await fetch('/api/images/generations', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify({
                 model: model,
-                messages: messages // 直接发送整个历史
+                messages: messages, // 直接发送整个历史
+                async: true, // 后台生成，返回任务 id 后轮询结果
+                fresh: fresh
             }),
             signal: currentAbortController.signal
         });
 
-        const data = await res.json();
+        let data = await res.json();
+        if (res.status === 202 && data.id) {
+            data = await waitForImageJob(data.id, currentAbortController.signal);
+        }
 
         if (loadingMsgDiv) {
             loadingMsgDiv.remove();
@@ -1387,36 +1490,77 @@ async function generateText(prompt, model) {
     let fullResponse = "";
 
     try {
-        const res = await fetch('/api/chat/completions', {
+        // 只发送最后一条消息，之前的历史由服务端从对话存储中读取
+        const lastIndex = messageHistory.length - 1;
+        let res = await fetch('/api/chat/completions', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: apiHeaders(),
             body: JSON.stringify({
                 model: model,
-                messages: messageHistory,
+                conversation_id: currentConversationId,
+                base_seq: lastIndex,
+                message: messageHistory[lastIndex],
                 stream: true
             }),
             signal: currentAbortController.signal
         });
 
+        if (res.status === 409) {
+            // 服务端的历史还未同步完成，退回发送完整历史（由服务端按 token 预算截取）
+            res = await fetch('/api/chat/completions', {
+                method: 'POST',
+                headers: apiHeaders(),
+                body: JSON.stringify({
+                    model: model,
+                    messages: messageHistory,
+                    stream: true
+                }),
+                signal: currentAbortController.signal
+            });
+        }
+
         if (!res.ok) {
             const errData = await res.json().catch(() => ({}));
             throw new Error(errData.error || `HTTP error! status: ${res.status}`);
         }
 
-        const reader = res.body.getReader();
+        currentStreamId = res.headers.get('X-Stream-Id');
+        let lastEventId = null;
+        let reconnects = 0;
+        let reader = res.body.getReader();
         const decoder = new TextDecoder("utf-8");
 
         aiContentDiv.innerHTML = "";
 
         let buffer = "";
-        while (true) {
+        let finished = false;
+        while (!finished) {
             // 检查是否被取消
             if (currentAbortController && currentAbortController.signal.aborted) {
                 reader.cancel();
                 break;
             }
 
-            const { done, value } = await reader.read();
+            let result;
+            try {
+                result = await reader.read();
+            } catch (e) {
+                // 网络中断：带 Last-Event-ID 重新连接，服务端从断点继续输出
+                if (e.name === 'AbortError' || !currentStreamId || reconnects >= 5) throw e;
+                reconnects++;
+                await new Promise(resolve => setTimeout(resolve, 1000 * reconnects));
+                const headers = lastEventId !== null ? { 'Last-Event-ID': lastEventId } : {};
+                const resumeRes = await fetch(`/api/chat/streams/${currentStreamId}`, {
+                    headers: headers,
+                    signal: currentAbortController.signal
+                });
+                if (!resumeRes.ok) throw e;
+                reader = resumeRes.body.getReader();
+                buffer = "";
+                continue;
+            }
+
+            const { done, value } = result;
             if (done) break;
 
             const chunk = decoder.decode(value, { stream: true });
@@ -1425,9 +1569,14 @@ async function generateText(prompt, model) {
             buffer = lines.pop();
 
             for (const line of lines) {
-                if (line.startsWith('data: ')) {
+                if (line.startsWith('id: ')) {
+                    lastEventId = line.slice(4);
+                } else if (line.startsWith('data: ')) {
                     const dataStr = line.slice(6);
-                    if (dataStr === '[DONE]') break;
+                    if (dataStr === '[DONE]') {
+                        finished = true;
+                        break;
+                    }
 
                     try {
                         const data = JSON.parse(dataStr);
@@ -1592,40 +1741,31 @@ searchInput.addEventListener('keydown', (e) => {
     }
 });
 
-// Perform the search
-function performSearch(query) {
+// Perform the search (服务端在标题与消息文本中查找)
+let searchSeq = 0;
+async function performSearch(query) {
     searchResults.innerHTML = '';
 
+    const seq = ++searchSeq;
     if (!query) return;
 
-    const lowerQuery = query.toLowerCase();
     const results = [];
+    try {
+        const res = await fetch(`/api/conversations/search?q=${encodeURIComponent(query)}`, { headers: apiHeaders() });
+        const data = await res.json();
+        // 输入过程中发起的旧请求晚到时丢弃
+        if (seq !== searchSeq) return;
 
-    conversations.forEach(conv => {
-        // Search in conversation title
-        const titleMatch = conv.title?.toLowerCase().includes(lowerQuery);
-
-        // Search in messages
-        let matchedMessage = null;
-        let matchContext = '';
-
-        for (const msg of conv.messages || []) {
-            const textContent = extractMessageText(msg);
-            if (textContent.toLowerCase().includes(lowerQuery)) {
-                matchedMessage = msg;
-                matchContext = getMatchContext(textContent, lowerQuery);
-                break;
-            }
-        }
-
-        if (titleMatch || matchedMessage) {
+        data.results.forEach(result => {
             results.push({
-                conversation: conv,
-                matchContext: matchContext || (titleMatch ? 'Title match' : ''),
+                conversation: toConversationMeta(result.conversation),
+                matchContext: result.text ? getMatchContext(result.text, query) : 'Title match',
                 query: query
             });
-        }
-    });
+        });
+    } catch (e) {
+        console.error("Search failed:", e);
+    }
 
     // Render results
     if (results.length === 0) {
@@ -1665,24 +1805,6 @@ function performSearch(query) {
     });
 }
 
-// Extract text from message content
-function extractMessageText(msg) {
-    const content = msg.content;
-
-    if (typeof content === 'string') {
-        return content;
-    }
-
-    if (Array.isArray(content)) {
-        return content
-            .filter(item => item.type === 'text')
-            .map(item => item.text)
-            .join(' ');
-    }
-
-    return '';
-}
-
 // Get context around the match
 function getMatchContext(text, query) {
     const lowerText = text.toLowerCase();
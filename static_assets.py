@@ -0,0 +1,186 @@
+"""静态资源：带指纹的 URL、预压缩与条件请求
+
+启动时读取 static/ 与 assets/ 下的文件，按内容哈希生成带指纹的文件名（style.css -> style.3f9a1c2b7d.css），
+并把 index.html 中对本地资源的引用替换为带指纹的 URL。带指纹的 URL 内容不会变化，返回一年的
+immutable 缓存；index.html 与不带指纹的 URL 每次向服务端验证 (no-cache)，未变化时返回 304。
+
+文本类文件预先压缩为 gzip（安装了 brotli 时另外生成 br），按 Accept-Encoding 选择；
+Range 请求只针对原始内容。文件在内存中保存，体积很小；文件修改后（开发时）在下次请求时重新加载。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 带指纹的资源与按内容哈希命名的缓存图片
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 可能变化的资源：允许缓存，但每次使用前验证
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "image/x-icon",
+                      "image/vnd.microsoft.icon")
+# 小于该字节数的文件不压缩
+MIN_COMPRESS_SIZE = 512
+# 检查文件是否修改的最小间隔 (秒)
+RELOAD_INTERVAL = 2.0
+HASH_LENGTH = 10
+
+_FINGERPRINT = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)$" % HASH_LENGTH)
+# index.html 中的 href/src 属性（只处理本地相对或根路径）
+_REFERENCE = re.compile(r'(?P<attr>\b(?:href|src)=")(?P<url>[^":?#]+)"')
+
+
+class Asset:
+
+    def __init__(self, data, mimetype, mtime):
+        self.mimetype = mimetype
+        self.mtime = mtime
+        self.digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        # 编码 -> 内容；identity 为原始内容
+        self.variants = {"identity": data}
+        if mimetype.startswith(COMPRESSIBLE_TYPES) and len(data) >= MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants["br"] = compressed
+
+    def fingerprinted(self, name):
+        stem, ext = os.path.splitext(name)
+        return f"{stem}.{self.digest}{ext}"
+
+
+def _accepted_encodings(header):
+    """解析 Accept-Encoding，返回 q > 0 的编码集合"""
+    accepted = set()
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticAssets:
+
+    def __init__(self, directories, index=None):
+        # directories: {URL 前缀: 目录}，例如 {"": "static", "/assets": "assets"}
+        self.directories = directories
+        # (前缀, 文件名) 所在目录与前缀下的 index 页面，其中的资源引用会被改写为带指纹的 URL
+        self.index = index
+        self.assets = {}
+        self.index_asset = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _scan(self):
+        files = {}
+        for prefix, directory in self.directories.items():
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and not name.startswith("."):
+                    files[(prefix, name)] = path
+        return files
+
+    def reload(self):
+        assets = {}
+        for key, path in self._scan().items():
+            with open(path, "rb") as f:
+                data = f.read()
+            mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            assets[key] = Asset(data, mimetype, os.path.getmtime(path))
+        index_asset = None
+        if self.index in assets:
+            index = assets[self.index]
+            html = index.variants["identity"].decode("utf-8")
+            html = _REFERENCE.sub(lambda m: m.group("attr") + self._rewrite(assets, m.group("url")) + '"', html)
+            index_asset = Asset(html.encode("utf-8"), index.mimetype, index.mtime)
+        self.assets = assets
+        self.index_asset = index_asset
+        self._checked = time.monotonic()
+
+    def _rewrite(self, assets, url):
+        if url.startswith("/"):
+            prefix, _, name = url.rpartition("/")
+        else:
+            # 相对路径：相对于 index 页面所在的目录
+            prefix, name = self.index[0], url
+        asset = assets.get((prefix, name))
+        return url if asset is None else f"{prefix}/{asset.fingerprinted(name)}"
+
+    def _maybe_reload(self):
+        if time.monotonic() - self._checked < RELOAD_INTERVAL:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked < RELOAD_INTERVAL:
+                return
+            current = self._scan()
+            changed = set(current) != set(self.assets) or any(
+                os.path.getmtime(path) != self.assets[key].mtime for key, path in current.items())
+            if changed:
+                self.reload()
+            else:
+                self._checked = time.monotonic()
+
+    def lookup(self, prefix, name):
+        """返回 (Asset, 是否带有与当前内容一致的指纹)；不存在时返回 (None, False)"""
+        self._maybe_reload()
+        asset = self.assets.get((prefix, name))
+        if asset is not None:
+            return asset, False
+        match = _FINGERPRINT.match(name)
+        if match:
+            asset = self.assets.get((prefix, match.group("stem") + match.group("ext")))
+            if asset is not None:
+                # 指纹过期（部署了新版本）时仍返回当前内容，但不允许长期缓存
+                return asset, asset.digest == match.group("hash")
+        return None, False
+
+    def index_response(self, request):
+        """index 页面的响应；页面不存在时返回 None"""
+        self._maybe_reload()
+        if self.index_asset is None:
+            return None
+        return self.response(self.index_asset, request, immutable=False)
+
+    @staticmethod
+    def response(asset, request, immutable):
+        """按 Accept-Encoding 选择预压缩版本，处理 If-None-Match 与 Range"""
+        encoding = "identity"
+        # Range 只针对原始内容
+        if "Range" not in request.headers and len(asset.variants) > 1:
+            accepted = _accepted_encodings(request.headers.get("Accept-Encoding"))
+            for candidate in ("br", "gzip"):
+                if candidate in asset.variants and candidate in accepted:
+                    encoding = candidate
+                    break
+        data = asset.variants[encoding]
+        resp = Response(data, mimetype=asset.mimetype)
+        if encoding != "identity":
+            resp.headers["Content-Encoding"] = encoding
+        if len(asset.variants) > 1:
+            resp.headers["Vary"] = "Accept-Encoding"
+        # 不同编码的内容不同，使用不同的强 ETag
+        resp.set_etag(asset.digest if encoding == "identity" else f"{asset.digest}-{encoding}")
+        resp.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        return resp.make_conditional(request, accept_ranges=encoding == "identity", complete_length=len(data))
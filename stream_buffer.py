@@ -0,0 +1,151 @@
+"""可续传的聊天流
+
+上游生成在独立线程中进行，产生的 SSE 事件按序号保存在回放缓冲区中，与客户端连接解耦；
+客户端断线后带 Last-Event-ID 重新连接即可从断点继续。
+输出时在 flush 窗口内合并相继到达的事件（达到字节阈值立即输出），一次写入代替多次小写入；
+每个连接的第一次写入不等待，避免增加首 token 时间。
+已结束的缓冲区按 TTL、总内存上限与缓冲区个数上限淘汰；个数已满且都未结束时不再接受新的流。
+"""
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayBuffer:
+
+    def __init__(self, stream_id, flush_interval=0.0, flush_bytes=0):
+        self.id = stream_id
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.events = []
+        self.bytes = 0
+        self.done = False
+        self.cancelled = False
+        self.created = time.time()
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def append(self, event):
+        with self._cond:
+            self.events.append(event)
+            self.bytes += len(event)
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def _coalesce(self, index):
+        """已有待输出事件时，在 flush 窗口内等待更多事件，直到达到字节阈值或生成结束（调用时持有 _cond）"""
+        deadline = time.monotonic() + self.flush_interval
+        while not self.done:
+            if sum(len(e) for e in self.events[index:]) >= self.flush_bytes:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._cond.wait(remaining)
+
+    def iter_from(self, start, heartbeat=15):
+        """从第 start 个事件开始输出 SSE（带 id），生成未结束时等待新事件；长时间无数据时发送注释保活"""
+        index = start
+        # 尚未向该连接写出过事件：有事件就立即输出，之后的事件才合并
+        flushed = False
+        while True:
+            with self._cond:
+                if index >= len(self.events) and not self.done:
+                    self._cond.wait(heartbeat)
+                if self.flush_interval and flushed and index < len(self.events):
+                    self._coalesce(index)
+                pending = self.events[index:]
+                done = self.done
+            if pending:
+                yield "".join(f"id: {i}\n{event}" for i, event in enumerate(pending, index))
+                index += len(pending)
+                flushed = True
+            elif done:
+                return
+            else:
+                yield ": keep-alive\n\n"
+
+
+class StreamRegistry:
+
+    def __init__(self, max_bytes, ttl, flush_interval=0.0, flush_bytes=0, max_streams=256):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def has_capacity(self):
+        """是否还能开始新的流（已结束的缓冲区会先被淘汰）"""
+        self.prune()
+        with self._lock:
+            return len(self._streams) < self.max_streams
+
+    def start(self, source):
+        """在后台线程中消费 source（逐个产生 SSE 事件文本的生成器），返回对应的缓冲区"""
+        self.prune()
+        buffer = ReplayBuffer(uuid.uuid4().hex, self.flush_interval, self.flush_bytes)
+        with self._lock:
+            self._streams[buffer.id] = buffer
+        threading.Thread(target=self._produce, args=(buffer, source), name=f"stream-{buffer.id[:8]}", daemon=True).start()
+        return buffer
+
+    @staticmethod
+    def _produce(buffer, source):
+        try:
+            for event in source:
+                if buffer.cancelled:
+                    break
+                buffer.append(event)
+        except Exception as e:
+            logger.warning("Stream failed", extra={"stream": buffer.id, "error": str(e)})
+        finally:
+            # 关闭生成器，释放上游连接
+            close = getattr(source, "close", None)
+            if close:
+                close()
+            buffer.finish()
+
+    def get(self, stream_id):
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def cancel(self, stream_id):
+        buffer = self.get(stream_id)
+        if buffer is not None:
+            buffer.cancelled = True
+        return buffer is not None
+
+    def prune(self):
+        """删除过期的已结束缓冲区；总量或个数超出上限时从最早结束的开始删除"""
+        now = time.time()
+        with self._lock:
+            finished = sorted(
+                (b for b in self._streams.values() if b.done), key=lambda b: b.finished_at)
+            total = sum(b.bytes for b in self._streams.values())
+            for buffer in finished:
+                # 为新的流留出一个位置
+                if (now - buffer.finished_at > self.ttl or total > self.max_bytes
+                        or len(self._streams) >= self.max_streams):
+                    del self._streams[buffer.id]
+                    total -= buffer.bytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "streams": len(self._streams),
+                "active": sum(1 for b in self._streams.values() if not b.done),
+                "bytes": sum(b.bytes for b in self._streams.values()),
+                "max_bytes": self.max_bytes,
+                "max_streams": self.max_streams,
+            }
@@ -0,0 +1,117 @@
+"""上下文缓存：对 bench/fake_gemini.py 模拟的上游测试创建、失败回退与缓存失效后的重试"""
+import dataclasses
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+
+from fake_gemini import FakeGemini
+
+import app
+from config import Config
+from context_cache import ContextCache
+
+MODEL = "gemini-2.5-flash"
+SYSTEM = {"parts": [{"text": "system prompt"}]}
+CONTENTS = [
+    {"role": "user", "parts": [{"text": "first question"}]},
+    {"role": "model", "parts": [{"text": "first answer"}]},
+    {"role": "user", "parts": [{"text": "second question"}]},
+]
+
+
+@pytest.fixture
+def fake():
+    server = FakeGemini(prefill_ms_per_mb=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ContextCache(str(tmp_path / "context_cache.db"), make_body=lambda payload: json.dumps(payload).encode(),
+                        min_tokens=0, step=2)
+
+
+def create_requests(fake):
+    return [path for path, _ in fake.requests if path.endswith("/cachedContents")]
+
+
+def test_created_on_second_sighting(fake, cache):
+    assert cache.get(MODEL, SYSTEM, CONTENTS, fake.url, "key") is None
+    assert create_requests(fake) == []
+
+    name, length, _ = cache.get(MODEL, SYSTEM, CONTENTS, fake.url, "key")
+    assert length == 2
+    assert name in fake.caches
+    assert len(create_requests(fake)) == 1
+
+    # 之后的请求直接使用已创建的缓存
+    assert cache.get(MODEL, SYSTEM, CONTENTS, fake.url, "key")[0] == name
+    assert len(create_requests(fake)) == 1
+    assert cache.stats()["created"] == 1
+
+
+def test_falls_back_when_creation_fails(fake, cache):
+    fake.min_cache_tokens = 10 ** 9
+    assert cache.get(MODEL, SYSTEM, CONTENTS, fake.url, "key") is None
+    assert cache.get(MODEL, SYSTEM, CONTENTS, fake.url, "key") is None
+    assert len(create_requests(fake)) == 1
+    assert cache.failures == 1
+    # 失败后一段时间内不再尝试创建，直接发送完整请求
+    assert cache.get(MODEL, SYSTEM, CONTENTS, fake.url, "key") is None
+    assert len(create_requests(fake)) == 1
+
+
+@pytest.fixture
+def cached_app(fake, tmp_path):
+    original = app.config
+    config = dataclasses.replace(
+        Config.from_env(),
+        gemini_base_url=fake.url,
+        gemini_api_keys=[(fake.url, "key")],
+        image_cache_dir=str(tmp_path / "cache_images"),
+        **{field: str(tmp_path / f"{field}.sqlite") for field in (
+            "image_index_db", "image_jobs_db", "generation_cache_db", "conversations_db", "context_cache_db",
+            "security_db")},
+        context_cache=True,
+        context_cache_min_tokens=0,
+        context_cache_step=2,
+    )
+    app.create_app(config)
+    yield app
+    app.create_app(original)
+
+
+def stream(messages):
+    events = list(app.stream_gemini_native(MODEL, messages))
+    assert events[-1] == "data: [DONE]\n\n", events
+    return "".join(json.loads(e[len("data: "):])["choices"][0]["delta"].get("content", "") for e in events[:-1])
+
+
+def test_rejected_cache_is_invalidated_and_request_retried(fake, cached_app):
+    messages = [
+        {"role": "user", "content": "first question"},
+        {"role": "assistant", "content": "first answer"},
+        {"role": "user", "content": "second question"},
+    ]
+    stream(messages)
+    stream(messages)
+    assert len(fake.caches) == 1
+
+    # 服务商一侧的缓存已过期或被删除：引用它的请求返回 404
+    fake.caches.clear()
+    fake.reset()
+    assert stream(messages) == fake.reply
+    paths = [path for path, _ in fake.requests]
+    assert len([p for p in paths if p.endswith(":streamGenerateContent")]) == 2
+    assert app.context_cache.stats()["entries"] == 0
+
+    # 下一次请求重新创建缓存
+    fake.reset()
+    assert stream(messages) == fake.reply
+    assert len(create_requests(fake)) == 1
+    assert len(fake.caches) == 1
@@ -0,0 +1,96 @@
+"""Gemini 流回放测试：录制的 alt=sse 响应在任意字节边界切分后，转换出的 OpenAI 事件不变"""
+import json
+import random
+
+import pytest
+
+import app
+
+# 录制的 Gemini streamGenerateContent?alt=sse 响应（事件间以 \r\n\r\n 分隔）
+RECORDED = [
+    {"candidates": [{"content": {"parts": [{"text": "你好"}], "role": "model"}, "index": 0}],
+     "usageMetadata": {"promptTokenCount": 12, "totalTokenCount": 12}, "modelVersion": "gemini-2.5-flash"},
+    {"candidates": [{"content": {"parts": [{"text": "，这是一段 😀 "}], "role": "model"}, "index": 0}],
+     "modelVersion": "gemini-2.5-flash"},
+    {"candidates": [{"content": {"parts": [{"text": "带签名的文本", "thoughtSignature": "c2lnbmF0dXJlLTE="}],
+                                 "role": "model"}, "index": 0}],
+     "modelVersion": "gemini-2.5-flash"},
+    {"candidates": [{"content": {"parts": [{"text": "。结尾"}], "role": "model"},
+                     "finishReason": "MAX_TOKENS", "index": 0}],
+     "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 20, "thoughtsTokenCount": 5,
+                       "totalTokenCount": 37, "cachedContentTokenCount": 8},
+     "modelVersion": "gemini-2.5-flash"},
+]
+STREAM = b"".join(
+    b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\r\n\r\n" for chunk in RECORDED)
+TEXT = "".join(part["text"] for chunk in RECORDED for part in chunk["candidates"][0]["content"]["parts"])
+
+
+def replay(pieces):
+    """按上游读取的切分把流交给解码器与 relay，返回解析出的响应块与 OpenAI 事件"""
+    decoder = app.GeminiStreamDecoder()
+    relay = app.gemini_relay("gemini-2.5-flash")
+    chunks, events = [], []
+    for piece in pieces:
+        decoded = decoder.feed(piece)
+        chunks.extend(decoded)
+        events.extend(app.relay_gemini_chunks(relay, decoded))
+    decoded = decoder.flush()
+    chunks.extend(decoded)
+    events.extend(app.relay_gemini_chunks(relay, decoded))
+    return chunks, [json.loads(event[len("data: "):]) for event in events], relay
+
+
+def check(pieces):
+    chunks, events, relay = replay(pieces)
+    # 每个响应块恰好解析一次
+    assert chunks == RECORDED
+    deltas = [event["choices"][0]["delta"] for event in events]
+    assert "".join(delta.get("content", "") for delta in deltas) == TEXT
+    assert [d["thoughtSignature"] for d in deltas if "thoughtSignature" in d] == ["c2lnbmF0dXJlLTE="]
+    finishes = [event["choices"][0]["finish_reason"] for event in events]
+    assert [f for f in finishes if f] == ["length"] and finishes[-1] == "length"
+    usage = {
+        "prompt_tokens": 12,
+        "completion_tokens": 25,
+        "total_tokens": 37,
+        "prompt_tokens_details": {"cached_tokens": 8},
+    }
+    assert events[-1]["usage"] == usage
+    assert relay.usage == usage
+
+
+def test_single_read():
+    check([STREAM])
+
+
+def test_split_at_every_byte_boundary():
+    for i in range(len(STREAM) + 1):
+        check([STREAM[:i], STREAM[i:]])
+
+
+def test_one_byte_at_a_time():
+    check([STREAM[i:i + 1] for i in range(len(STREAM))])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_splits(seed):
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(STREAM)), rng.randint(1, 12)))
+    check([STREAM[a:b] for a, b in zip([0] + cuts, cuts + [len(STREAM)])])
+
+
+@pytest.mark.parametrize("reason, expected", [
+    ("STOP", "stop"),
+    ("SAFETY", "content_filter"),
+    ("RECITATION", "content_filter"),
+    ("MALFORMED_FUNCTION_CALL", "malformed_function_call"),
+])
+def test_finish_reason_mapping(reason, expected):
+    chunk = {"candidates": [{"content": {"parts": []}, "finishReason": reason}]}
+    assert app.gemini_chunk_delta(chunk) == ({}, expected, None)
+
+
+def test_chunk_without_content_is_skipped():
+    assert app.gemini_chunk_delta({"candidates": [{"content": {"parts": []}}]}) is None
+    assert app.gemini_chunk_delta({"usageMetadata": {"promptTokenCount": 3}}) is None
@@ -0,0 +1,78 @@
+"""SSEDecoder 回放测试：同一段流在任意字节边界切分后解析结果不变"""
+import json
+
+import pytest
+
+from sse import SSEDecoder, iter_events
+
+EVENTS = [
+    '{"text":"hello"}',
+    '{"text":"你好，世界"}',
+    '{"text":"emoji 😀 and ü"}',
+    "line one\nline two",
+    "[DONE]",
+]
+
+
+def encode(events, newline):
+    out = []
+    for i, data in enumerate(events):
+        out.append(f"id: {i}{newline}")
+        out.append(": comment" + newline)
+        for line in data.split("\n"):
+            out.append(f"data: {line}{newline}")
+        out.append(newline)
+    return "".join(out).encode("utf-8")
+
+
+def decode(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_split_at_every_byte_boundary(newline):
+    stream = encode(EVENTS, newline)
+    for i in range(len(stream) + 1):
+        assert decode([stream[:i], stream[i:]]) == EVENTS, f"split at byte {i}"
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_one_byte_at_a_time(newline):
+    stream = encode(EVENTS, newline)
+    assert decode([stream[i:i + 1] for i in range(len(stream))]) == EVENTS
+
+
+def test_split_inside_multibyte_sequences():
+    stream = encode(EVENTS, "\r\n")
+    # 每个多字节 UTF-8 字符内部的每个切分位置
+    boundaries = [i for i in range(1, len(stream)) if stream[i] & 0xC0 == 0x80]
+    assert boundaries
+    for i in boundaries:
+        assert decode([stream[:i], stream[i:]]) == EVENTS, f"split at byte {i}"
+
+
+def test_split_between_cr_and_lf():
+    stream = encode(EVENTS, "\r\n")
+    for i in range(1, len(stream)):
+        if stream[i - 1:i + 1] == b"\r\n":
+            assert decode([stream[:i], stream[i:]]) == EVENTS, f"split at byte {i}"
+
+
+def test_flush_returns_unterminated_event():
+    decoder = SSEDecoder()
+    assert decoder.feed(b'data: {"a":1}\r\n\r\ndata: {"b"') == ['{"a":1}']
+    assert decoder.feed(b":2}") == []
+    assert decoder.flush() == ['{"b":2}']
+
+
+def test_iter_events_reframes_chunks():
+    stream = encode(EVENTS, "\r\n")
+    chunks = [stream[i:i + 7] for i in range(0, len(stream), 7)]
+    out = "".join(iter_events(iter(chunks)))
+    assert out == "".join("data: " + e.replace("\n", "\ndata: ") + "\n\n" for e in EVENTS)
+    assert json.loads(out.split("\n\n")[1][len("data: "):]) == {"text": "你好，世界"}
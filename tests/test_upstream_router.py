@@ -0,0 +1,57 @@
+"""UpstreamRouter 限流冷却：只有一个 backend 时 429 不会让服务整段冷却时间不可用"""
+import pytest
+
+import upstream_router
+from upstream_router import NoBackendAvailable, UpstreamRouter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstream_router.time, "time", clock.time)
+    return clock
+
+
+def make_router(keys):
+    router = UpstreamRouter([], "gemini", cooldown=30.0, error_cooldown=5.0, acquire_timeout=0)
+    router.add_provider("gemini", [("https://example.test", key) for key in keys], max_inflight=4)
+    return router
+
+
+def test_single_backend_usable_after_retry_after(clock):
+    router = make_router(["a"])
+    backend = router.backends["gemini"][0]
+    router.penalize(backend, 429, {"Retry-After": "2"})
+    with pytest.raises(NoBackendAvailable) as e:
+        router.acquire("gemini")
+    assert e.value.retry_after == 2
+    clock.now += 2
+    assert router.acquire("gemini") is backend
+
+
+def test_single_backend_without_retry_after_waits_error_cooldown(clock):
+    router = make_router(["a"])
+    backend = router.backends["gemini"][0]
+    router.penalize(backend, 429, {})
+    clock.now += 4
+    with pytest.raises(NoBackendAvailable):
+        router.acquire("gemini")
+    clock.now += 1
+    assert router.acquire("gemini") is backend
+
+
+def test_throttled_backend_avoided_while_another_is_ready(clock):
+    router = make_router(["a", "b"])
+    first, second = router.backends["gemini"]
+    router.penalize(first, 429, {})
+    clock.now += 10
+    for _ in range(3):
+        assert router.acquire("gemini") is second
@@ -0,0 +1,160 @@
+"""对话标题生成：缓存、合并相同请求与本地兜底
+
+标题按规范化后的首条消息缓存（LRU + TTL），"你好" 之类的常见开场白只请求一次上游；
+同一消息的并发请求共用一次上游调用。上游调用在有界线程池中执行，请求最多等待 wait_timeout 秒，
+超时、线程池已满或上游失败时立即返回按关键词截取的本地标题（可关闭），上游结果在完成后仍写入缓存。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+DEFAULT_TITLE = "New Chat"
+# 本地标题的最大长度：中日韩字符数 / 英文单词数
+HEURISTIC_MAX_CHARS = 16
+HEURISTIC_MAX_WORDS = 6
+
+# 正则在首次使用时由 re 编译并缓存，不在导入时编译
+_WHITESPACE = r"\s+"
+_URL = r"https?://\S+"
+_MARKUP = r"[`*_#>\[\](){}|~]+"
+_SENTENCE_END = r"[。！？!?；;\n]|[.,，、:：](?=\s|$)"
+_CJK = r"[぀-ヿ㐀-鿿가-힯]"
+# 开头的客套话，不进入标题
+_FILLER = (
+    r"(?i)^(?:(?:请问|请|麻烦|帮我|帮忙|能不能|可以|你好|您好|嗨|hi|hello|hey|please|can you|could you|"
+    r"would you|i want to|i'd like to|help me|tell me)[\s,，、:：!！]*)+"
+)
+
+
+def normalize(message):
+    """缓存键：忽略大小写、空白与末尾标点的差异"""
+    text = re.sub(_WHITESPACE, " ", message).strip().lower()
+    return text.rstrip("。！？!?.~～ ")
+
+
+def heuristic_title(message):
+    """取首句去掉客套话后的开头部分作为标题；无可用内容时返回默认标题"""
+    text = re.sub(_MARKUP, " ", re.sub(_URL, " ", message))
+    text = re.sub(_WHITESPACE, " ", text).strip()
+    first = re.split(_SENTENCE_END, text, maxsplit=1)[0].strip()
+    stripped = re.sub(_FILLER, "", first).strip()
+    text = stripped or first
+    if not text:
+        return DEFAULT_TITLE
+    if re.search(_CJK, text):
+        title = text[:HEURISTIC_MAX_CHARS]
+    else:
+        words = text.split(" ")
+        title = " ".join(words[:HEURISTIC_MAX_WORDS])
+        title = title[:1].upper() + title[1:]
+    return title.rstrip(" ,，、:：-")
+
+
+class TitleCache:
+
+    def __init__(self, generate, max_entries=1024, ttl=86400, max_inflight=4, wait_timeout=3.0, fallback=True):
+        # generate(message) 请求上游生成标题，失败时返回 None
+        self.generate = generate
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_inflight = max_inflight
+        self.wait_timeout = wait_timeout
+        self.fallback = fallback
+        self._entries = OrderedDict()  # key -> (expires, title)
+        self._pending = {}  # key -> Future
+        self._executor = ThreadPoolExecutor(max_inflight, thread_name_prefix="title")
+        self._lock = threading.Lock()
+        # 统计
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.upstream = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.saturated = 0
+        self.fallbacks = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key, title):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, title)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _run(self, key, message):
+        try:
+            title = self.generate(message)
+        except Exception:
+            title = None
+        if title:
+            self._store(key, title)
+        with self._lock:
+            self._pending.pop(key, None)
+            if not title:
+                self.failures += 1
+        return title
+
+    def get(self, message):
+        """返回 (标题, 来源)；来源为 cache / upstream / fallback / default"""
+        key = normalize(message)
+        with self._lock:
+            self.requests += 1
+            title = self._lookup(key)
+            if title is not None:
+                self.hits += 1
+                return title, "cache"
+            future = self._pending.get(key)
+            if future is not None:
+                self.coalesced += 1
+            elif len(self._pending) >= self.max_inflight * 2:
+                # 上游已积压：不再排队，直接使用本地标题
+                self.saturated += 1
+            else:
+                self.upstream += 1
+                future = self._pending[key] = self._executor.submit(self._run, key, message)
+
+        title = None
+        if future is not None:
+            try:
+                title = future.result(timeout=self.wait_timeout)
+            except FutureTimeout:
+                # 上游仍在执行，完成后写入缓存
+                with self._lock:
+                    self.timeouts += 1
+        if title:
+            return title, "upstream"
+        if not self.fallback:
+            return DEFAULT_TITLE, "default"
+        with self._lock:
+            self.fallbacks += 1
+        return heuristic_title(message), "fallback"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "inflight": len(self._pending),
+                "requests": self.requests,
+                "hits": self.hits,
+                "coalesced": self.coalesced,
+                "upstream": self.upstream,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "saturated": self.saturated,
+                "fallbacks": self.fallbacks,
+                "hit_ratio": round(self.hits / self.requests, 4) if self.requests else 0.0,
+                "fallback_rate": round(self.fallbacks / self.requests, 4) if self.requests else 0.0,
+            }
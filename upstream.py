@@ -0,0 +1,83 @@
+"""上游 HTTP 客户端：按主机复用 keep-alive 连接池，统一超时与重试
+
+下面的默认值由 create_app() 调用 configure() 按 Config 覆盖。
+"""
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# 每个主机的连接池大小（并发请求数超过后会新建非复用连接）
+POOL_MAXSIZE = 32
+# 超时 (秒)：连接超时 / 两次读取之间的最大间隔
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 120.0
+# 重试：仅在连接失败或上游明确拒绝 (429/503) 时重试，此时尚未收到任何响应内容
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUS = (429, 503)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def configure(config):
+    """按应用配置设置连接池、超时与重试；已创建的 Session 丢弃，下次使用时按新配置重建"""
+    global POOL_MAXSIZE, CONNECT_TIMEOUT, READ_TIMEOUT, MAX_RETRIES, RETRY_BACKOFF
+    POOL_MAXSIZE = config.upstream_pool_maxsize
+    CONNECT_TIMEOUT = config.upstream_connect_timeout
+    READ_TIMEOUT = config.upstream_read_timeout
+    MAX_RETRIES = config.upstream_max_retries
+    RETRY_BACKOFF = config.upstream_retry_backoff
+    with _sessions_lock:
+        _sessions.clear()
+
+
+def _build_session(retry_status=True):
+    retry = Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=0,  # 请求已发出后的读错误不重试，避免重复生成
+        status=MAX_RETRIES if retry_status else 0,
+        status_forcelist=RETRY_STATUS if retry_status else (),
+        allowed_methods=frozenset(["GET", "POST"]),
+        backoff_factor=RETRY_BACKOFF,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url, retry_status=True):
+    """获取目标主机对应的共享 Session（首次使用时创建）
+
+    retry_status=False 的 Session 不在 429/503 时原地重试，由调用方（上游路由）换 key 重发。
+    """
+    parts = urlsplit(url)
+    key = (f"{parts.scheme}://{parts.netloc}", retry_status)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _build_session(retry_status)
+                _sessions[key] = session
+    return session
+
+
+def request(method, url, read_timeout=None, retry_status=True, **kwargs):
+    """通过连接池发送请求；未指定 timeout 时使用默认的连接/读取超时"""
+    if "timeout" not in kwargs:
+        kwargs["timeout"] = (CONNECT_TIMEOUT, read_timeout or READ_TIMEOUT)
+    return get_session(url, retry_status).request(method, url, **kwargs)
+
+
+def post(url, read_timeout=None, **kwargs):
+    return request("POST", url, read_timeout=read_timeout, **kwargs)
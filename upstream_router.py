@@ -0,0 +1,286 @@
+"""上游路由：每个服务商可配置多个 key / endpoint
+
+每个 backend（一个 key + endpoint）有并发上限。选择时跳过冷却中与已满的 backend，在其余中选
+当前负载最低的；收到 429（按 Retry-After）、5xx 或连接失败时该 backend 进入冷却，
+并在响应内容开始返回之前换下一个 backend 重试。没有其他可用 backend 时，被限流的 backend
+过了上游给出的 Retry-After 即可再次使用，不必等完整个冷却时间。
+所有 backend 都不可用时抛出 NoBackendAvailable，调用方返回 429 与 Retry-After。
+"""
+import logging
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# 换 backend 重试的状态码
+FAILOVER_STATUS = (429, 500, 502, 503, 504)
+# key 无效/无权限：长时间停用
+AUTH_FAILURE_STATUS = (401, 403)
+AUTH_FAILURE_COOLDOWN = 600
+
+
+class NoBackendAvailable(Exception):
+    """没有可用的 backend；retry_after 为预计可重试的秒数"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def parse_keys(spec, default_url):
+    """解析 "key,key@https://endpoint/v1,..."：每项为一个 key，可用 @ 指定 endpoint"""
+    entries = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, url = item.partition("@")
+        entries.append((url.strip().rstrip("/") or default_url, key.strip()))
+    return entries
+
+
+def parse_routes(spec):
+    """解析 "model-prefix=provider,..." 形式的模型路由"""
+    routes = []
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        prefix, _, provider = item.partition("=")
+        routes.append((prefix.strip().lower(), provider.strip()))
+    # 最长前缀优先
+    return sorted(routes, key=lambda r: len(r[0]), reverse=True)
+
+
+def _retry_after(headers, default):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return default
+
+
+class Backend:
+
+    def __init__(self, provider, index, base_url, api_key, max_inflight):
+        self.provider = provider
+        self.name = f"{provider}#{index}"
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.cooldown_until = 0.0
+        # 冷却原因：被限流 (429) 时不再发送；其他错误在没有别的选择时仍可尝试
+        self.throttled = False
+        # 被限流时上游允许重试的时间：没有其他可用 backend 时过了该时间即可使用
+        self.retry_at = 0.0
+        self.last_used = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self, now):
+        return {
+            "name": self.name,
+            "endpoint": self.base_url,
+            "key": f"...{self.api_key[-4:]}" if self.api_key else "",
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "cooldown": round(max(0.0, self.cooldown_until - now), 1),
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class Lease:
+    """选中的 backend 与其响应；close() 关闭响应并归还并发名额（可重复调用）"""
+
+    def __init__(self, router, backend, response):
+        self.router = router
+        self.backend = backend
+        self.response = response
+        self._closed = False
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                self.response.close()
+            finally:
+                self.router.release(self.backend)
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                await self.response.aclose()
+            finally:
+                self.router.release(self.backend)
+
+    def __enter__(self):
+        return self.response
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UpstreamRouter:
+
+    def __init__(self, routes, default_provider, cooldown=30.0, error_cooldown=5.0, acquire_timeout=10.0):
+        self.routes = routes
+        self.default_provider = default_provider
+        # 429 未带 Retry-After 时的冷却时间；5xx/连接失败的冷却时间
+        self.cooldown = cooldown
+        self.error_cooldown = error_cooldown
+        # 所有 backend 都已满时最多等待的时间
+        self.acquire_timeout = acquire_timeout
+        self.backends = {}
+        self._cond = threading.Condition()
+
+    def add_provider(self, provider, entries, max_inflight):
+        """entries 为 [(base_url, api_key)]"""
+        self.backends[provider] = [
+            Backend(provider, i, url, key, max_inflight) for i, (url, key) in enumerate(entries)]
+
+    def provider_for(self, model):
+        model = model.lower()
+        for prefix, provider in self.routes:
+            if model.startswith(prefix):
+                return provider
+        return self.default_provider
+
+    # --- 选择 backend ---
+
+    def _try_acquire(self, provider, exclude):
+        """选出负载最低的可用 backend 并占用一个名额；暂无可用时返回 None，
+        不会再有可用 backend（都已试过或都在冷却）时抛出 NoBackendAvailable"""
+        now = time.time()
+        candidates = [b for b in self.backends.get(provider, []) if b not in exclude]
+        if not candidates:
+            raise NoBackendAvailable(f"No {provider} upstream available")
+        ready = [b for b in candidates if b.cooldown_until <= now]
+        if not ready:
+            ready = [b for b in candidates if not b.throttled or b.retry_at <= now]
+        if not ready:
+            retry_after = min(b.retry_at for b in candidates) - now
+            raise NoBackendAvailable(f"All {provider} upstreams are rate limited", retry_after)
+        free = [b for b in ready if b.inflight < b.max_inflight]
+        if not free:
+            return None
+        backend = min(free, key=lambda b: (b.inflight / b.max_inflight, b.last_used))
+        backend.inflight += 1
+        backend.requests += 1
+        backend.last_used = now
+        return backend
+
+    def acquire(self, provider, exclude=()):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                backend = self._try_acquire(provider, exclude)
+                if backend is not None:
+                    return backend
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NoBackendAvailable(f"All {provider} upstreams are busy")
+                self._cond.wait(remaining)
+
+    async def acquire_async(self, provider, exclude=()):
+        # asyncio 只在 ASGI 模式下需要，不在导入时加载
+        import asyncio
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                backend = self._try_acquire(provider, exclude)
+            if backend is not None:
+                return backend
+            if time.monotonic() >= deadline:
+                raise NoBackendAvailable(f"All {provider} upstreams are busy")
+            await asyncio.sleep(0.05)
+
+    def release(self, backend):
+        with self._cond:
+            backend.inflight -= 1
+            self._cond.notify_all()
+
+    def penalize(self, backend, status_code=None, headers=None):
+        """按失败类型设置冷却时间
+
+        429 未带 Retry-After 时冷却 cooldown 秒，但没有其他 backend 时 error_cooldown 秒后即可重试。
+        """
+        retry_after = self.error_cooldown
+        if status_code == 429:
+            retry_after = _retry_after(headers or {}, retry_after)
+            duration = _retry_after(headers or {}, self.cooldown)
+        elif status_code in AUTH_FAILURE_STATUS:
+            duration = AUTH_FAILURE_COOLDOWN
+        else:
+            duration = self.error_cooldown
+        with self._cond:
+            backend.failures += 1
+            backend.throttled = status_code == 429
+            backend.cooldown_until = time.time() + duration
+            backend.retry_at = time.time() + retry_after
+        logger.warning("Upstream failed, cooling down", extra={
+            "backend": backend.name, "status": status_code or "connection error", "cooldown": round(duration)})
+
+    def _has_alternative(self, provider, tried):
+        now = time.time()
+        return any(b not in tried and b.cooldown_until <= now for b in self.backends.get(provider, []))
+
+    # --- 发送 ---
+
+    def send(self, provider, send, errors=(requests.RequestException,)):
+        """send(backend) 用选中的 backend 发送请求并返回响应（流式请求只读取到响应头）；
+        可重试的失败换 backend 重发，返回 Lease。没有其他 backend 时返回最后一次的失败响应。"""
+        tried = set()
+        while True:
+            backend = self.acquire(provider, tried)
+            tried.add(backend)
+            try:
+                resp = send(backend)
+            except errors:
+                self.release(backend)
+                self.penalize(backend)
+                if self._has_alternative(provider, tried):
+                    continue
+                raise
+            except:
+                self.release(backend)
+                raise
+            if resp.status_code in FAILOVER_STATUS + AUTH_FAILURE_STATUS:
+                self.penalize(backend, resp.status_code, resp.headers)
+                if self._has_alternative(provider, tried):
+                    resp.close()
+                    self.release(backend)
+                    continue
+            return Lease(self, backend, resp)
+
+    async def send_async(self, provider, send, errors):
+        """send 的异步版本：send(backend) 为协程，返回 httpx 流式响应"""
+        tried = set()
+        while True:
+            backend = await self.acquire_async(provider, tried)
+            tried.add(backend)
+            try:
+                resp = await send(backend)
+            except errors:
+                self.release(backend)
+                self.penalize(backend)
+                if self._has_alternative(provider, tried):
+                    continue
+                raise
+            except:
+                self.release(backend)
+                raise
+            if resp.status_code in FAILOVER_STATUS + AUTH_FAILURE_STATUS:
+                self.penalize(backend, resp.status_code, resp.headers)
+                if self._has_alternative(provider, tried):
+                    await resp.aclose()
+                    self.release(backend)
+                    continue
+            return Lease(self, backend, resp)
+
+    def stats(self):
+        now = time.time()
+        with self._cond:
+            return {provider: [b.stats(now) for b in backends] for provider, backends in self.backends.items()}